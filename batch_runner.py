@@ -0,0 +1,183 @@
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy
+
+import constants
+import main
+from collision import CollisionEvent
+from constants import Color
+from engine import SimulationResult, run_headless
+from models import Ball, Robot
+from multi_world import MultiWorldEngine
+
+
+# Scenes by the seed, the seed is only passed down, the global random state is not touched
+def _single_scenario(seed):
+    robots = [Robot(constants.x_start_left, constants.y_start_left, constants.theta_start, Color.WHITE)]
+    return robots, Ball.create_randomized(seed=seed), []
+
+
+def _fleet_scenario(seed):
+    return main._generate_robots(cnt=constants.ROBOTS_COUNT), Ball.create_randomized(seed=seed), []
+
+
+def _two_rows_scenario(seed):
+    return main._generate_robots(cnt=2 * constants.ROBOTS_COUNT), Ball.create_randomized(seed=seed), []
+
+
+SCENARIOS = {
+    'single': _single_scenario,
+    'fleet': _fleet_scenario,
+    'two rows': _two_rows_scenario,
+}
+
+# Planner configurations are options of @SimulationEngine
+CONFIGS = {
+    'every tick': {},
+    'scheduled': {'replanning_period': 0.5},
+    'adaptive': {'adaptive_tolerance': 0.01, 'dt': 0.3},
+}
+
+
+class Episode:
+    def __init__(self, seed, scenario, config_name, config, max_time):
+        self.seed = seed
+        self.scenario = scenario
+        self.config_name = config_name
+        self.config = config
+        self.max_time = max_time
+
+
+class EpisodeResult:
+    def __init__(self, episode: Episode, result: SimulationResult):
+        self.seed = episode.seed
+        self.scenario = episode.scenario
+        self.config_name = episode.config_name
+        self.outcome = result.outcome
+        self.sim_time = result.sim_time
+        self.ticks = result.ticks
+        self.wall_time = result.wall_time
+        # time of the first contact which may be inside of the last tick
+        self.event_time = result.events[0].time if result.events else None
+        self.crashes_cnt = sum(event.kind == CollisionEvent.Kind.CRASH for event in result.events)
+        self.events = [repr(event) for event in result.events]
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+def run_episode(episode: Episode) -> EpisodeResult:
+    robots, ball, obstacles = SCENARIOS[episode.scenario](episode.seed)
+    result = run_headless(robots, ball, obstacles, episode.max_time, **episode.config)
+    return EpisodeResult(episode, result)
+
+
+def get_episodes(seeds, scenarios=tuple(SCENARIOS), configs=None, max_time=60.0):
+    configs = CONFIGS if configs is None else configs
+    return [Episode(seed, scenario, config_name, config, max_time)
+            for scenario in scenarios for config_name, config in configs.items() for seed in seeds]
+
+
+# Runs the episodes in a pool of @workers processes (the number of cores by default) and yields the results
+# as they finish, not in the order of the episodes
+def run_batch(episodes: [Episode], workers=None):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_episode, episode) for episode in episodes]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+# Runs the episodes with the same scenario and time limit as worlds of one @MultiWorldEngine in this process,
+# only the 'every tick' planner configuration (empty options) is supported. Yields the results by the groups.
+def run_vectorized(episodes: [Episode]):
+    groups = {}
+    for episode in episodes:
+        if episode.config:
+            raise ValueError(f'Config {episode.config_name} can not be run vectorized')
+        groups.setdefault((episode.scenario, episode.max_time), []).append(episode)
+
+    for (scenario, max_time), group in groups.items():
+        scenes = [SCENARIOS[scenario](episode.seed)[:2] for episode in group]
+        results = MultiWorldEngine.from_scenes(scenes).run(max_time)
+        for episode, result in zip(group, results):
+            yield EpisodeResult(episode, result)
+
+
+# Aggregates the results by scenario and config: success rate, time to the ball percentiles, crashes
+class BatchReport:
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        self.results = []
+        self.start_time = time.perf_counter()
+        self.wall_time = 0.0
+
+    def add(self, result: EpisodeResult):
+        self.results.append(result)
+        self.wall_time = time.perf_counter() - self.start_time
+
+    def _get_group_stats(self, results):
+        goal_times = [result.event_time for result in results if result.outcome == SimulationResult.Outcome.GOAL]
+        outcomes = [result.outcome for result in results]
+        stats = {
+            'episodes': len(results),
+            'success_rate': len(goal_times) / len(results),
+            'crashes': outcomes.count(SimulationResult.Outcome.CRASH),
+            'crash_events': sum(result.crashes_cnt for result in results),
+            'timeouts': outcomes.count(SimulationResult.Outcome.TIMEOUT),
+            'mean_episode_wall_time': sum(result.wall_time for result in results) / len(results),
+        }
+        for percentile in self.PERCENTILES:
+            stats[f'time_to_ball_p{percentile}'] = \
+                float(numpy.percentile(goal_times, percentile)) if goal_times else None
+        return stats
+
+    def get_summary(self):
+        groups = {}
+        for result in self.results:
+            groups.setdefault((result.scenario, result.config_name), []).append(result)
+        return {
+            'episodes': len(self.results),
+            'wall_time': self.wall_time,
+            'episodes_per_sec': len(self.results) / self.wall_time if self.wall_time else 0.0,
+            'groups': [{'scenario': scenario, 'config': config_name, **self._get_group_stats(results)}
+                       for (scenario, config_name), results in sorted(groups.items())],
+        }
+
+    def write(self, path):
+        with open(path, 'w') as file:
+            json.dump({'summary': self.get_summary(), 'episodes': [result.to_dict() for result in self.results]},
+                      file, indent=2)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Runs headless episodes in parallel and aggregates the results')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[42, 171, 228, 239, 322, 359, 777, 1337, 1703, 3228])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--max-time', type=float, default=60.0)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--vectorized', action='store_true',
+                        help='Run the episodes of a scenario as one array simulation in this process')
+    parser.add_argument('--output', default='batch_report.json')
+    args = parser.parse_args()
+
+    episodes = get_episodes(args.seeds, args.scenarios, {name: CONFIGS[name] for name in args.configs}, args.max_time)
+    report = BatchReport()
+    results = run_vectorized(episodes) if args.vectorized else run_batch(episodes, args.workers)
+    for result in results:
+        report.add(result)
+        print(f'[{len(report.results)}/{len(episodes)}] {result.scenario}, {result.config_name}, '
+              f'seed {result.seed}: {result.outcome} at {result.sim_time:.2f} sec')
+    report.write(args.output)
+
+    summary = report.get_summary()
+    print(f'{summary["episodes"]} episodes in {summary["wall_time"]:.2f} sec '
+          f'({summary["episodes_per_sec"]:.1f} per sec), report is written to {args.output}')
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,140 @@
+import numpy
+
+from models import MovingObstacle, Robot
+from spatial_index import UniformGrid
+
+
+# Robots closer than this to each other are crashed, same as in the end of tick check of @run_simulation
+CRASH_DIST = 0.001
+# Segments of the robot arcs checked as linear motions by @sweep_collisions
+SWEEP_SEGMENTS = 4
+# Broad phase by the grid is used for at least this number of robots, the rest are checked all pairwise
+GRID_MIN_ROBOTS = 64
+
+
+class CollisionEvent:
+    class Kind:
+        CRASH = 'crash'
+        BALL = 'ball'
+
+    def __init__(self, kind, robot, other, time, dist):
+        self.kind = kind
+        self.robot = robot  # index of the robot
+        self.other = other  # index of the other robot for a crash, -1 for the ball
+        self.time = time
+        self.dist = dist  # distance between the borders
+
+    def __eq__(self, other):
+        return isinstance(other, CollisionEvent) and \
+               (self.kind, self.robot, self.other, self.time) == (other.kind, other.robot, other.other, other.time)
+
+    def __repr__(self):
+        if self.kind == CollisionEvent.Kind.CRASH:
+            return f'Crash of robots {self.robot} and {self.other} at {self.time:.2f} sec'
+        return f'Robot {self.robot} touched the ball at {self.time:.2f} sec'
+
+
+# Distances between borders of all robot pairs (i, j), j < i. Pairs are found by the grid for large fleets,
+# otherwise all of them are taken. Only pairs closer than @max_dist are returned by the grid.
+def get_pair_distances(robot_positions, max_dist=CRASH_DIST, spatial_index: UniformGrid = None):
+    robot_positions = numpy.asarray(robot_positions, dtype=float).reshape(-1, 2)
+    robots_cnt = len(robot_positions)
+    if spatial_index is None and robots_cnt >= GRID_MIN_ROBOTS:
+        spatial_index = UniformGrid(2 * Robot.RADIUS + max_dist).update(robot_positions)
+    if spatial_index is not None:
+        robot_indices, other_indices = spatial_index.query_pairs(robot_positions,
+                                                                 MovingObstacle.RADIUS + Robot.RADIUS + max_dist)
+        is_before = other_indices < robot_indices
+        robot_indices, other_indices = robot_indices[is_before], other_indices[is_before]
+    else:
+        robot_indices, other_indices = numpy.tril_indices(robots_cnt, -1)
+
+    deltas = robot_positions[other_indices] - robot_positions[robot_indices]
+    dists = numpy.sqrt(deltas[:, 0] ** 2 + deltas[:, 1] ** 2) - MovingObstacle.RADIUS - Robot.RADIUS
+    return robot_indices, other_indices, dists
+
+
+# Distances between borders of the robots and the ball
+def get_ball_distances(robot_positions, ball_position):
+    robot_positions = numpy.asarray(robot_positions, dtype=float).reshape(-1, 2)
+    ball_x, ball_y = ball_position
+    return numpy.sqrt((robot_positions[:, 0] - ball_x) ** 2 + (robot_positions[:, 1] - ball_y) ** 2) - \
+        (MovingObstacle.RADIUS + Robot.RADIUS)
+
+
+# Crashes and ball touches at @sim_time sorted by the robot index, a crash goes before the ball touch
+# of the same robot. The first event is what the robot by robot check of @run_simulation stops on.
+def detect_collisions(robot_positions, ball_position, sim_time=0.0, spatial_index: UniformGrid = None):
+    robot_positions = numpy.asarray(robot_positions, dtype=float).reshape(-1, 2)
+    robot_indices, other_indices, dists = get_pair_distances(robot_positions, spatial_index=spatial_index)
+    is_crash = dists < CRASH_DIST
+    ball_dists = get_ball_distances(robot_positions, ball_position)
+    ball_touches = numpy.flatnonzero(ball_dists < 0)
+
+    events = [CollisionEvent(CollisionEvent.Kind.CRASH, robot, other, sim_time, dist) for robot, other, dist in
+              zip(robot_indices[is_crash].tolist(), other_indices[is_crash].tolist(), dists[is_crash].tolist())]
+    events += [CollisionEvent(CollisionEvent.Kind.BALL, robot, -1, sim_time, dist)
+               for robot, dist in zip(ball_touches.tolist(), ball_dists[ball_touches].tolist())]
+    events.sort(key=lambda event: (event.robot, event.kind != CollisionEvent.Kind.CRASH, event.other))
+    return events
+
+
+# Fractions of the step (K,) when the circles moving linearly from @starts_a, @starts_b to @ends_a, @ends_b
+# (K, 2) first come closer than @contact_dist between their centers, nan if they do not.
+# Circles which are already closer at the start have the contact at 0.
+def get_contact_fractions(starts_a, ends_a, starts_b, ends_b, contact_dist):
+    deltas = starts_b - starts_a
+    velocities = (ends_b - ends_a) - deltas
+    a = (velocities ** 2).sum(axis=-1)
+    b = 2 * (deltas * velocities).sum(axis=-1)
+    c = (deltas ** 2).sum(axis=-1) - contact_dist ** 2
+    discriminant = b ** 2 - 4 * a * c
+
+    fractions = numpy.full(len(deltas), numpy.nan)
+    is_approaching = (a > 0) & (discriminant >= 0)
+    fractions[is_approaching] = (-b[is_approaching] - numpy.sqrt(discriminant[is_approaching])) / \
+        (2 * a[is_approaching])
+    fractions[(fractions < 0) | (fractions > 1)] = numpy.nan
+    fractions[c < 0] = 0
+    return fractions
+
+
+# Continuous detection over one step of @dt from @start_time: @robot_paths are (S + 1, N, 2) positions of the
+# robots along the step (see @WorldState.get_robot_paths), the ball moves linearly from @ball_start to @ball_end.
+# Each segment of the paths is checked as a linear motion, events have the time of the first contact
+# and are sorted by it, then the same way as by @detect_collisions.
+def sweep_collisions(robot_paths, ball_start, ball_end, start_time, dt, spatial_index: UniformGrid = None):
+    robot_paths = numpy.asarray(robot_paths, dtype=float)
+    segments, robots_cnt = len(robot_paths) - 1, robot_paths.shape[1]
+    crash_contact_dist = MovingObstacle.RADIUS + Robot.RADIUS + CRASH_DIST
+    ball_contact_dist = MovingObstacle.RADIUS + Robot.RADIUS
+
+    # candidate pairs are the ones which can meet while moving at most @max_shift from the start
+    max_shift = numpy.sqrt(((robot_paths - robot_paths[0]) ** 2).sum(axis=-1)).max(initial=0)
+    robot_indices, other_indices, _ = get_pair_distances(robot_paths[0], CRASH_DIST + 2 * max_shift, spatial_index)
+
+    crash_fractions = numpy.full(len(robot_indices), numpy.nan)
+    ball_fractions = numpy.full(robots_cnt, numpy.nan)
+    ball_start, ball_end = numpy.asarray(ball_start, dtype=float), numpy.asarray(ball_end, dtype=float)
+    for segment in range(segments):
+        starts, ends = robot_paths[segment], robot_paths[segment + 1]
+        offset = segment / segments
+        fractions = offset + get_contact_fractions(starts[robot_indices], ends[robot_indices],
+                                                   starts[other_indices], ends[other_indices],
+                                                   crash_contact_dist) / segments
+        crash_fractions = numpy.fmin(crash_fractions, fractions)
+
+        ball_starts = numpy.broadcast_to(ball_start + (ball_end - ball_start) * offset, starts.shape)
+        ball_ends = numpy.broadcast_to(ball_start + (ball_end - ball_start) * (segment + 1) / segments, ends.shape)
+        fractions = offset + get_contact_fractions(starts, ends, ball_starts, ball_ends, ball_contact_dist) / segments
+        ball_fractions = numpy.fmin(ball_fractions, fractions)
+
+    is_crash = ~numpy.isnan(crash_fractions)
+    ball_touches = numpy.flatnonzero(~numpy.isnan(ball_fractions))
+    events = [CollisionEvent(CollisionEvent.Kind.CRASH, robot, other, start_time + fraction * dt, CRASH_DIST)
+              for robot, other, fraction in zip(robot_indices[is_crash].tolist(), other_indices[is_crash].tolist(),
+                                                crash_fractions[is_crash].tolist())]
+    events += [CollisionEvent(CollisionEvent.Kind.BALL, robot, -1, start_time + fraction * dt, 0.0)
+               for robot, fraction in zip(ball_touches.tolist(), ball_fractions[ball_touches].tolist())]
+    events.sort(key=lambda event: (event.time, event.robot, event.kind != CollisionEvent.Kind.CRASH, event.other))
+    return events
@@ -42,18 +42,31 @@ class Color:
     PURPLE = (148, 0, 201)
 
 DRAWABLE_OBS_AVOIDANCE = True
+DRAWABLE_OBS_AVOIDANCE_ROBOT = None  # index of the only robot whose sectors are drawn, all robots if None
 
 k = 100  # pixels per metre for graphics
 
+# Video recording, see @AsyncVideoWriter
+VIDEO_PATH = 'project.avi'
+VIDEO_QUEUE_SIZE = 8  # frames waiting for the encoder
+VIDEO_BACKPRESSURE = 'block'  # 'block' waits for the encoder when the queue is full, 'drop' skips the frame
+VIDEO_FRAME_STEP = 1  # every k-th frame is recorded
+TRAJECTORY_PATH = None  # e.g. 'project.npz' to record the states of all ticks, see @TrajectoryRecorder
+
 # Game settings
 dt = 0.1
-SIMULATION_DELAY = 1000
+SIMULATION_DELAY = 1000  # wall ms per simulated second, 1000 is real time
+RENDER_FPS = 30  # frames are shown at this rate independent of the ticks, see @FixedStepClock
+MAX_TICKS_PER_FRAME = 5  # more ticks are not caught up with when the loop falls behind
+REPLANNING_DRIFT_CHECK_PERIOD = None  # every k-th tick the skipped replans are compared to fresh ones
 
 OBSTACLES_COUNT = 9
+ROBOTS_COUNT = 12
 OBSTACLE_VELOCITY_RANGE = 0.1
 ROBOT_MAX_VELOCITY = 1
 ROBOT_HUNT_DISTANCE = 0.75
 ROBOT_MAX_HUNT_VELOCITY = 1.25
+POS_HISTORY_LIMIT = 100  # positions kept for the robot trails
 
 # Fix random seed to reproduce results. Set None if no fixation is needed
 # RANDOM_SEED = 239
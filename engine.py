@@ -0,0 +1,293 @@
+import copy
+import random
+import time
+
+import numpy
+
+import collision
+import constants
+from collision import CollisionEvent, detect_collisions, sweep_collisions
+from constants import Color
+from integrator import AdaptiveIntegrator
+from models import Ball, MovingObstacle, Robot
+from obstacle_avoidance import PlannerContext, PlannerResult
+from scheduler import ReplanningScheduler
+from utils import cast_detector_coordinates, move_to_dot_batch
+from world import WorldState
+
+
+# Scene as the camera sees it: robots, obstacles and the ball without any debug drawing,
+# the trails are under all the robots
+def render_scene(robots: [Robot], ball: Ball, obstacles: [MovingObstacle]):
+    screen = numpy.full((constants.WINDOW_HEIGHT, constants.WINDOW_WIDTH, 3), Color.BLACK, dtype=numpy.uint8)
+
+    for robot in robots:
+        robot.draw_trail(screen)
+    for robot, wheel_coords in zip(robots, Robot.get_wheel_coords_many(robots)):
+        robot.draw_body(screen, wheel_coords)
+    for obstacle in obstacles:
+        obstacle.draw(screen)
+    ball.draw(screen)
+    return screen
+
+
+# Robots of one world are moved by one array operation, the others one by one
+def move_robots(robots: [Robot], velocities, dt):
+    world = robots[0].world if robots else None
+    if all(robot.world is world for robot in robots):
+        indices = numpy.array([robot.index for robot in robots], dtype=numpy.intp)
+        world.wheel_velocities[indices] = velocities
+        world.move_robots(dt, indices)
+        world.record_positions(indices)
+        return
+
+    for robot, (vl, vr) in zip(robots, velocities):
+        robot.set_velocity(float(vl), float(vr))
+        robot.move(dt)
+
+
+# Copy of a planner, scheduler or integrator with its own arrays and containers (and nested caches)
+def _copy_component(component):
+    if component is None:
+        return None
+    component = copy.copy(component)
+    for name, value in vars(component).items():
+        if isinstance(value, numpy.ndarray):
+            setattr(component, name, value.copy())
+        elif isinstance(value, (list, dict, set)):
+            setattr(component, name, copy.copy(value))
+        elif hasattr(value, '__dict__') and not isinstance(value, type):
+            setattr(component, name, _copy_component(value))
+    return component
+
+
+# State of a @SimulationEngine at a tick: copies of the rows of its worlds, of its planner, scheduler
+# and integrator and the global random state. Robot and obstacle objects are not copied.
+class EngineSnapshot:
+    def __init__(self, engine):
+        self.worlds = [(world, world.get_snapshot()) for world in engine.get_worlds()]
+        self.ticks = engine.ticks
+        self.ball_predicted_positions = list(engine.ball_predicted_positions)
+        self.barriers_predicted_positions = list(engine.barriers_predicted_positions)
+        self.robot_poses = list(engine._robot_poses) if engine._robot_poses is not None else None
+        self.planner_context = _copy_component(engine.planner_context)
+        self.scheduler = _copy_component(engine.scheduler)
+        self.integrator = _copy_component(engine.integrator)
+        self.random_state = random.getstate()
+
+
+# One tick of the simulation is detection -> obstacle avoidance -> move_to_dot -> integration -> collisions.
+# The engine does no drawing, windows or sleeps, @run_simulation and @run_headless drive it.
+# Obstacles are detected by @detector on the rendered scene if it is given, otherwise the true positions are used.
+# For @replanning_period, @continuous_collisions and @adaptive_tolerance see @run_simulation.
+# @recorder (see @TrajectoryRecorder) gets the state and the plan of every tick before the move.
+# The state can be saved by @snapshot and put back by @restore or run further in another engine by @fork.
+class SimulationEngine:
+    # options creating the component, it starts anew in a fork with any of them changed
+    COMPONENT_OPTIONS = {
+        'scheduler': ('replanning_period', 'replanning_events'),
+        'integrator': ('adaptive_tolerance',),
+    }
+
+    def __init__(self, robots: [Robot], ball: Ball, obstacles: [MovingObstacle] = (), dt=None, detector=None,
+                 replanning_period=None, replanning_events=True, continuous_collisions=False,
+                 adaptive_tolerance=None, recorder=None):
+        self.options = {'dt': dt, 'detector': detector, 'replanning_period': replanning_period,
+                        'replanning_events': replanning_events, 'continuous_collisions': continuous_collisions,
+                        'adaptive_tolerance': adaptive_tolerance}
+        if continuous_collisions and adaptive_tolerance is not None:
+            # the integrator finds the contacts by its substeps, the swept check would not be done
+            raise ValueError('continuous_collisions and adaptive_tolerance can not be used together')
+        self.robots = robots
+        self.ball = ball
+        self.obstacles = obstacles
+        self.dt = constants.dt if dt is None else dt
+        self.detector = detector
+        self.continuous_collisions = continuous_collisions
+        self.recorder = recorder
+
+        self.planner_context = PlannerContext(len(robots))
+        self.scheduler = None
+        if replanning_period is not None:
+            self.scheduler = ReplanningScheduler(len(robots), replanning_period, replanning_events,
+                                                 constants.REPLANNING_DRIFT_CHECK_PERIOD)
+        self.integrator = AdaptiveIntegrator(adaptive_tolerance) if adaptive_tolerance is not None else None
+
+        self.ticks = 0
+        self.ball_predicted_positions = []
+        self.barriers_predicted_positions = []
+        self._robot_poses = None
+
+    @property
+    def sim_time(self):
+        return self.ticks * self.dt
+
+    # Positions of the ball and the barriers, @screen_picture is the rendered scene for the detector
+    def detect(self, screen_picture=None):
+        if self.detector is None:
+            self.ball_predicted_positions = [self.ball.get_pos()]
+            self.barriers_predicted_positions = [barrier.get_pos() for barrier in self.robots]
+            return
+
+        if screen_picture is None:
+            screen_picture = render_scene(self.robots, self.ball, self.obstacles)
+        self.ball_predicted_positions, self.barriers_predicted_positions = self.detector.forward(
+            screen_picture, [(Color.RED, 1), (Color.LIGHTBLUE, 9)]
+        )
+        self.ball_predicted_positions = cast_detector_coordinates(self.ball_predicted_positions)
+        self.barriers_predicted_positions = cast_detector_coordinates(self.barriers_predicted_positions)
+
+    # Targets of all robots, they are planned at once and the other robots are obstacles for each of them
+    def plan(self):
+        self._robot_poses = [(*robot.get_pos(), robot.angle) for robot in self.robots]
+        if self.scheduler is not None:
+            return self.scheduler.get_targets(self.sim_time, self._robot_poses, self.ball_predicted_positions,
+                                              self.planner_context)
+        return self.planner_context.batch_obstacle_avoidance(self._robot_poses, self.ball_predicted_positions)
+
+    def get_planner_result(self, index) -> PlannerResult:
+        if self.scheduler is not None:
+            return self.scheduler.get_result(index)
+        return self.planner_context.get_result(index)
+
+    # Moves everything by one tick to @robot_targets, returns crashes and ball touches of the tick
+    def move(self, robot_targets):
+        robots, ball, dt = self.robots, self.ball, self.dt
+        start_time = self.sim_time
+        if self.recorder is not None:
+            self.recorder.record(self, robot_targets)
+        velocities = move_to_dot_batch(self._robot_poses, ball.get_pos(), robot_targets)
+        if self.integrator is not None:
+            for robot, (vl, vr) in zip(robots, velocities.tolist()):
+                robot.set_velocity(vl, vr)
+            events = self.integrator.advance(robots, ball, dt, start_time)
+            self.ticks += 1
+            return events
+
+        if self.continuous_collisions:
+            robot_paths = WorldState.get_paths(numpy.array(self._robot_poses), velocities, dt,
+                                               collision.SWEEP_SEGMENTS)
+            ball_start = ball.get_pos()
+        move_robots(robots, velocities, dt)
+        ball.move(dt)
+
+        # for player in obstacles:
+        #     player.move(dt)
+
+        self.ticks += 1
+        if self.continuous_collisions:
+            return sweep_collisions(robot_paths, ball_start, ball.get_pos(), start_time, dt)
+        return detect_collisions([robot.get_pos() for robot in robots], ball.get_pos(), self.sim_time)
+
+    def step(self):
+        self.detect()
+        return self.move(self.plan())
+
+    # Worlds of the robots, the obstacles and the ball
+    def get_worlds(self) -> [WorldState]:
+        worlds = []
+        for drawable in (*self.robots, *self.obstacles, self.ball):
+            if all(drawable.world is not world for world in worlds):
+                worlds.append(drawable.world)
+        return worlds
+
+    def snapshot(self) -> EngineSnapshot:
+        return EngineSnapshot(self)
+
+    # Puts the engine back to the @snapshot taken from it, the snapshot can be restored again.
+    # The recorder drops the ticks after it.
+    def restore(self, snapshot: EngineSnapshot):
+        for world, world_snapshot in snapshot.worlds:
+            world.restore(world_snapshot)
+        self._restore_state(snapshot)
+        self.planner_context = _copy_component(snapshot.planner_context)
+        self.scheduler = _copy_component(snapshot.scheduler)
+        self.integrator = _copy_component(snapshot.integrator)
+        random.setstate(snapshot.random_state)
+        if self.recorder is not None:
+            self.recorder.truncate(self.ticks)
+
+    def _restore_state(self, snapshot: EngineSnapshot):
+        self.ticks = snapshot.ticks
+        self.ball_predicted_positions = list(snapshot.ball_predicted_positions)
+        self.barriers_predicted_positions = list(snapshot.barriers_predicted_positions)
+        self._robot_poses = list(snapshot.robot_poses) if snapshot.robot_poses is not None else None
+
+    # New engine going on from the @snapshot (the current state by default) on copies of the worlds, with
+    # the @options of this engine changed by the given ones and @planner_context if it is given.
+    # The scheduler and the integrator start anew if their options are changed, nothing is recorded.
+    def fork(self, snapshot: EngineSnapshot = None, planner_context: PlannerContext = None, **options):
+        snapshot = snapshot if snapshot is not None else self.snapshot()
+        worlds = {}
+        for world, world_snapshot in snapshot.worlds:
+            worlds[id(world)] = world.copy()
+            worlds[id(world)].restore(world_snapshot)
+        robots = [worlds[id(robot.world)].robots[robot.index] for robot in self.robots]
+        obstacles = [worlds[id(obstacle.world)].obstacles[obstacle.index] for obstacle in self.obstacles]
+        ball = worlds[id(self.ball.world)].obstacles[self.ball.index]
+
+        engine = SimulationEngine(robots, ball, obstacles, **{**self.options, **options})
+        engine._restore_state(snapshot)
+        engine.planner_context = planner_context if planner_context is not None else \
+            _copy_component(snapshot.planner_context)
+        for name, names in self.COMPONENT_OPTIONS.items():
+            if not any(option in options for option in names):
+                setattr(engine, name, _copy_component(getattr(snapshot, name)))
+        return engine
+
+    def get_reports(self):
+        reports = []
+        if self.scheduler is not None:
+            reports.append(self.scheduler.get_report(self.sim_time))
+        if self.integrator is not None:
+            reports.append(self.integrator.get_report())
+        return reports
+
+
+class SimulationResult:
+    class Outcome:
+        GOAL = 'goal'
+        CRASH = 'crash'
+        TIMEOUT = 'timeout'
+        STOPPED = 'stopped'  # by the stop condition without crashes or ball touches
+
+    def __init__(self, outcome, sim_time, ticks, wall_time, events):
+        self.outcome = outcome
+        self.sim_time = sim_time
+        self.ticks = ticks
+        self.wall_time = wall_time
+        self.events = events
+
+    def __repr__(self):
+        return f'{self.outcome} at {self.sim_time:.2f} sec after {self.ticks} ticks ({self.wall_time:.3f} sec)'
+
+
+# Runs the simulation without any window, video or sleeps until @max_time of simulated time passes or
+# @stop_condition(events) of a tick is true (by default any crash or ball touch). The outcome is decided by
+# the first event as in @run_simulation. @engine_options are the ones of @SimulationEngine.
+# The recorder of the options gets the final state as the last row and is closed.
+def run_headless(robots: [Robot], ball: Ball, obstacles: [MovingObstacle] = (), max_time=60.0,
+                 stop_condition=None, **engine_options) -> SimulationResult:
+    start_time = time.perf_counter()
+    engine = SimulationEngine(robots, ball, obstacles, **engine_options)
+    stop_condition = bool if stop_condition is None else stop_condition
+
+    events = []
+    is_stopped = False
+    while not is_stopped and engine.sim_time < max_time - 1e-9:
+        events = engine.step()
+        is_stopped = stop_condition(events)
+
+    if engine.recorder is not None:
+        engine.recorder.record(engine)
+        engine.recorder.close()
+
+    if not is_stopped:
+        outcome = SimulationResult.Outcome.TIMEOUT
+    elif not events:
+        outcome = SimulationResult.Outcome.STOPPED
+    elif events[0].kind == CollisionEvent.Kind.CRASH:
+        outcome = SimulationResult.Outcome.CRASH
+    else:
+        outcome = SimulationResult.Outcome.GOAL
+    return SimulationResult(outcome, engine.sim_time, engine.ticks, time.perf_counter() - start_time, events)
@@ -0,0 +1,95 @@
+import math
+
+import numpy
+
+import constants
+from collision import CRASH_DIST, detect_collisions, get_ball_distances, get_pair_distances
+from models import Ball, Robot
+
+
+# Advances the robots and the ball by a tick in substeps of adaptive size (conservative advancement):
+# a substep is as long as nothing can come closer than @tolerance past a contact, i.e. the clearance
+# between robots, to the ball and of the ball to the walls plus @tolerance divided by the fastest closing
+# speed. Far from everything a tick is one step, near contacts the steps get down to @min_step. Each substep is
+# sized anew, so the steps grow back after a near miss, but never past the end of the tick: the ticks are kept.
+# Robots with constant wheel velocities move along the same arcs whatever the steps are, the ball bounces
+# off the walls at the substep resolution.
+class AdaptiveIntegrator:
+    def __init__(self, tolerance=0.01, min_step=1e-3):
+        self.tolerance = tolerance
+        self.min_step = min_step
+
+        self.ticks_cnt = 0
+        self.steps_cnt = 0
+        self.min_step_taken = math.inf
+
+    # The longest step up to @max_step from the current state with which the contacts are resolved with @tolerance
+    def get_step(self, robot_positions, robot_speeds, ball_position, ball_velocity, max_step):
+        robot_speed = robot_speeds.max(initial=0)
+        ball_speed = math.hypot(*ball_velocity)
+
+        clearances_speeds = []
+        if len(robot_positions) > 1:
+            # only the pairs which can close during @max_step can shorten it
+            _, _, dists = get_pair_distances(robot_positions, CRASH_DIST + 2 * robot_speed * max_step)
+            if len(dists):
+                clearances_speeds.append((dists.min() - CRASH_DIST, 2 * robot_speed))
+        if len(robot_positions):
+            clearances_speeds.append((get_ball_distances(robot_positions, ball_position).min(),
+                                      robot_speed + ball_speed))
+        # distances to the walls the ball moves to, it bounces when it is beyond them
+        x_min, y_min, x_max, y_max = constants.WINDOW_CORNERS
+        for position, velocity, low, high in zip(ball_position, ball_velocity, (x_min, y_min), (x_max, y_max)):
+            wall_dist = high - Ball.RADIUS - position if velocity > 0 else position - low - Ball.RADIUS
+            clearances_speeds.append((max(wall_dist, 0), abs(velocity)))
+
+        step = math.inf
+        for clearance, speed in clearances_speeds:
+            if speed > 0:
+                step = min(step, (max(clearance, 0) + self.tolerance) / speed)
+        return max(min(step, max_step), self.min_step)
+
+    # Moves @robots (with the wheel velocities set) and @ball by @dt from @sim_time.
+    # Stops at the end of the first substep with crashes or ball touches and returns them,
+    # the positions of the robots are recorded once per tick.
+    def advance(self, robots: [Robot], ball: Ball, dt, sim_time=0.0):
+        # robots of one world are moved by one array operation, the others one by one as @move_robots does
+        world = robots[0].world if robots else None
+        if all(robot.world is world for robot in robots):
+            groups = [(world, numpy.array([robot.index for robot in robots], dtype=numpy.intp))] if robots else []
+        else:
+            groups = [(robot.world, numpy.array([robot.index])) for robot in robots]
+
+        def get_robot_positions():
+            return numpy.concatenate([world.robot_poses[indices, :2] for world, indices in groups] or
+                                     [numpy.zeros((0, 2))])
+
+        velocities = numpy.concatenate([world.wheel_velocities[indices] for world, indices in groups] or
+                                       [numpy.zeros((0, 2))])
+        robot_speeds = numpy.abs(velocities).max(axis=-1, initial=0)
+
+        self.ticks_cnt += 1
+        events = []
+        elapsed = 0.0
+        while dt - elapsed > 1e-12 and not events:
+            ball_velocity = ball.world.obstacle_velocities[ball.index].tolist()
+            step = self.get_step(get_robot_positions(), robot_speeds, ball.get_pos(), ball_velocity, dt - elapsed)
+            # no tiny step is left at the end of the tick
+            step = dt - elapsed if dt - elapsed - step < self.min_step else step
+
+            for world, indices in groups:
+                world.move_robots(step, indices)
+            ball.move(step)
+            elapsed += step
+            self.steps_cnt += 1
+            self.min_step_taken = min(self.min_step_taken, step)
+            events = detect_collisions(get_robot_positions(), ball.get_pos(), sim_time + elapsed)
+
+        for world, indices in groups:
+            world.record_positions(indices)
+        return events
+
+    def get_report(self):
+        steps_per_tick = self.steps_cnt / self.ticks_cnt if self.ticks_cnt else 0
+        return f'Integrator: {self.steps_cnt} steps in {self.ticks_cnt} ticks ({steps_per_tick:.2f} per tick), ' \
+               f'min step {self.min_step_taken:.4f} sec, tolerance {self.tolerance} m'
@@ -2,8 +2,6 @@
 # https://www.youtube.com/watch?v=Mdg9ElewwA0&feature=emb_logo
 
 import cv2
-import copy
-import numpy
 import time
 
 from typing import List, Tuple
@@ -11,10 +9,16 @@ from typing import List, Tuple
 import random
 import constants
 from constants import Color
+from collision import CollisionEvent
+from engine import SimulationEngine
 from models import Robot, MovingObstacle, Ball
-from obstacle_avoidance import dump_obstacle_avoidance, drawable_dump_obstacle_avoidance
+from obstacle_avoidance import dump_obstacle_avoidance, drawable_dump_obstacle_avoidance, draw_planner_results
 from obstacle_detection.mser import MSERObstacleDetector
-from utils import cast_detector_coordinates, move_to_dot
+from realtime import FixedStepClock
+from renderer import LayeredRenderer
+from trajectory import TrajectoryRecorder
+from video_writer import AsyncVideoWriter
+from world import WorldState
 
 drawable_obstacle_avoidance = drawable_dump_obstacle_avoidance
 obstacle_avoidance = dump_obstacle_avoidance
@@ -25,29 +29,37 @@ def obstacle_avoidance_simple(ball_predicted_positions):
     return ball_predicted_positions[0]
 
 
-def _generate_obstacles(cnt=10):
+# With @seed the obstacles are the same as with this constants.RANDOM_SEED without touching the global random state
+def _generate_obstacles(cnt=10, seed=None):
     barriers = []
     for i in range(cnt):
-        if constants.RANDOM_SEED is not None:
-            random.seed(constants.RANDOM_SEED * (i + 1))
-        barrier = MovingObstacle.create_randomized()
+        if seed is not None:
+            barrier = MovingObstacle.create_randomized(seed=seed * (i + 1))
+        else:
+            if constants.RANDOM_SEED is not None:
+                random.seed(constants.RANDOM_SEED * (i + 1))
+            barrier = MovingObstacle.create_randomized()
         barriers.append(barrier)
     return barriers
 
 
-def _generate_robots(cnt=6):
+# Robots are views onto @world rows, a new world is created if it is not given
+def _generate_robots(cnt=12, world: WorldState = None):
+    world = world if world is not None else WorldState(cnt, 0)
     robots = []
     # for i in range(cnt):
     #     if constants.RANDOM_SEED is not None:
     #         random.seed(constants.RANDOM_SEED * (i + 1))
-    for i in range(12):
+    for i in range(cnt):
+        # 12 robots in a row along the bottom edge, next rows are placed above
+        row, col = divmod(i, 12)
+        x = constants.x_start_left + col - col / 3
+        y = constants.y_start_left + row * Robot.WIDTH * 2
         if i % 2 == 0:
-            robot = Robot(constants.x_start_left + i - i / 3, constants.y_start_left, constants.theta_start,
-                          Color.WHITE)
+            robot = Robot(x, y, constants.theta_start, Color.WHITE, world)
             robots.append(robot)
         else:
-            robot = Robot(constants.x_start_left + i - i / 3, constants.y_start_left, constants.theta_start,
-                          Color.YELLOW)
+            robot = Robot(x, y, constants.theta_start, Color.YELLOW, world)
             robots.append(robot)
 
     return robots
@@ -60,109 +72,131 @@ def _draw_edges(screen, predicted_coords: List[Tuple[float, float]], color: Tupl
         cv2.circle(screen, (x, y), MovingObstacle.SCREEN_RADIUS, color, 2)
 
 
-def _draw_scene(robots: List[Robot], ball: Ball, obstacles: List[MovingObstacle],
+# The scene for the detection is kept by @renderer between the ticks, the screen is its copy with the debug drawing
+def _draw_scene(renderer: LayeredRenderer, robots: List[Robot], ball: Ball, obstacles: List[MovingObstacle],
                 ball_predicted_positions, barriers_predicted_positions):
 
-    screen = numpy.full((constants.WINDOW_HEIGHT, constants.WINDOW_WIDTH, 3), Color.BLACK, dtype=numpy.uint8)
-
-    for robot in robots:
-        robot.draw(screen)
-    for obstacle in obstacles:
-        obstacle.draw(screen)
-    ball.draw(screen)
+    screen_picture = renderer.render(robots, ball, obstacles)
 
-    screen_picture = copy.deepcopy(screen)
+    screen = renderer.get_frame()
     _draw_edges(screen, ball_predicted_positions, Color.YELLOW)
     _draw_edges(screen, barriers_predicted_positions, Color.GREEN)
     return screen, screen_picture
 
 
-def run_simulation(robots, ball, obstacles, simulation_delay=10, enable_detection=False, drawable_obs_avoidance=False):
+# 's' key saves the state of the simulation, 'r' puts it back to the last saved one (also after the end),
+# returns whether it is put back
+def _handle_snapshot_keys(key, engine: SimulationEngine, snapshots):
+    if key == ord('s'):
+        snapshots.append(engine.snapshot())
+        print(f'State is saved at {engine.sim_time:.2f} sec')
+    elif key == ord('r') and snapshots:
+        engine.restore(snapshots[-1])
+        print(f'State is restored to {engine.sim_time:.2f} sec')
+        return True
+    return False
+
+
+# If @replanning_period is set, robots call obstacle avoidance with this period (and on events if
+# @replanning_events is set, see @ReplanningScheduler) instead of every tick.
+# With @continuous_collisions crashes and ball touches are found along the whole step with the time of the first
+# contact (see @sweep_collisions), not only at the positions after it.
+# With @adaptive_tolerance physics of each tick is done in adaptive substeps (see @AdaptiveIntegrator),
+# it can not be used together with @continuous_collisions. @dt is the tick, constants.dt by default.
+# With @drawable_obs_avoidance the sectors of all robots or only of the robot with index @drawable_robot are drawn.
+# With @record_path the states of all ticks are written there (see @TrajectoryRecorder) for the replay.
+# Ticks are paced by the wall time (see @FixedStepClock): a simulated second takes @simulation_delay ms
+# and frames are shown at constants.RENDER_FPS whatever the rate of the ticks is.
+def run_simulation(robots, ball, obstacles, simulation_delay=10, enable_detection=False, drawable_obs_avoidance=False,
+                   replanning_period=None, replanning_events=True, continuous_collisions=False,
+                   adaptive_tolerance=None, dt=None, drawable_robot=None, record_path=None):
     start_time = time.time()
-    frames = 0
-    dt = constants.dt
-    out = cv2.VideoWriter('project.avi', cv2.VideoWriter_fourcc(*'DIVX'), 15, (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT))
-    robot_targets = [(0, 0) for _ in enumerate(robots)]
-
-    ball_predicted_positions = []
-    barriers_predicted_positions = []
+    recorder = TrajectoryRecorder(record_path) if record_path is not None else None
+    engine = SimulationEngine(robots, ball, obstacles, dt, obstacle_detection if enable_detection else None,
+                              replanning_period, replanning_events, continuous_collisions, adaptive_tolerance,
+                              recorder)
+    dt = engine.dt
+    renderer = LayeredRenderer()
+    out = AsyncVideoWriter(constants.VIDEO_PATH, constants.RENDER_FPS,
+                           (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT), 'DIVX',
+                           constants.VIDEO_QUEUE_SIZE, constants.VIDEO_BACKPRESSURE, constants.VIDEO_FRAME_STEP)
+    # a tick used to be shown for dt * simulation_delay ms, so this is the same speed of the simulation
+    clock = FixedStepClock(dt, 1000 / simulation_delay, constants.RENDER_FPS, constants.MAX_TICKS_PER_FRAME)
 
     target_achieved = False
+    snapshots = []
+    planned_centers = []
+    events = []
 
     while True:
-        screen, screen_picture = _draw_scene(
-            robots, ball, obstacles, ball_predicted_positions, barriers_predicted_positions)
-
-        if enable_detection:
-            ball_predicted_positions, barriers_predicted_positions = obstacle_detection.forward(
-                screen_picture, [(Color.RED, 1), (Color.LIGHTBLUE, 9)]
-            )
-            ball_predicted_positions = cast_detector_coordinates(ball_predicted_positions)
-            barriers_predicted_positions = cast_detector_coordinates(barriers_predicted_positions)
-        else:
-            ball_predicted_positions = [ball.get_pos()]
-            barriers_predicted_positions = [barrier.get_pos() for barrier in robots]
-
-        # Planning
-        #
-        # Call obstacle avoidance algorithm and move to returned dot.
-        #
-        # At the moment it has the same call rate as simulation update rate:
-        # it is called each quantum of time as the simulation updates.
+        # Physics
         #
-        # If obstacle_avoidance() call rate will be different than simulation update rate
-        # then move_to_dot_again() should be called instead of obstacle_avoidance() and move_to_dot()
-        # in this 'while' cycle if time of caliing obstacle_avoidance() is not reached yet.
-
-        for index, robot in enumerate(robots):
-            obstacles = [i.get_pos() for i in robots if i != robot]
+        # Ticks of dt are done as many as the wall time passed since the last ones takes,
+        # independent of the rate of the frames.
+        for _ in range(clock.advance()):
+            # the scene is rendered for the detector only, the frame is rendered below when it is due
+            engine.detect(renderer.render(robots, ball, obstacles) if enable_detection else None)
+
+            # Planning
+            #
+            # Call obstacle avoidance algorithm and move to returned dot.
+            #
+            # Without scheduler it has the same call rate as simulation update rate:
+            # it is called each quantum of time as the simulation updates.
+            #
+            # With scheduler robots which are not replanned on this tick move to the dot
+            # they got last time (move_to_dot_again).
+            robot_targets = engine.plan()
+            # robot_targets = [obstacle_avoidance_simple(ball_predicted_positions) for _ in robots]
             if drawable_obs_avoidance:
-                target_x, target_y = drawable_obstacle_avoidance(
-                    screen, robot, ball_predicted_positions, obstacles)
-            else:
-                target_x, target_y = obstacle_avoidance(
-                    robot.get_pos(), robot.angle, ball_predicted_positions, obstacles)
-            # target_x, target_y = obstacle_avoidance_simple(ball_predicted_positions)
-            robot_targets[index] = (target_x, target_y)
-
-        for index, robot in enumerate(robots):
-            target_x, target_y = robot_targets[index]
-            vl, vr = move_to_dot(robot, ball, (target_x, target_y))
-            robot.set_velocity(vl, vr)
-            robot.move(dt)
-
-        ball.move(dt)
-
-        # for player in obstacles:
-        #     player.move(dt)
-
-        frames += 1
-        cur_time = time.time()
-        fps = frames // (cur_time - start_time)
-        screen = cv2.putText(screen, 'FPS: {}'.format(fps), (50, 50), cv2.FONT_HERSHEY_SIMPLEX,
-                            1, (255, 0, 0), 2, cv2.LINE_AA)
-        out.write(screen)
-        cv2.imshow('robot football',  cv2.cvtColor(screen, cv2.COLOR_BGR2RGB))
-
-        obstacles = []
-        for robot in robots:
-            dist_to_obstacle = robot.get_closest_dist_to_obstacle(obstacles)
-            obstacles.append(robot)
-            dist_to_target = robot.get_dist_to_target(ball)
-            if dist_to_obstacle < 0.001 or dist_to_target < MovingObstacle.RADIUS + Robot.RADIUS:
-                if dist_to_obstacle < 0.001:
-                    print('Crash!')
-                else:
-                    target_achieved = True
-                print(f'Result: {time.time() - start_time} sec')
-                while cv2.getWindowProperty('robot football', cv2.WND_PROP_VISIBLE) == 1:
-                    cv2.waitKey(int(dt * 10))
+                planned_centers = [robot.get_pos() for robot in robots]
+
+            # robots crashed into each other or touched the ball, the first event of the robots in order decides
+            events = engine.move(robot_targets)
+            clock.count_tick()
+            if events:
                 break
 
-        cv2.waitKey(int(dt * simulation_delay))
+        # Rendering, the last frame is always shown
+        if events or clock.is_frame_due():
+            screen, _ = _draw_scene(
+                renderer, robots, ball, obstacles, engine.ball_predicted_positions, engine.barriers_predicted_positions)
+            if drawable_obs_avoidance and planned_centers:
+                indices = range(len(robots)) if drawable_robot is None else [drawable_robot]
+                draw_planner_results(screen, [planned_centers[index] for index in indices],
+                                     [engine.get_planner_result(index) for index in indices])
+            screen = cv2.putText(screen, 'FPS: {:.1f} RTF: {:.2f}'.format(clock.fps, clock.real_time_factor),
+                                 (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2, cv2.LINE_AA)
+            out.write(screen)
+            cv2.imshow('robot football',  cv2.cvtColor(screen, cv2.COLOR_BGR2RGB))
+
+        if events:
+            # the result is the last event, a restored snapshot goes on without one
+            target_achieved = events[0].kind != CollisionEvent.Kind.CRASH
+            if not target_achieved:
+                print('Crash!')
+            for event in events:
+                print(event)
+            print(f'Result: {time.time() - start_time} sec')
+            for report in engine.get_reports() + [renderer.get_report(), out.get_report(), clock.get_report()]:
+                print(report)
+            while cv2.getWindowProperty('robot football', cv2.WND_PROP_VISIBLE) == 1:
+                if _handle_snapshot_keys(cv2.waitKey(int(dt * 10)), engine, snapshots):
+                    events = []
+                    target_achieved = False
+                    clock.reset()
+                    break
+
+        # waits for the next tick or frame, at least 1 ms as 0 waits for a key forever
+        if _handle_snapshot_keys(cv2.waitKey(max(int(clock.get_wait() * 1000), 1)), engine, snapshots):
+            target_achieved = False
+            clock.reset()
         if cv2.getWindowProperty('robot football', cv2.WND_PROP_VISIBLE) < 1:
             break
-    out.release()
+    out.close()
+    if recorder is not None:
+        recorder.record(engine)
+        recorder.close()
     cv2.destroyAllWindows()
     return target_achieved
 
@@ -170,10 +204,13 @@ def run_simulation(robots, ball, obstacles, simulation_delay=10, enable_detectio
 def _main():
     ball = Ball.create_randomized()
     obstacles = []  # _generate_obstacles(cnt=constants.OBSTACLES_COUNT)
-    robots = _generate_robots()
+    robots = _generate_robots(cnt=constants.ROBOTS_COUNT)
     run_simulation(robots, ball, obstacles,
+                   simulation_delay=constants.SIMULATION_DELAY,
                    enable_detection=False,
-                   drawable_obs_avoidance=constants.DRAWABLE_OBS_AVOIDANCE)
+                   drawable_obs_avoidance=constants.DRAWABLE_OBS_AVOIDANCE,
+                   drawable_robot=constants.DRAWABLE_OBS_AVOIDANCE_ROBOT,
+                   record_path=constants.TRAJECTORY_PATH)
 
 
 if __name__ == '__main__':
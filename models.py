@@ -3,12 +3,16 @@ import logging
 import random
 
 import cv2
+import numpy
 
 import constants
 from constants import Color
+from world import WorldState
 
 
 class Drawable:
+    __slots__ = ('_x', '_y')
+
     def __init__(self, x, y):
         self._x = x
         self._y = y
@@ -33,45 +37,79 @@ class Drawable:
         return int(constants.WINDOW_WIDTH / 2 + constants.k * coords[0]), \
                int(constants.WINDOW_HEIGHT / 2 - constants.k * coords[1])
 
+    # @get_coords_on_screen for (K, 2) array of coordinates, returns list of tuples
+    @staticmethod
+    def get_coords_on_screen_many(coords):
+        coords = numpy.asarray(coords, dtype=float).reshape(-1, 2)
+        screen_x = (constants.WINDOW_WIDTH / 2 + constants.k * coords[:, 0]).astype(int)
+        screen_y = (constants.WINDOW_HEIGHT / 2 - constants.k * coords[:, 1]).astype(int)
+        return list(zip(screen_x.tolist(), screen_y.tolist()))
+
     def draw(self, screen):
         pass
 
 
+# View onto a row of @WorldState obstacles, a private world is created if no @world is given
 class MovingObstacle(Drawable):
+    __slots__ = ('world', 'index')
+
     RADIUS = constants.UNITS_RADIUS
     VELOCITY_RANGE = constants.OBSTACLE_VELOCITY_RANGE
 
     SCREEN_RADIUS = int(RADIUS * constants.k)
+    SCREEN_EXTENT = SCREEN_RADIUS + 1  # half of the side of the square which the drawing fits in
     COLOR = Color.LIGHTBLUE
 
-    def __init__(self, x, y, vx, vy):
-        super().__init__(x, y)
+    def __init__(self, x, y, vx, vy, world: WorldState = None):
+        self.world = world if world is not None else WorldState(0, 1)
+        self.index = self.world.add_obstacle(x, y, vx, vy, self)
+
+    @property
+    def x(self):
+        return float(self.world.obstacle_positions[self.index, 0])
 
-        self._vx = vx
-        self._vy = vy
+    @property
+    def y(self):
+        return float(self.world.obstacle_positions[self.index, 1])
+
+    def set_pos(self, x, y):
+        self.world.obstacle_positions[self.index] = x, y
+
+    def get_pos(self):
+        x, y = self.world.obstacle_positions[self.index].tolist()
+        return x, y
 
+    # @rng is a random.Random to draw from instead of the global random state, with @seed a new one is made
     @classmethod
-    def create_randomized(cls):
-        x = random.uniform(constants.WINDOW_CORNERS[0] + cls.RADIUS * 2,
-                           constants.WINDOW_CORNERS[2] - cls.RADIUS * 2)
-        y = random.uniform(constants.WINDOW_CORNERS[1] + cls.RADIUS * 2,
-                           constants.WINDOW_CORNERS[3] - cls.RADIUS * 2)
-        vx = random.gauss(0.0, cls.VELOCITY_RANGE)
-        vy = random.gauss(0.0, cls.VELOCITY_RANGE)
-
-        result = MovingObstacle(x, y, vx, vy)
+    def create_randomized(cls, world: WorldState = None, seed=None, rng: random.Random = None):
+        if rng is None:
+            rng = random.Random(seed) if seed is not None else random
+        x = rng.uniform(constants.WINDOW_CORNERS[0] + cls.RADIUS * 2,
+                        constants.WINDOW_CORNERS[2] - cls.RADIUS * 2)
+        y = rng.uniform(constants.WINDOW_CORNERS[1] + cls.RADIUS * 2,
+                        constants.WINDOW_CORNERS[3] - cls.RADIUS * 2)
+        vx = rng.gauss(0.0, cls.VELOCITY_RANGE)
+        vy = rng.gauss(0.0, cls.VELOCITY_RANGE)
+
+        result = cls(x, y, vx, vy, world)
         return result
 
     def move(self, dt):
-        self._x += self._vx * dt
-        if self._x < constants.WINDOW_CORNERS[0] + MovingObstacle.RADIUS \
-                or self._x > constants.WINDOW_CORNERS[2] - MovingObstacle.RADIUS:
-            self._vx = -self._vx
+        x, y = self.get_pos()
+        vx, vy = self.world.obstacle_velocities[self.index].tolist()
 
-        self._y += self._vy * dt
-        if self._y < constants.WINDOW_CORNERS[1] + MovingObstacle.RADIUS or \
-                self._y > constants.WINDOW_CORNERS[3] - MovingObstacle.RADIUS:
-            self._vy = -self._vy
+        x += vx * dt
+        if x < constants.WINDOW_CORNERS[0] + MovingObstacle.RADIUS \
+                or x > constants.WINDOW_CORNERS[2] - MovingObstacle.RADIUS:
+            vx = -vx
+
+        y += vy * dt
+        if y < constants.WINDOW_CORNERS[1] + MovingObstacle.RADIUS or \
+                y > constants.WINDOW_CORNERS[3] - MovingObstacle.RADIUS:
+            vy = -vy
+
+        self.world.obstacle_positions[self.index] = x, y
+        self.world.obstacle_velocities[self.index] = vx, vy
 
     def draw(self, screen):
         pos = self.get_coords_on_screen(self.get_pos())
@@ -79,19 +117,28 @@ class MovingObstacle(Drawable):
 
 
 class Ball(MovingObstacle):
+    __slots__ = ()
+
     COLOR = Color.RED
 
+    # With @seed the ball is the same as with this constants.RANDOM_SEED but the global random state is not touched,
+    # @rng is a random.Random to draw from instead
     @classmethod
-    def create_randomized(cls):
-        assert constants.RANDOM_SEED != 0, "Value 0 for random seed is not allowed. If no seed needed, set None"
-        if constants.RANDOM_SEED is not None:
-            random.seed(constants.RANDOM_SEED)
-        x = constants.WINDOW_CORNERS[2]-4 + random.uniform(-1, 1)
-        y = constants.WINDOW_CORNERS[3]-2.5 + random.uniform(-2, 2)
-        vx = random.gauss(0.0, cls.VELOCITY_RANGE)
-        vy = random.gauss(0.0, cls.VELOCITY_RANGE)
-
-        result = Ball(x, y, vx, vy)
+    def create_randomized(cls, world: WorldState = None, seed=None, rng: random.Random = None):
+        if rng is None and seed is not None:
+            assert seed != 0, "Value 0 for random seed is not allowed"
+            rng = random.Random(seed)
+        elif rng is None:
+            assert constants.RANDOM_SEED != 0, "Value 0 for random seed is not allowed. If no seed needed, set None"
+            if constants.RANDOM_SEED is not None:
+                random.seed(constants.RANDOM_SEED)
+            rng = random
+        x = constants.WINDOW_CORNERS[2]-4 + rng.uniform(-1, 1)
+        y = constants.WINDOW_CORNERS[3]-2.5 + rng.uniform(-2, 2)
+        vx = rng.gauss(0.0, cls.VELOCITY_RANGE)
+        vy = rng.gauss(0.0, cls.VELOCITY_RANGE)
+
+        result = cls(x, y, vx, vy, world)
         return result
 
     def draw(self, screen):
@@ -100,6 +147,8 @@ class Ball(MovingObstacle):
 
 
 class Wheel(Drawable):
+    __slots__ = ('kind', 'robot')
+
     RADIUS = 0.04
 
     COLOR = Color.GREEN
@@ -109,99 +158,124 @@ class Wheel(Drawable):
         LEFT = 'left'
         RIGHT = 'right'
 
-    def __init__(self, x, y, kind, robot):
-        super().__init__(x, y)
-
-        self.velocity = 0
-
+    def __init__(self, kind, robot):
         self.kind = kind
         self.robot = robot
 
-        self.set_pos(x, y)  # setting new pos with offsets
+    @property
+    def side(self):
+        return int(self.kind == Wheel.Kind.RIGHT)
 
-    def _calc_x(self):
-        robot_x, _ = self.robot.get_pos()
-        offset = (self.robot.WIDTH / 2) * math.sin(self.robot.angle)
-        return robot_x - offset if self.kind == Wheel.Kind.LEFT else robot_x + offset
+    @property
+    def velocity(self):
+        return float(self.robot.world.wheel_velocities[self.robot.index, self.side])
 
-    def _calc_y(self):
-        _, robot_y = self.robot.get_pos()
-        offset = (self.robot.WIDTH / 2) * math.cos(self.robot.angle)
-        return robot_y + offset if self.kind == Wheel.Kind.LEFT else robot_y - offset
+    @velocity.setter
+    def velocity(self, velocity):
+        self.robot.world.wheel_velocities[self.robot.index, self.side] = velocity
 
-    def set_pos(self, x, y):
-        self._x = self._calc_x()
-        self._y = self._calc_y()
+    @property
+    def x(self):
+        return self.get_pos()[0]
+
+    @property
+    def y(self):
+        return self.get_pos()[1]
 
     def get_pos(self):
-        return self._calc_x(), self._calc_y()
+        x, y = self.robot.world.get_wheel_positions([self.robot.index])[0, self.side].tolist()
+        return x, y
 
-    def draw(self, screen):
-        pos = self.get_coords_on_screen(self.get_pos())
+    # @pos_on_screen is found from the position if it is not given
+    def draw(self, screen, pos_on_screen=None):
+        pos = self.get_coords_on_screen(self.get_pos()) if pos_on_screen is None else pos_on_screen
         cv2.circle(screen, pos, self.SCREEN_RADIUS, self.COLOR, thickness=2)
 
 
+# View onto a row of @WorldState robots, a private world is created if no @world is given
 class Robot(Drawable):
+    __slots__ = ('world', 'index', 'COLOR', 'wheels')
+
     RADIUS = constants.UNITS_RADIUS
     WIDTH = constants.UNITS_RADIUS * 2
 
-    POS_HISTORY_LIMIT = 100
+    POS_HISTORY_LIMIT = constants.POS_HISTORY_LIMIT
 
     SCREEN_WIDTH = int(WIDTH * constants.k)
     SCREEN_RADIUS = int(RADIUS * constants.k)
+    # the body with the wheels on it, with a pixel more for rounding of the wheel positions
+    SCREEN_EXTENT = SCREEN_RADIUS + Wheel.SCREEN_RADIUS + 3
     TRAIL_COLOR = Color.GRAY
     TRAIL_SCREEN_RADIUS = 3
     DIRECTION_COLOR = Color.GREEN
 
-    def __init__(self, x, y, angle, color):
-        super().__init__(x, y)
-
-        self._angle = angle
-        self.pos_history = []
+    def __init__(self, x, y, angle, color, world: WorldState = None):
+        self.world = world if world is not None else WorldState(1, 0)
+        self.index = self.world.add_robot(x, y, angle, self)
         self.COLOR = color
 
         self.wheels = (
-            Wheel(self._x, self._y, Wheel.Kind.LEFT, self),
-            Wheel(self._x, self._y, Wheel.Kind.RIGHT, self)
+            Wheel(Wheel.Kind.LEFT, self),
+            Wheel(Wheel.Kind.RIGHT, self)
         )
 
+    @property
+    def x(self):
+        return float(self.world.robot_poses[self.index, 0])
+
+    @property
+    def y(self):
+        return float(self.world.robot_poses[self.index, 1])
+
     @property
     def angle(self):
-        return self._angle
+        return float(self.world.robot_poses[self.index, 2])
+
+    def get_pos(self):
+        x, y = self.world.robot_poses[self.index, :2].tolist()
+        return x, y
+
+    def get_pose(self):
+        x, y, angle = self.world.robot_poses[self.index].tolist()
+        return x, y, angle
 
     def set_pos(self, x, y):
-        self._x = x
-        self._y = y
+        self.world.robot_poses[self.index, :2] = x, y
+        self.record_pos(x, y)
+
+    def record_pos(self, x, y):
+        self.world.history.append(self.index, x, y)
 
-        self.pos_history.append((x, y))
-        self.pos_history = self.pos_history[-Robot.POS_HISTORY_LIMIT:]
+    # Last positions from the oldest one, (size, 2) array
+    @property
+    def pos_history(self):
+        return self.world.history.get(self.index)
 
     def set_velocity(self, vel_left, vel_right):
-        self.wheels[0].velocity = vel_left
-        self.wheels[1].velocity = vel_right
+        self.world.wheel_velocities[self.index] = vel_left, vel_right
 
     def set_angle(self, new_angle):
-        self._angle = new_angle
+        self.world.robot_poses[self.index, 2] = new_angle
 
     def move(self, dt):
-        vel_left = self.wheels[0].velocity
-        vel_right = self.wheels[1].velocity
+        x, y, angle = self.get_pose()
+        vel_left, vel_right = self.world.wheel_velocities[self.index].tolist()
 
-        logging.info(f'Moving robot: origin=({self._x}, {self._y}, {self._angle}), vel=({vel_left}, {vel_right})')
+        logging.info(f'Moving robot: origin=({x}, {y}, {angle}), vel=({vel_left}, {vel_right})')
 
         if round(vel_left, 3) == round(vel_right, 3):  # Straight line motion
-            x_new = self._x + vel_left * dt * math.cos(self._angle)
-            y_new = self._y + vel_right * dt * math.sin(self._angle)
-            theta = self._angle
+            x_new = x + vel_left * dt * math.cos(angle)
+            y_new = y + vel_right * dt * math.sin(angle)
+            theta = angle
         elif round(vel_left, 3) == -round(vel_right, 3):  # Pure rotation motion
-            x_new, y_new = self.get_pos()
-            theta = self._angle + ((vel_right - vel_left) * dt / self.WIDTH)
+            x_new, y_new = x, y
+            theta = angle + ((vel_right - vel_left) * dt / self.WIDTH)
         else:  # Rotation and arc angle of general circular motion (Lecture 2)
             _r = self.WIDTH / 2.0 * (vel_right + vel_left) / (vel_right - vel_left)
             delta_theta = (vel_right - vel_left) * dt / self.WIDTH
-            x_new = self._x + _r * (math.sin(delta_theta + self._angle) - math.sin(self._angle))
-            y_new = self._y - _r * (math.cos(delta_theta + self._angle) - math.cos(self._angle))
-            theta = self._angle + delta_theta
+            x_new = x + _r * (math.sin(delta_theta + angle) - math.sin(angle))
+            y_new = y - _r * (math.cos(delta_theta + angle) - math.cos(angle))
+            theta = angle + delta_theta
 
         self.set_angle(theta)
         self.set_pos(x_new, y_new)
@@ -215,30 +289,48 @@ class Robot(Drawable):
 
         cv2.line(screen, start_on_screen, end_on_screen, self.DIRECTION_COLOR, thickness=1)
 
-    def _draw_wheels(self, screen):
-        for wheel in self.wheels:
-            wheel.draw(screen)
-
-    def draw(self, screen):
-        for pos in self.pos_history:
-            pos_on_screen = self.get_coords_on_screen(pos)
+    # (N, 2, 2) screen coordinates of the left and right wheels of @robots,
+    # found by one array operation for the robots of one world
+    @staticmethod
+    def get_wheel_coords_many(robots):
+        world = robots[0].world if robots else None
+        if all(robot.world is world for robot in robots):
+            positions = world.get_wheel_positions([robot.index for robot in robots]) if robots else []
+        else:
+            positions = numpy.concatenate([robot.world.get_wheel_positions([robot.index]) for robot in robots])
+        return numpy.reshape(Drawable.get_coords_on_screen_many(positions), (-1, 2, 2))
+
+    def _draw_wheels(self, screen, wheel_coords=None):
+        wheel_coords = self.get_wheel_coords_many([self])[0] if wheel_coords is None else wheel_coords
+        for wheel, pos_on_screen in zip(self.wheels, wheel_coords.tolist()):
+            wheel.draw(screen, tuple(pos_on_screen))
+
+    def draw_trail(self, screen):
+        for pos_on_screen in self.get_coords_on_screen_many(self.pos_history):
             cv2.circle(screen, pos_on_screen, self.TRAIL_SCREEN_RADIUS,
                        self.TRAIL_COLOR, thickness=-1)
 
-        self._draw_wheels(screen)
+    # The robot without the trail, @wheel_coords (2, 2) are from @get_wheel_coords_many if they are given
+    def draw_body(self, screen, wheel_coords=None):
+        self._draw_wheels(screen, wheel_coords)
 
-        pos = self.get_coords_on_screen((self._x, self._y))
+        pos = self.get_coords_on_screen(self.get_pos())
         cv2.circle(screen, pos, self.SCREEN_RADIUS, self.COLOR, thickness=3)
 
         self._draw_direction(screen)
 
+    def draw(self, screen):
+        self.draw_trail(screen)
+        self.draw_body(screen)
+
     def get_closest_dist_to_obstacle(self, obstacles):
+        x, y = self.get_pos()
         closest_dist = 100000.0
         for i, player in enumerate(obstacles):
             p_x, p_y = player.get_pos()
 
-            dx = p_x - self._x
-            dy = p_y - self._y
+            dx = p_x - x
+            dy = p_y - y
 
             d = math.sqrt(dx ** 2 + dy ** 2)
 
@@ -250,5 +342,6 @@ class Robot(Drawable):
         return closest_dist
 
     def get_dist_to_target(self, target):
+        x, y = self.get_pos()
         target_x, target_y = target.get_pos()
-        return math.sqrt((self._x - target_x) ** 2 + (self._y - target_y) ** 2)
+        return math.sqrt((x - target_x) ** 2 + (y - target_y) ** 2)
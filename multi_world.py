@@ -0,0 +1,149 @@
+import time
+
+import numpy
+
+import constants
+from collision import CRASH_DIST, detect_collisions
+from engine import SimulationResult
+from models import MovingObstacle, Robot
+from obstacle_avoidance import PlannerContext
+from utils import move_to_dot_batch
+from world import WorldState
+
+
+# Advances B independent worlds of N robots and a ball each by one array operation per tick stage:
+# @robot_poses are (B, N, 3), @ball_positions and @ball_velocities are (B, 2). A tick is the same as
+# @SimulationEngine.step without a detector (the true positions, the other robots of the world are the obstacles)
+# and the end of tick collision check, so a world goes exactly as its @run_headless episode. A world is done
+# on its first crash or ball touch and is not moved afterwards, the rest go on until all are done or time is out.
+class MultiWorldEngine:
+    class Outcome:
+        NONE = 0
+        GOAL = 1
+        CRASH = 2
+
+    def __init__(self, robot_poses, ball_positions, ball_velocities, dt=None):
+        self.robot_poses = numpy.array(robot_poses, dtype=float).reshape(len(ball_positions), -1, 3)
+        self.wheel_velocities = numpy.zeros(self.robot_poses.shape[:2] + (2,))
+        self.ball_positions = numpy.array(ball_positions, dtype=float).reshape(-1, 2)
+        self.ball_velocities = numpy.array(ball_velocities, dtype=float).reshape(-1, 2)
+        self.dt = constants.dt if dt is None else dt
+
+        worlds_cnt, robots_cnt = self.robot_poses.shape[:2]
+        self.done = numpy.zeros(worlds_cnt, dtype=bool)
+        self.outcomes = numpy.full(worlds_cnt, self.Outcome.NONE)
+        self.done_ticks = numpy.zeros(worlds_cnt, dtype=numpy.intp)
+        self.done_wall_times = numpy.zeros(worlds_cnt)
+        self.ticks = 0
+        self.planner_context = PlannerContext(worlds_cnt * robots_cnt)
+        self._start_time = time.perf_counter()
+
+    # Worlds of the @scenes, (robots, ball) pairs with the same number of robots
+    @classmethod
+    def from_scenes(cls, scenes, dt=None):
+        robot_poses = [[(*robot.get_pos(), robot.angle) for robot in robots] for robots, _ in scenes]
+        ball_positions = [ball.get_pos() for _, ball in scenes]
+        ball_velocities = [ball.world.obstacle_velocities[ball.index] for _, ball in scenes]
+        return cls(robot_poses, ball_positions, ball_velocities, dt)
+
+    @property
+    def worlds_cnt(self):
+        return len(self.robot_poses)
+
+    @property
+    def sim_time(self):
+        return self.ticks * self.dt
+
+    # Targets (K, N, 2) of the robots of the worlds with @indices, planned at once
+    def plan(self, indices):
+        worlds_cnt, robots_cnt = len(indices), self.robot_poses.shape[1]
+        robot_groups = numpy.repeat(numpy.arange(worlds_cnt), robots_cnt)
+        ball_positions = self.ball_positions[indices][robot_groups]
+        targets = self.planner_context.batch_obstacle_avoidance(
+            self.robot_poses[indices].reshape(-1, 3), None, robot_groups=robot_groups,
+            robot_ball_positions=ball_positions)
+        return targets.reshape(worlds_cnt, robots_cnt, 2)
+
+    # Same as @MovingObstacle.move for the balls of the worlds with @indices
+    def move_balls(self, indices):
+        positions = self.ball_positions[indices] + self.ball_velocities[indices] * self.dt
+        x_min, y_min, x_max, y_max = constants.WINDOW_CORNERS
+        is_out = (positions < (x_min + MovingObstacle.RADIUS, y_min + MovingObstacle.RADIUS)) | \
+                 (positions > (x_max - MovingObstacle.RADIUS, y_max - MovingObstacle.RADIUS))
+        self.ball_positions[indices] = positions
+        self.ball_velocities[indices] = numpy.where(is_out, -self.ball_velocities[indices],
+                                                    self.ball_velocities[indices])
+
+    # Outcomes (K,) of the worlds with @indices after the move, decided by the first event of @detect_collisions:
+    # the lowest robot with a crash with a robot before it or a ball touch
+    def get_outcomes(self, indices):
+        positions = self.robot_poses[indices, :, :2]
+        deltas = positions[:, None, :, :] - positions[:, :, None, :]
+        dists = numpy.sqrt(deltas[..., 0] ** 2 + deltas[..., 1] ** 2) - MovingObstacle.RADIUS - Robot.RADIUS
+        robots_cnt = positions.shape[1]
+        is_crash = ((dists < CRASH_DIST) & numpy.tri(robots_cnt, k=-1, dtype=bool)).any(axis=-1)
+
+        ball_deltas = positions - self.ball_positions[indices, None, :]
+        ball_dists = numpy.sqrt(ball_deltas[..., 0] ** 2 + ball_deltas[..., 1] ** 2) - \
+            (MovingObstacle.RADIUS + Robot.RADIUS)
+        is_event = is_crash | (ball_dists < 0)
+
+        first_robots = is_event.argmax(axis=-1)
+        outcomes = numpy.where(is_crash[numpy.arange(len(indices)), first_robots], self.Outcome.CRASH,
+                               self.Outcome.GOAL)
+        return numpy.where(is_event.any(axis=-1), outcomes, self.Outcome.NONE)
+
+    # One tick of all worlds which are not done, returns the indices of the worlds done by it
+    def step(self):
+        indices = numpy.flatnonzero(~self.done)
+        if not len(indices):
+            return indices
+        robots_cnt = self.robot_poses.shape[1]
+        poses = self.robot_poses[indices].reshape(-1, 3)
+        targets = self.plan(indices).reshape(-1, 2)
+        ball_positions = numpy.repeat(self.ball_positions[indices], robots_cnt, axis=0)
+
+        velocities = move_to_dot_batch(poses, ball_positions, targets)
+        self.wheel_velocities[indices] = velocities.reshape(len(indices), robots_cnt, 2)
+        self.robot_poses[indices] = WorldState.integrate(poses, velocities, self.dt).reshape(-1, robots_cnt, 3)
+        self.move_balls(indices)
+        self.ticks += 1
+
+        outcomes = self.get_outcomes(indices)
+        is_done = outcomes != self.Outcome.NONE
+        done_indices = indices[is_done]
+        self.done[done_indices] = True
+        self.outcomes[done_indices] = outcomes[is_done]
+        self.done_ticks[done_indices] = self.ticks
+        self.done_wall_times[done_indices] = time.perf_counter() - self._start_time
+        return done_indices
+
+    # Steps until all worlds are done or @max_time of simulated time passes
+    def run(self, max_time=60.0):
+        while not self.done.all() and self.sim_time < max_time - 1e-9:
+            self.step()
+        return self.get_results()
+
+    # @SimulationResult of each world, the ones which are not done are timed out at the current tick.
+    # The wall time is the one until the world is done and the events are found for the final positions only.
+    def get_results(self) -> [SimulationResult]:
+        wall_time = time.perf_counter() - self._start_time
+        results = []
+        for world in range(self.worlds_cnt):
+            if not self.done[world]:
+                results.append(SimulationResult(SimulationResult.Outcome.TIMEOUT, self.sim_time, self.ticks,
+                                                wall_time, []))
+                continue
+            ticks = int(self.done_ticks[world])
+            outcome = SimulationResult.Outcome.CRASH if self.outcomes[world] == self.Outcome.CRASH \
+                else SimulationResult.Outcome.GOAL
+            events = detect_collisions(self.robot_poses[world, :, :2], self.ball_positions[world].tolist(),
+                                       ticks * self.dt)
+            results.append(SimulationResult(outcome, ticks * self.dt, ticks, float(self.done_wall_times[world]),
+                                            events))
+        return results
+
+
+# @run_headless of many episodes at once, @scenes are (robots, ball) pairs with the same number of robots
+def run_many_headless(scenes, max_time=60.0, dt=None) -> [SimulationResult]:
+    return MultiWorldEngine.from_scenes(scenes, dt).run(max_time)
@@ -1,12 +1,16 @@
 import constants
 import math
 import logging
+import functools
+import collections
+import threading
 import cv2
 import numpy
 
 import utils
 from constants import Color
 from models import Drawable, MovingObstacle
+from spatial_index import UniformGrid
 
 logger = logging.getLogger('algo')
 
@@ -32,8 +36,10 @@ class Point:
         return f'({round(self.x, 2)}, {round(self.y, 2)})'
 
     def rotate(self, angle):
-        x_ = self.x * math.cos(Sector._radians(angle)) + self.y * math.sin(Sector._radians(angle))
-        y_ = -self.x * math.sin(Sector._radians(angle)) + self.y * math.cos(Sector._radians(angle))
+        rad = Sector._radians(angle)
+        cos, sin = math.cos(rad), math.sin(rad)
+        x_ = self.x * cos + self.y * sin
+        y_ = -self.x * sin + self.y * cos
         return Point(x_, y_)
 
 
@@ -96,17 +102,15 @@ class Sector:
     FIRST_SECTOR_ID = 1  # todo: is not used for setting up sectors
     LAST_SECTOR_ID = None
 
-    def __init__(self, id, deg):
+    def __init__(self, id, deg, deg_step=None):
         self.id = id
         self.start_deg = deg
-        self.end_deg = deg + Sector.DEG_STEP
+        self.end_deg = deg + (deg_step or Sector.DEG_STEP)
+        self.center_deg = (self.start_deg + self.end_deg) / 2
 
         self.lowest_line = self._get_line_by_deg(self.start_deg)
         self.highest_line = self._get_line_by_deg(self.end_deg)
-
-        self.is_empty = True
-        self.is_chosen = False
-        self.is_danger = False
+        self.middle_line = self._get_line_by_deg(self.center_deg)
 
         Sector.LAST_SECTOR_ID = self.id
 
@@ -134,17 +138,18 @@ class Sector:
     
     @staticmethod
     def get_diff(sector1, sector2):
-        sector1_deg = (sector1.start_deg + sector1.end_deg) / 2
-        sector2_deg = (sector2.start_deg + sector2.end_deg) / 2
-        
+        sector1_deg = sector1.center_deg
+        sector2_deg = sector2.center_deg
+
         diff = abs(sector1_deg - sector2_deg)
         if diff >= 180:
             diff = abs(sector1_deg - sector2_deg - 360)
         return diff
 
     @classmethod
-    def generate_sectors(cls):
-        return [Sector(i + 1, deg=(1 + cls.DEG_STEP * i) % 360) for i in range(cls.COUNT)]
+    def generate_sectors(cls, deg_step=None):
+        deg_step = deg_step or cls.DEG_STEP
+        return [Sector(i + 1, deg=(1 + deg_step * i) % 360, deg_step=deg_step) for i in range(360 // deg_step)]
 
     @staticmethod
     def _radians(deg):
@@ -161,45 +166,117 @@ class Sector:
         # logger.info(f'deg {deg}: ({a > 0}, {b > 0})')
         return Line(a, b, 0)
 
-    def draw(self, screen, center):
-        if self.is_empty and DRAWING_HIDE_EMPTY:
+    # sector state is owned by @PlannerResult, so the same sector can be drawn for several robots
+    def draw(self, screen, center, is_empty=True, is_chosen=False, is_danger=False):
+        if is_empty and DRAWING_HIDE_EMPTY:
             return
 
         color = Color.GRAY
-        if not self.is_empty:
+        if not is_empty:
             color = Color.RED
-        elif self.is_chosen:
+        elif is_chosen:
             color = Color.PURPLE
-        if self.is_danger:
+        if is_danger:
             color = Color.RED2
 
         if not DRAWING_MIDDLE_LANE:
             self.lowest_line.draw(screen, center, color)
             self.highest_line.draw(screen, center, color)
         else:
-            middle = self._get_line_by_deg((self.start_deg + self.end_deg) / 2)
-            middle.draw(screen, center, color)
+            self.middle_line.draw(screen, center, color)
 
     def __repr__(self):
         return f'#{self.id} {self.lowest_line} {self.highest_line}'
 
-class Valley:
-    def __init__(self,sectors):
-        self.sectors = sectors
-        self.width = VALLEY
-        self.target_sector = sectors[(self.width//2) + 1]
-    
-    def get_target_deg(self):
-        return (self.target_sector.end_deg + self.target_sector.start_deg) / 2
-    def get_median(self):
-        
-        return self.target_sector._get_line_by_deg((self.target_sector.start_deg + self.target_sector.end_deg) / 2)
+
+# Sector values used by the planner for one @Sector.DEG_STEP, computed once: borders, centers, direction vectors
+# of the lower border, the median and the upper border (as @Line.get_direction_vector), border lines (their (a, b)
+# are the normals) and angular differences (@Sector.get_diff) of all pairs
+class SectorGeometry:
+    def __init__(self, deg_step):
+        self.deg_step = deg_step
+        self.sectors = Sector.generate_sectors(deg_step)
+        self.count = len(self.sectors)
+
+        self.start_deg = numpy.array([sector.start_deg for sector in self.sectors], dtype=float)
+        self.end_deg = numpy.array([sector.end_deg for sector in self.sectors], dtype=float)
+        self.center_deg = numpy.array([sector.center_deg for sector in self.sectors])
+        self.directions = numpy.array([[line.get_direction_vector() for line in
+                                        (sector.lowest_line, sector.middle_line, sector.highest_line)]
+                                       for sector in self.sectors], dtype=float)
+        self.lines = numpy.array([(sector.lowest_line.a, sector.lowest_line.b,
+                                   sector.highest_line.a, sector.highest_line.b) for sector in self.sectors])
+
+        diffs = self.center_deg[:, None] - self.center_deg[None, :]
+        self.diffs = numpy.where(numpy.abs(diffs) >= 180, numpy.abs(diffs - 360), numpy.abs(diffs))
+
+        # median direction as @get_target_offsets uses it: |x / y| and signs of the coordinates
+        medians = self.directions[:, 1]
+        self.median_scales = numpy.abs(medians[:, 0] / medians[:, 1])
+        self.median_signs = numpy.where(medians > 0, 1, -1)
+
+        self._valley_targets = {}
+        self._rays = {}
+
+    # Target sector of the valley of @valley sectors starting at each sector: the valley sectors are taken
+    # in the order of their ids
+    def get_valley_targets(self, valley):
+        if valley not in self._valley_targets:
+            windows = numpy.sort((numpy.arange(self.count)[:, None] + numpy.arange(valley)) % self.count, axis=-1)
+            self._valley_targets[valley] = windows[:, min(valley // 2 + 1, valley - 1)]
+        return self._valley_targets[valley]
+
+    # Rays of the sectors as @Line.draw puts the dots on them: (S, L, 2, 2) offsets of the first and the last dot
+    # of the median (L = 1) or of the two border lines of each sector from the robot
+    def get_rays(self, points_cnt, middle_lane):
+        if (points_cnt, middle_lane) not in self._rays:
+            directions = self._normalize(self.directions[:, [1] if middle_lane else [0, 2]], 0.1)
+            steps = numpy.array([1, max(points_cnt - 1, 1)], dtype=float)
+            self._rays[points_cnt, middle_lane] = directions[:, :, None, :] * steps[:, None]
+        return self._rays[points_cnt, middle_lane]
+
+    # @utils.normalize_np_vector of (..., 2) @vectors: the longer coordinate is cut down to @max_val
+    @staticmethod
+    def _normalize(vectors, max_val):
+        abs_x, abs_y = numpy.abs(vectors[..., 0]), numpy.abs(vectors[..., 1])
+        is_x_longer = abs_x > abs_y
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            abs_x, abs_y = numpy.where(is_x_longer, max_val, max_val * (abs_x / abs_y)), \
+                numpy.where(is_x_longer, max_val * (abs_y / abs_x), max_val)
+        is_long = (numpy.abs(vectors) > max_val).any(axis=-1)
+        scaled = numpy.stack([abs_x, abs_y], axis=-1)
+        return numpy.where(is_long[..., None], scaled, numpy.abs(vectors)) * numpy.where(vectors > 0, 1, -1)
+
+    # Point at @MAX_DIST_TO_GO along the median of each sector with @indices
+    def get_target_offsets(self, indices, dist):
+        scales = self.median_scales[indices]
+        with numpy.errstate(divide='ignore'):
+            offsets = numpy.stack([numpy.where(scales < 1, dist * scales, dist),
+                                   numpy.where(scales < 1, dist, dist / scales)], axis=-1)
+        offsets *= self.median_signs[indices]
+        return offsets
+
+
+@functools.lru_cache(maxsize=None)
+def get_sector_geometry(deg_step) -> SectorGeometry:
+    return SectorGeometry(deg_step)
+
+
+# Changes the sector resolution of the planner, geometry is built once per @deg_step.
+# The resolution is process-global (module geometry and Sector.DEG_STEP/COUNT), it is read by all planner
+# contexts, so it must not be changed while any of them plans, e.g. in another thread.
+def set_sector_resolution(deg_step):
+    global _geometry, _sectors
+    _geometry = get_sector_geometry(deg_step)
+    _sectors = _geometry.sectors
+    Sector.DEG_STEP = deg_step
+    Sector.COUNT = _geometry.count
 
 
 # a-bd, where d is distance, d_max = @OBSTACLE_AWARE_DIST
 def get_histogram_value(robot: Point, obstacle: Square, sector: Sector, vx, vy):
     # 1 meter = 100 pixels, so iterate through points with @step
-    step = 0.04
+    step = HISTOGRAM_SAMPLE_STEP
     top_left = obstacle.left_top
     pixels = []
 
@@ -220,170 +297,567 @@ def get_histogram_value(robot: Point, obstacle: Square, sector: Sector, vx, vy):
             dist = pixel.get_dist_to_point(robot)
             dist = math.sqrt(2) * OBSTACLE_AWARE_DIST - dist
             res = res + dist
-            
+
     return res
 
 
-def dump_obstacle_avoidance(robot_position, robot_angle, ball_predicted_positions,
-                            obstacles_predicted_positions: [MovingObstacle]):
-    robot_x, robot_y = robot_position
-    rangle = robot_angle
-    ball_x, ball_y = ball_predicted_positions[0]
-    obstacles_positions = [(obstacle[0], obstacle[1], 1, 1) for obstacle in
-                           obstacles_predicted_positions]
-
-    hist = {}  # sector to prob
-
-    # maximal distance to obstacle    
-    robot_point = Point(0, 0)
-
-    sector_to_obstacles = {} # obstacle with vx,vy
-    obstacles = []
-    # obstacle_squares = []
-    for obstacle_num, obstacle_pos in enumerate(obstacles_positions):
-        obstacle_x, obstacle_y, vx, vy = obstacle_pos
-        obstacle_point = Point(obstacle_x, obstacle_y).rotate(rangle)
-        # need to tune sector around an obstacle
-        obstacle = Square(obstacle_point.x, obstacle_point.y, constants.UNITS_RADIUS * 2 + constants.UNITS_RADIUS,
-                          coord_center=Point(robot_x, robot_y).rotate(rangle))
-
-        curr_dist = obstacle.get_dist_to_point(robot_point)
-        if curr_dist > OBSTACLE_AWARE_DIST:
-            # logger.info(f'Skipping obstacle {1 + obstacle_num} {obstacle_pos}')
-            continue
-        obstacles.append(obstacle)
-
-    ball_point = Point(ball_x, ball_y, coord_center=Point(robot_x, robot_y)).rotate(rangle)
-    ball_sector = None
-    
-    # for each sector find closest obstacle
-    for sector in _sectors:
-        sector.is_empty = True
-        sector.is_chosen = False
-        sector.is_danger = False
+# Vectorized version of @get_histogram_value for all obstacles and sectors at once.
+# Footprints are sampled the same way (grid of @HISTOGRAM_SAMPLE_STEP starting from the rounded
+# top left corner), every sample gets its sector by one atan2 and the weights are summed with bincount.
+def get_footprint_samples(corners: numpy.ndarray, width):
+    samples_cnt = int(width * 100 / 4)
+    offsets = HISTOGRAM_SAMPLE_STEP * numpy.arange(samples_cnt)
 
-        min_dist = INF
+    shape = (len(corners), samples_cnt, samples_cnt)
+    xs = numpy.broadcast_to(corners[:, 0, None, None] + offsets[None, :, None], shape)
+    ys = numpy.broadcast_to(corners[:, 1, None, None] - offsets[None, None, :], shape)
+    return xs.reshape(len(corners), samples_cnt ** 2), ys.reshape(len(corners), samples_cnt ** 2)
 
-        hist_val = 0
-        sector_to_obstacles[sector.id] = 0
-        for obstacle in obstacles:
-            val = get_histogram_value(robot_point, obstacle, sector,1,1)
-            if val != 0:
-                sector_to_obstacles[sector.id] += 1
-            hist_val += val
-        if sector_to_obstacles[sector.id] != 0:
-            hist[sector.id] = hist_val / sector_to_obstacles[sector.id]
-        else:
-            hist[sector.id] = hist_val
 
-        # get dist
-        if sector.contains_point(ball_point):
-            ball_sector = sector
+# Index of the sector (0-based, same order as @_sectors) containing each point, -1 if none.
+# The sector is found by the polar angle and then checked with its lines exactly like @Sector.contains_point,
+# so points lying on the borders (e.g. on a diagonal) get the same sector as before.
+def get_sector_indices(xs, ys):
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
 
-    # logger.info(f'historgam {hist}')
+    offset = (numpy.degrees(numpy.arctan2(ys, xs)) - _geometry.start_deg[0]) % 360
+    indices = numpy.floor(offset / _geometry.deg_step).astype(numpy.intp) % Sector.COUNT
+
+    is_left_of_lowest, is_left_of_highest = _get_sector_lines_position(indices, xs, ys)
+    indices[~is_left_of_lowest] -= 1
+    indices[is_left_of_lowest & is_left_of_highest] += 1
+    indices %= Sector.COUNT
+
+    is_left_of_lowest, is_left_of_highest = _get_sector_lines_position(indices, xs, ys)
+    indices[~is_left_of_lowest | is_left_of_highest] = -1
+    return indices
+
+
+def _get_sector_lines_position(indices, xs, ys):
+    lines = _geometry.lines[indices]
+    return lines[..., 0] * xs + lines[..., 1] * ys < 0, lines[..., 2] * xs + lines[..., 3] * ys < 0
+
+
+def get_histogram(corners: numpy.ndarray, width):
+    return get_histograms(corners, numpy.zeros(len(corners), dtype=numpy.intp), 1, width)[0]
+
+
+# Histograms of several robots at once: @corners are rounded top left corners of the obstacle squares
+# in the frames of robots @robot_indices. @out and @obstacles_cnt are optional preallocated buffers.
+def get_histograms(corners: numpy.ndarray, robot_indices: numpy.ndarray, robots_cnt, width,
+                   out=None, obstacles_cnt=None):
+    hist = numpy.zeros((robots_cnt, Sector.COUNT)) if out is None else out[:robots_cnt]
+    hist.fill(0)
+    obstacles_cnt = numpy.zeros((robots_cnt, Sector.COUNT), dtype=numpy.intp) \
+        if obstacles_cnt is None else obstacles_cnt[:robots_cnt]
+    obstacles_cnt.fill(0)
+
+    values = get_obstacle_values(corners, width)
+    # ufunc.at adds obstacles one by one in their order
+    numpy.add.at(hist, robot_indices, values)
+
+    # average by the number of obstacles seen in the sector
+    numpy.add.at(obstacles_cnt, robot_indices, values != 0)
+    return numpy.divide(hist, obstacles_cnt, out=hist, where=obstacles_cnt != 0)
+
+
+# Values of @get_histogram_value for every obstacle square (by its rounded top left corner) and every sector
+def get_obstacle_values(corners: numpy.ndarray, width):
+    if len(corners) == 0:
+        return numpy.zeros((0, Sector.COUNT))
+
+    xs, ys = get_footprint_samples(corners, width)
+    sector_indices = get_sector_indices(xs, ys)
+    weights = math.sqrt(2) * OBSTACLE_AWARE_DIST - numpy.sqrt(xs ** 2 + ys ** 2)
+
+    # obstacle-major bins keep the summation order of @get_histogram_value
+    bins = numpy.arange(len(corners))[:, None] * Sector.COUNT + sector_indices
+    valid = sector_indices >= 0
+    values = numpy.bincount(bins[valid], weights=weights[valid], minlength=len(corners) * Sector.COUNT)
+    return values.reshape(len(corners), Sector.COUNT)
 
-    # smooth hist
-    smoothed_hist = {i : 0 for i in range(1,Sector.COUNT + 1)}
-    
-    h_list = list(hist.values())
-    for k in range(Sector.COUNT):
-        
-        hist_vals = [(h_list[(k - i) % Sector.COUNT],h_list[(k + i) % Sector.COUNT]) for i in range(6)]
-        i = 5
-        
-        for j in range(6):
-            if j != 0:
-                smoothed_hist[k + 1] += i * hist_vals[j][0]
-                smoothed_hist[k + 1] += i * hist_vals[j][1]
-            else:
-                smoothed_hist[k + 1] += i * hist_vals[j][0]
-            i = i - 1
-        smoothed_hist[k + 1] /= 11
-        if smoothed_hist[k+1] >= TRESHOLD:
-            _sectors[k].is_empty = False
-
-    if not ball_sector:
-        logger.error(f'Unable to identify ball {ball_point} position')
-        return robot_x, robot_y
-
-    valleys = []
-    danger_sectors = []
-    for k,v in smoothed_hist.items():
-        if v > DANGER:
-            _sectors[k-1].is_danger = True
-            danger_sectors.append(_sectors[k - 1])
-    
-    # logger.warning(f"smooth {smoothed_hist}")
-    # logger.info(f"maximum {max(hist.values())}")
-
-    for k in range(Sector.COUNT):
-        valley_sectors = [((k + i) % Sector.COUNT + 1, smoothed_hist[(k + i) % Sector.COUNT + 1]) for i in range(VALLEY)]
-        if all(map(lambda x : x[1] < TRESHOLD,valley_sectors)):
-            valley_sectors = list(map(lambda x : x[0], valley_sectors))
-            valleys.append(Valley([sector for sector in _sectors if sector.id in valley_sectors]))
-
-    # choose closest valley
-    target_sector = _sectors[0]
-    min_diff = INF
-    for valley in valleys:
-        diff = Sector.get_diff(valley.target_sector,ball_sector)
-        if danger_sectors != []:
-            if diff < min_diff and all(map(lambda x : Sector.get_diff(valley.target_sector,x) > DANGER_AWARE_ANGLE, danger_sectors)):
-                min_diff = diff
-                target_sector = valley.target_sector
-        elif diff < min_diff:
-            min_diff = diff
-            target_sector = valley.target_sector
-
-
-    if not target_sector:
-        return robot_x, robot_y
-
-    target_sector.is_chosen = True
-
-    target_line = target_sector._get_line_by_deg((target_sector.start_deg + target_sector.end_deg) / 2)
-    target_vec = target_line.get_direction_vector()
-
-    scale = abs(target_vec[0] / target_vec[1])
-    if scale < 1:
-        target_y = MAX_DIST_TO_GO
-        target_x = target_y * scale
-    else:
-        target_x = MAX_DIST_TO_GO
-        target_y = target_x / scale
 
-    target_x *= utils._get_sign(target_vec[0])
-    target_y *= utils._get_sign(target_vec[1])
+def get_obstacle_corners(obstacles: [Square]):
+    return numpy.array([(round(obstacle.left_top.x, 2), round(obstacle.left_top.y, 2))
+                        for obstacle in obstacles], dtype=float).reshape(-1, 2)
 
-    # logger.warning(f'Should go to ({target_x}, {target_y}) from {target_sector} according to {target_vec}')
-    return target_x + robot_x, target_y + robot_y
+
+# Obstacles and ball in the frames of all robots at once, computed the same way as with @Point and @Square.
+# @robot_indices and @obstacle_indices are the (robot, obstacle) pairs to check, sorted by robot, all pairs if not given.
+# Returns rounded top left corners of the obstacle squares closer than @OBSTACLE_AWARE_DIST with indices
+# of robots and obstacles they belong to and coordinates of the ball for each robot.
+def get_relative_scene(robot_poses: numpy.ndarray, ball_position, obstacles_positions: numpy.ndarray,
+                       robot_indices=None, obstacle_indices=None):
+    if robot_indices is None:
+        robot_indices, obstacle_indices = numpy.divmod(numpy.arange(len(robot_poses) * len(obstacles_positions)),
+                                                       len(obstacles_positions))
+    # one ball for all robots or (N, 2) array of them
+    ball_x, ball_y = numpy.asarray(ball_position, dtype=float).T
+
+    # @Point.rotate takes the angle in degrees
+    cos = numpy.array([math.cos(Sector._radians(angle)) for angle in robot_poses[:, 2]])
+    sin = numpy.array([math.sin(Sector._radians(angle)) for angle in robot_poses[:, 2]])
+
+    robot_x, robot_y = robot_poses[robot_indices, 0], robot_poses[robot_indices, 1]
+    obstacle_x, obstacle_y = obstacles_positions[obstacle_indices, 0], obstacles_positions[obstacle_indices, 1]
+    pair_cos, pair_sin = cos[robot_indices], sin[robot_indices]
+
+    center_x = obstacle_x * pair_cos + obstacle_y * pair_sin
+    center_y = -obstacle_x * pair_sin + obstacle_y * pair_cos
+    robot_center_x = robot_x * pair_cos + robot_y * pair_sin
+    robot_center_y = -robot_x * pair_sin + robot_y * pair_cos
+
+    half_width = OBSTACLE_SQUARE_WIDTH / 2
+    points_x = numpy.stack([center_x, center_x + half_width, center_x - half_width,
+                            center_x - half_width, center_x + half_width]) - robot_center_x
+    points_y = numpy.stack([center_y, center_y + half_width, center_y + half_width,
+                            center_y - half_width, center_y - half_width]) - robot_center_y
+
+    is_near = numpy.sqrt(points_x ** 2 + points_y ** 2).min(axis=0) <= OBSTACLE_AWARE_DIST
+    corners = numpy.array([round(coord, 2) for coord in
+                           numpy.stack([points_x[2][is_near], points_y[2][is_near]], axis=-1).ravel().tolist()])
+
+    ball_dx = ball_x - robot_poses[:, 0]
+    ball_dy = ball_y - robot_poses[:, 1]
+    ball_points = numpy.stack([ball_dx * cos + ball_dy * sin, -ball_dx * sin + ball_dy * cos], axis=-1)
+
+    return corners.reshape(-1, 2), robot_indices[is_near], obstacle_indices[is_near], ball_points
+
+
+# Obstacles which can be closer than @OBSTACLE_AWARE_DIST to the robot: the obstacle square is
+# checked by its points, so its center can be farther by the half of the diagonal
+def get_aware_radius():
+    return OBSTACLE_AWARE_DIST + OBSTACLE_SQUARE_WIDTH / math.sqrt(2) + 1e-6
+
+
+# All pairs (robot index, obstacle index) with the same group, sorted by the robot index and then
+# by the obstacle index
+def get_group_pairs(robot_groups, obstacle_groups):
+    robot_groups = numpy.asarray(robot_groups, dtype=numpy.intp)
+    obstacle_groups = numpy.asarray(obstacle_groups, dtype=numpy.intp)
+    groups_cnt = max(robot_groups.max(initial=-1), obstacle_groups.max(initial=-1)) + 1
+
+    order = numpy.argsort(obstacle_groups, kind='stable')
+    counts = numpy.bincount(obstacle_groups, minlength=groups_cnt)
+    starts = numpy.cumsum(counts) - counts
+
+    pair_counts = counts[robot_groups]
+    robot_indices = numpy.repeat(numpy.arange(len(robot_groups)), pair_counts)
+    range_starts = numpy.repeat(numpy.cumsum(pair_counts) - pair_counts, pair_counts)
+    slots = numpy.repeat(starts[robot_groups], pair_counts) + numpy.arange(pair_counts.sum()) - range_starts
+    return robot_indices, order[slots]
+
+
+def build_spatial_index(obstacles_positions) -> UniformGrid:
+    return UniformGrid(get_aware_radius()).update(obstacles_positions)
+
+
+# Circular convolution of the histograms (along the last axis) with @kernel, divided by @divider.
+# Taps are added from the center outwards, the left one first, as the former loop smoothing did.
+def smooth_histograms(hist, kernel=None, divider=None, out=None):
+    kernel = SMOOTHING_KERNEL if kernel is None else kernel
+    divider = SMOOTHING_DIVIDER if divider is None else divider
+    sectors_cnt = hist.shape[-1]
+    center = len(kernel) // 2
+
+    padded = numpy.take(hist, numpy.arange(-center, sectors_cnt + center), axis=-1, mode='wrap')
+    smoothed = numpy.empty_like(hist) if out is None else out
+    numpy.multiply(kernel[center], padded[..., center:center + sectors_cnt], out=smoothed)
+    for i in range(1, center + 1):
+        smoothed += kernel[center - i] * padded[..., center - i:center - i + sectors_cnt]
+        smoothed += kernel[center + i] * padded[..., center + i:center + i + sectors_cnt]
+    smoothed /= divider
+    return smoothed
+
+
+# Valley starting at sector k consists of @VALLEY sectors k, k + 1, ... (circularly) with smoothed values
+# below @TRESHOLD
+def get_valleys(smoothed_hist):
+    windows = numpy.arange(Sector.COUNT)[:, None] + numpy.arange(VALLEY)
+    return numpy.take(smoothed_hist < TRESHOLD, windows, axis=-1, mode='wrap').all(axis=-1)
+
+
+# Chooses the valley closest to the ball sector which is farther than @DANGER_AWARE_ANGLE from all
+# danger sectors, for all robots at once. Returns indices of the target sectors (the first sector if no valley fits).
+def choose_target_sectors(smoothed_hist, is_danger, ball_sector_indices):
+    valley_targets = _geometry.get_valley_targets(VALLEY)
+    target_diffs = _geometry.diffs[valley_targets]
+
+    too_close = (target_diffs <= DANGER_AWARE_ANGLE).astype(float)
+    is_safe = is_danger.astype(float) @ too_close.T == 0
+
+    ball_diffs = target_diffs[:, ball_sector_indices].T
+    ball_diffs = numpy.where(get_valleys(smoothed_hist) & is_safe, ball_diffs, INF)
+    # argmin takes the first of equally close valleys
+    chosen = numpy.argmin(ball_diffs, axis=-1)
+    has_valley = ball_diffs[numpy.arange(len(chosen)), chosen] < INF
+    return numpy.where(has_valley, valley_targets[chosen], 0)
+
+
+# Sector flags and target chosen for one robot, used for drawing
+class PlannerResult:
+    def __init__(self, target, is_empty, is_chosen, is_danger):
+        self.target = target
+        self.is_empty = is_empty
+        self.is_chosen = is_chosen
+        self.is_danger = is_danger
+
+    def draw(self, screen, center):
+        draw_planner_results(screen, [(center.x, center.y)], [self])
+
+
+# Sectors of the robots at (R, 2) @centers with their @results colored as by @Sector.draw, but the dots of each
+# ray are joined into a line and all rays of a color are drawn by one cv2.polylines call.
+# With @only_marked (@DRAWING_ONLY_MARKED by default) only the chosen and the danger sectors are drawn.
+def draw_planner_results(screen, centers, results: [PlannerResult], only_marked=None):
+    only_marked = DRAWING_ONLY_MARKED if only_marked is None else only_marked
+    if not results or DRAWING_MAX_LINE_POINTS < 2:
+        return
+    centers = numpy.asarray(centers, dtype=float).reshape(-1, 2)
+    is_empty = numpy.array([result.is_empty for result in results], dtype=bool)
+    is_chosen = numpy.array([result.is_chosen for result in results], dtype=bool)
+    is_danger = numpy.array([result.is_danger for result in results], dtype=bool)
+
+    # indices of the colors in @DRAWING_COLORS
+    color_indices = numpy.where(is_empty, numpy.where(is_chosen, 2, 0), 1)
+    color_indices[is_danger] = 3
+    is_drawn = ~is_empty if DRAWING_HIDE_EMPTY else numpy.ones_like(is_empty)
+    if only_marked:
+        is_drawn &= is_chosen | is_danger
+
+    robot_indices, sector_indices = numpy.nonzero(is_drawn)
+    points = centers[robot_indices, None, None, :] + _geometry.get_rays(DRAWING_MAX_LINE_POINTS,
+                                                                        DRAWING_MIDDLE_LANE)[sector_indices]
+    screen_points = numpy.stack([constants.WINDOW_WIDTH / 2 + constants.k * points[..., 0],
+                                 constants.WINDOW_HEIGHT / 2 - constants.k * points[..., 1]], axis=-1)
+    screen_points = screen_points.astype(numpy.int32)
+    ray_colors = color_indices[robot_indices, sector_indices]
+    for color_index, color in enumerate(DRAWING_COLORS):
+        is_color = ray_colors == color_index
+        if is_color.any():
+            cv2.polylines(screen, screen_points[is_color].reshape(-1, 2, 2), False, color,
+                          thickness=DRAWING_LINE_THICKNESS)
+
+
+# Incremental histograms: keeps the values of every (robot, obstacle) pair from the previous call and
+# recomputes only the pairs whose obstacle square moved (in the robot frame) by more than @tolerance.
+# The histogram sums are adjusted by the differences of the recomputed pairs and fully re-summed every
+# @refresh_period calls. Robots and obstacles have to keep their order between calls.
+# If @check is set, every call is compared with the full recompute and the largest difference is kept in @max_error.
+class HistogramCache:
+    def __init__(self, tolerance=0.0, refresh_period=100, check=False):
+        self.tolerance = tolerance
+        self.refresh_period = refresh_period
+        self.check = check
+
+        self.calls_cnt = 0
+        self.pairs_cnt = 0
+        self.recomputed_cnt = 0
+        self.max_error = 0.0
+
+        self._reset((0, 0))
+
+    def _reset(self, shape):
+        self._shape = shape
+        self._keys = numpy.zeros(0, dtype=numpy.intp)
+        self._corners = numpy.zeros((0, 2))
+        self._values = numpy.zeros((0, Sector.COUNT))
+        self._sums = numpy.zeros((shape[0], Sector.COUNT))
+        self._seen_cnt = numpy.zeros((shape[0], Sector.COUNT), dtype=numpy.intp)
+
+    @property
+    def skipped_cnt(self):
+        return self.pairs_cnt - self.recomputed_cnt
+
+    def get_histograms(self, corners, robot_indices, obstacle_indices, robots_cnt, obstacles_cnt, width, out=None):
+        shape = (robots_cnt, obstacles_cnt)
+        if shape != self._shape or self._values.shape[1] != Sector.COUNT:
+            self._reset(shape)
+        keys = robot_indices * obstacles_cnt + obstacle_indices
+
+        # pairs of the previous call: still seen and not moved, moved, gone
+        slots = numpy.minimum(numpy.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+        is_known = numpy.zeros(len(keys), dtype=bool) if len(self._keys) == 0 else self._keys[slots] == keys
+        is_kept = is_known.copy()
+        is_kept[is_known] = numpy.abs(corners[is_known] - self._corners[slots[is_known]]).max(axis=-1) <= self.tolerance
+        is_moved = is_known & ~is_kept
+        is_gone = ~numpy.isin(self._keys, keys)
+
+        values = numpy.empty((len(keys), Sector.COUNT))
+        values[is_kept] = self._values[slots[is_kept]]
+        values[~is_kept] = get_obstacle_values(corners[~is_kept], width)
+        # reused pairs keep the corners they were computed for, so slow motion is not lost
+        kept_corners = corners.copy()
+        kept_corners[is_kept] = self._corners[slots[is_kept]]
+
+        if self.refresh_period and self.calls_cnt % self.refresh_period == 0:
+            self._sums.fill(0)
+            self._seen_cnt.fill(0)
+            numpy.add.at(self._sums, robot_indices, values)
+            numpy.add.at(self._seen_cnt, robot_indices, values != 0)
+        else:
+            old_robot_indices = self._keys // max(obstacles_cnt, 1)
+            old_values = self._values[slots[is_moved]]
+            numpy.subtract.at(self._sums, old_robot_indices[is_gone], self._values[is_gone])
+            numpy.subtract.at(self._seen_cnt, old_robot_indices[is_gone], self._values[is_gone] != 0)
+            numpy.add.at(self._sums, robot_indices[is_moved], values[is_moved] - old_values)
+            numpy.add.at(self._seen_cnt, robot_indices[is_moved],
+                         (values[is_moved] != 0).astype(numpy.intp) - (old_values != 0))
+            is_new = ~is_known
+            numpy.add.at(self._sums, robot_indices[is_new], values[is_new])
+            numpy.add.at(self._seen_cnt, robot_indices[is_new], values[is_new] != 0)
+            # sectors without obstacles are exactly empty, whatever was left after the differences
+            self._sums[self._seen_cnt == 0] = 0
+
+        self._keys, self._corners, self._values = keys, kept_corners, values
+        self.calls_cnt += 1
+        self.pairs_cnt += len(keys)
+        self.recomputed_cnt += numpy.count_nonzero(~is_kept)
+
+        hist = numpy.zeros((robots_cnt, Sector.COUNT)) if out is None else out[:robots_cnt]
+        numpy.divide(self._sums, self._seen_cnt, out=hist, where=self._seen_cnt != 0)
+        hist[self._seen_cnt == 0] = 0
+        if self.check:
+            expected = get_histograms(corners, robot_indices, robots_cnt, width)
+            self.max_error = max(self.max_error, float(numpy.abs(hist - expected).max(initial=0)))
+        return hist
+
+
+# Bounded LRU of planner decisions. The key of a robot is its local configuration: bearings (@bearing_step degrees)
+# and ranges (@range_step) of the near obstacles relative to the robot, quantized and sorted, plus the ball sector.
+# Robots with a known key skip the histograms and reuse the chosen sector with its flags.
+class DecisionCache:
+    def __init__(self, capacity=4096, bearing_step=2.0, range_step=0.05):
+        self.capacity = capacity
+        self.bearing_step = bearing_step
+        self.range_step = range_step
+
+        self.hits_cnt = 0
+        self.misses_cnt = 0
+        self.evictions_cnt = 0
+
+        self._decisions = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._decisions)
+
+    @property
+    def hit_rate(self):
+        calls_cnt = self.hits_cnt + self.misses_cnt
+        return self.hits_cnt / calls_cnt if calls_cnt else 0.0
+
+    def clear(self):
+        self._decisions.clear()
+
+    # Keys of all robots, @corners are the relative obstacle corners of the pairs sorted by @robot_indices
+    def get_keys(self, corners, robot_indices, robots_cnt, ball_sector_indices):
+        half_width = OBSTACLE_SQUARE_WIDTH / 2
+        center_x, center_y = corners[:, 0] + half_width, corners[:, 1] - half_width
+        bearings = numpy.floor(numpy.degrees(numpy.arctan2(center_y, center_x)) / self.bearing_step)
+        ranges = numpy.floor(numpy.hypot(center_x, center_y) / self.range_step)
+
+        order = numpy.lexsort((ranges, bearings, robot_indices))
+        configurations = numpy.stack([bearings[order], ranges[order]], axis=-1).astype(numpy.int64)
+        ends = numpy.cumsum(numpy.bincount(robot_indices, minlength=robots_cnt))
+        starts = ends - numpy.bincount(robot_indices, minlength=robots_cnt)
+        return [(Sector.COUNT, int(ball_sector_indices[i]), configurations[starts[i]:ends[i]].tobytes())
+                for i in range(robots_cnt)]
+
+    def get(self, key):
+        decision = self._decisions.get(key)
+        if decision is None:
+            self.misses_cnt += 1
+        else:
+            self.hits_cnt += 1
+            self._decisions.move_to_end(key)
+        return decision
+
+    def put(self, key, decision):
+        self._decisions[key] = decision
+        self._decisions.move_to_end(key)
+        while len(self._decisions) > self.capacity:
+            self._decisions.popitem(last=False)
+            self.evictions_cnt += 1
+
+    def get_report(self):
+        return f'Decision cache: {self.hits_cnt} hits, {self.misses_cnt} misses ({100 * self.hit_rate:.1f}% hit), ' \
+               f'{self.evictions_cnt} evictions, {len(self)} of {self.capacity} entries'
+
+
+# Owns the planner state (sector flags and histogram buffers), so different contexts can plan
+# at the same time, e.g. in different threads. Buffers grow with the number of robots planned at once.
+# With @incremental set, histograms are updated from the previous call (see @HistogramCache).
+class PlannerContext:
+    def __init__(self, robots_cnt=1, incremental=False, tolerance=0.0, decision_cache: DecisionCache = None):
+        self.histogram_cache = HistogramCache(tolerance) if incremental else None
+        self.decision_cache = decision_cache
+        self._allocate(robots_cnt)
+
+    def _allocate(self, robots_cnt):
+        self.robots_cnt = robots_cnt
+        self.hist = numpy.zeros((robots_cnt, Sector.COUNT))
+        self.obstacles_cnt = numpy.zeros((robots_cnt, Sector.COUNT), dtype=numpy.intp)
+        self.smoothed_hist = numpy.zeros((robots_cnt, Sector.COUNT))
+        self.targets = numpy.zeros((robots_cnt, 2))
+        self.is_empty = numpy.ones((robots_cnt, Sector.COUNT), dtype=bool)
+        self.is_chosen = numpy.zeros((robots_cnt, Sector.COUNT), dtype=bool)
+        self.is_danger = numpy.zeros((robots_cnt, Sector.COUNT), dtype=bool)
+
+    def get_result(self, index=0) -> PlannerResult:
+        return PlannerResult(tuple(float(coord) for coord in self.targets[index]), self.is_empty[index].copy(),
+                             self.is_chosen[index].copy(), self.is_danger[index].copy())
+
+    # Plans all robots at once: @robot_poses is (N, 3) array of x, y, angle, the result is (N, 2) array of targets
+    # (a view of the context buffer). Obstacles are the other robots if @obstacles_predicted_positions is not given.
+    # @self_obstacle_indices are indices of the obstacles which are the robots themselves (-1 for none), they are
+    # not taken into account for their robots. @spatial_index built on the same obstacles can be shared between
+    # calls, otherwise it is built here for large fields (at least @SPATIAL_INDEX_MIN_OBSTACLES obstacles).
+    # Robots of independent worlds are planned together with @robot_groups and @obstacle_groups (world indices
+    # of the robots and the obstacles, a robot sees only the obstacles of its group; the robots are in their own
+    # groups if there are no obstacles) and @robot_ball_positions, (N, 2) array of the ball of each robot used
+    # instead of @ball_predicted_positions.
+    def batch_obstacle_avoidance(self, robot_poses, ball_predicted_positions, obstacles_predicted_positions=None,
+                                 spatial_index: UniformGrid = None, self_obstacle_indices=None,
+                                 robot_groups=None, obstacle_groups=None, robot_ball_positions=None):
+        robot_poses = numpy.asarray(robot_poses, dtype=float).reshape(-1, 3)
+        robots_cnt = len(robot_poses)
+        if robots_cnt > self.robots_cnt or self.hist.shape[1] != Sector.COUNT:
+            self._allocate(robots_cnt)
+
+        if obstacles_predicted_positions is None:
+            obstacles_positions = robot_poses[:, :2]
+            self_obstacle_indices = numpy.arange(robots_cnt)
+            obstacle_groups = robot_groups
+        else:
+            obstacles_positions = numpy.asarray(obstacles_predicted_positions, dtype=float).reshape(-1, 2)
+
+        if spatial_index is None and robot_groups is None and len(obstacles_positions) >= SPATIAL_INDEX_MIN_OBSTACLES:
+            spatial_index = build_spatial_index(obstacles_positions)
+        if robot_groups is not None:
+            robot_indices, obstacle_indices = get_group_pairs(robot_groups, obstacle_groups)
+        elif spatial_index is not None:
+            robot_indices, obstacle_indices = spatial_index.query_pairs(robot_poses[:, :2], get_aware_radius())
+        else:
+            robot_indices, obstacle_indices = numpy.divmod(numpy.arange(robots_cnt * len(obstacles_positions)),
+                                                           len(obstacles_positions))
+        if self_obstacle_indices is not None:
+            is_other = numpy.asarray(self_obstacle_indices)[robot_indices] != obstacle_indices
+            robot_indices, obstacle_indices = robot_indices[is_other], obstacle_indices[is_other]
+
+        ball_position = ball_predicted_positions[0] if robot_ball_positions is None else robot_ball_positions
+        corners, robot_indices, obstacle_indices, ball_points = get_relative_scene(
+            robot_poses, ball_position, obstacles_positions, robot_indices, obstacle_indices)
+        ball_sector_indices = get_sector_indices(ball_points[:, 0], ball_points[:, 1])
+
+        # remembered robots get no histograms, their flags and targets are taken from the cache below
+        if self.decision_cache is not None:
+            keys = self.decision_cache.get_keys(corners, robot_indices, robots_cnt, ball_sector_indices)
+            decisions = [self.decision_cache.get(key) for key in keys]
+            is_planned = numpy.array([decision is None for decision in decisions], dtype=bool)[robot_indices]
+            corners, robot_indices, obstacle_indices = \
+                corners[is_planned], robot_indices[is_planned], obstacle_indices[is_planned]
+
+        if self.histogram_cache is not None:
+            self.histogram_cache.get_histograms(corners, robot_indices, obstacle_indices, robots_cnt,
+                                                len(obstacles_positions), OBSTACLE_SQUARE_WIDTH, out=self.hist)
+        else:
+            get_histograms(corners, robot_indices, robots_cnt, OBSTACLE_SQUARE_WIDTH,
+                           out=self.hist, obstacles_cnt=self.obstacles_cnt)
+
+        smoothed_hist = smooth_histograms(self.hist[:robots_cnt], out=self.smoothed_hist[:robots_cnt])
+        is_empty, is_chosen, is_danger = \
+            self.is_empty[:robots_cnt], self.is_chosen[:robots_cnt], self.is_danger[:robots_cnt]
+        numpy.less(smoothed_hist, TRESHOLD, out=is_empty)
+        has_ball = ball_sector_indices >= 0
+        numpy.logical_and(smoothed_hist > DANGER, has_ball[:, None], out=is_danger)
+
+        target_indices = choose_target_sectors(smoothed_hist, is_danger, ball_sector_indices)
+        if self.decision_cache is not None:
+            for i, (key, decision) in enumerate(zip(keys, decisions)):
+                if decision is None:
+                    self.decision_cache.put(key, (int(target_indices[i]), is_empty[i].copy(), is_danger[i].copy()))
+                else:
+                    target_indices[i], is_empty[i], is_danger[i] = decision
+        is_chosen.fill(False)
+        is_chosen[has_ball, target_indices[has_ball]] = True
+
+        targets = self.targets[:robots_cnt]
+        numpy.add(_geometry.get_target_offsets(target_indices, MAX_DIST_TO_GO), robot_poses[:, :2], out=targets)
+        for i in numpy.flatnonzero(~has_ball):
+            logger.error(f'Unable to identify ball {Point(*ball_points[i])} position')
+            targets[i] = robot_poses[i, :2]
+        return targets
+
+    def obstacle_avoidance(self, robot_position, robot_angle, ball_predicted_positions,
+                           obstacles_predicted_positions) -> PlannerResult:
+        robot_x, robot_y = robot_position
+        self.batch_obstacle_avoidance([(robot_x, robot_y, robot_angle)], ball_predicted_positions,
+                                      obstacles_predicted_positions)
+        return self.get_result(0)
+
+
+_local = threading.local()
+
+
+# Planner context of the current thread used by the functions below
+def get_planner_context() -> PlannerContext:
+    if not hasattr(_local, 'context'):
+        decision_cache = DecisionCache(DECISION_CACHE_CAPACITY, DECISION_CACHE_BEARING_STEP,
+                                       DECISION_CACHE_RANGE_STEP) if DECISION_CACHE_CAPACITY else None
+        _local.context = PlannerContext(decision_cache=decision_cache)
+    return _local.context
+
+
+def batch_obstacle_avoidance(robot_poses, ball_predicted_positions, obstacles_predicted_positions=None):
+    targets = get_planner_context().batch_obstacle_avoidance(robot_poses, ball_predicted_positions,
+                                                             obstacles_predicted_positions)
+    return targets.copy()
+
+
+def dump_obstacle_avoidance(robot_position, robot_angle, ball_predicted_positions,
+                            obstacles_predicted_positions: [MovingObstacle]):
+    return get_planner_context().obstacle_avoidance(robot_position, robot_angle, ball_predicted_positions,
+                                                    obstacles_predicted_positions).target
 
 
 def drawable_dump_obstacle_avoidance(screen, robot, ball_predicted_positions, obstacles_predicted_positions):
-    result = dump_obstacle_avoidance(robot.get_pos(), robot.angle, ball_predicted_positions,
-                                     obstacles_predicted_positions)
+    result = get_planner_context().obstacle_avoidance(robot.get_pos(), robot.angle, ball_predicted_positions,
+                                                      obstacles_predicted_positions)
 
-    for sector in _sectors:
-        robot_x, robot_y = robot.get_pos()
-        sector.draw(screen, center=Point(robot_x, robot_y))
+    robot_x, robot_y = robot.get_pos()
+    result.draw(screen, center=Point(robot_x, robot_y))
 
-    return result
+    return result.target
 
 
 MAX_DIST_TO_GO = 0.5
 OBSTACLE_AWARE_DIST = 1.5
+OBSTACLE_SQUARE_WIDTH = constants.UNITS_RADIUS * 2 + constants.UNITS_RADIUS  # need to tune sector around an obstacle
+SPATIAL_INDEX_MIN_OBSTACLES = 32
+HISTOGRAM_SAMPLE_STEP = 0.04
+# memoization of the decisions of the thread planner contexts, 0 capacity disables it
+DECISION_CACHE_CAPACITY = 0
+DECISION_CACHE_BEARING_STEP = 2.0
+DECISION_CACHE_RANGE_STEP = 0.05
 
 DRAWING_HIDE_EMPTY = False
 DRAWING_MAX_LINE_POINTS = 30
 DRAWING_MIDDLE_LANE = True
+DRAWING_ONLY_MARKED = False  # only the chosen and the danger sectors
+DRAWING_LINE_THICKNESS = 1
+DRAWING_COLORS = (Color.GRAY, Color.RED, Color.PURPLE, Color.RED2)  # empty, not empty, chosen, danger
 
 # need to tune
+SMOOTHING_KERNEL = (0, 1, 2, 3, 4, 5, 4, 3, 2, 1, 0)
+SMOOTHING_DIVIDER = 11
 TRESHOLD = 28
 VALLEY = 3
 DANGER_AWARE_ANGLE = 50
 DANGER = 45
 
-_sectors = Sector.generate_sectors()
+_geometry = get_sector_geometry(Sector.DEG_STEP)
+_sectors = _geometry.sectors
 logger.warning('\n'.join([str(s) for s in _sectors]))
 
 OBSTACLE_COEF_DRIVE_TO_ROBOT = 0.5
@@ -391,7 +865,7 @@ OBSTACLE_COEF_DRIVE_TO_ROBOT = 0.5
 
 #  Эвриситка раз:  Если робот движется на нас -> хреновое направление
 def get_coeff_direction(vx, vy, sector: Sector) -> float:
-    direction_vector = sector._get_line_by_deg((sector.start_deg + sector.end_deg) / 2).get_direction_vector()
+    direction_vector = sector.middle_line.get_direction_vector()
     direction_obstacle = (-vx, -vy)
 
     # no movements
@@ -0,0 +1,86 @@
+import time
+
+
+# Fixed timestep pacing of the visible simulation: the wall time passed since the previous @advance, scaled by
+# @speed (simulated seconds per wall second), is added to an accumulator which is spent by ticks of @dt, so the
+# physics goes at the same rate however long the ticks and the frames take. Frames are shown at @render_fps.
+# When the loop falls behind, the accumulator is kept below @max_ticks_per_frame ticks and the rest of the time is
+# dropped (the simulation slows down instead of doing more and more ticks per frame), and the frames which were
+# missed are skipped instead of shown late. The real time factor is measured from the ticks which were done
+# (see @count_tick), since the last @reset. @clock gives the wall time in seconds.
+class FixedStepClock:
+    def __init__(self, dt, speed=1.0, render_fps=30, max_ticks_per_frame=5, clock=time.perf_counter):
+        self.dt = dt
+        self.speed = speed
+        self.frame_period = 1 / render_fps
+        self.max_lag = max_ticks_per_frame * dt
+        self.clock = clock
+        self.reset()
+
+    # Starts the measurement anew from now, e.g. after the simulation is put back to a snapshot
+    def reset(self):
+        self.start_time = self._last_time = self._next_frame_time = self.clock()
+        self.accumulator = 0.0
+
+        self.ticks_cnt = 0
+        self.frames_cnt = 0
+        self.skipped_frames_cnt = 0
+        self.dropped_time = 0.0
+
+    @property
+    def sim_time(self):
+        return self.ticks_cnt * self.dt
+
+    @property
+    def wall_time(self):
+        return self.clock() - self.start_time
+
+    # Simulated seconds per wall second since the start, 1 is real time
+    @property
+    def real_time_factor(self):
+        wall_time = self.wall_time
+        return self.sim_time / wall_time if wall_time > 0 else 0.0
+
+    @property
+    def fps(self):
+        wall_time = self.wall_time
+        return self.frames_cnt / wall_time if wall_time > 0 else 0.0
+
+    # Number of ticks to do now to catch up with the wall time, the ones done are counted by @count_tick
+    def advance(self):
+        now = self.clock()
+        self.accumulator += (now - self._last_time) * self.speed
+        self._last_time = now
+        if self.accumulator > self.max_lag:
+            self.dropped_time += self.accumulator - self.max_lag
+            self.accumulator = self.max_lag
+
+        # the small epsilon keeps a whole tick of accumulated time from being lost to the rounding
+        ticks_cnt = int((self.accumulator + 1e-9) // self.dt)
+        self.accumulator = max(self.accumulator - ticks_cnt * self.dt, 0.0)
+        return ticks_cnt
+
+    def count_tick(self):
+        self.ticks_cnt += 1
+
+    # Whether a frame is to be shown now, the frames missed since the previous one are skipped
+    def is_frame_due(self):
+        now = self.clock()
+        if now < self._next_frame_time:
+            return False
+        missed_cnt = int((now - self._next_frame_time) // self.frame_period)
+        self.skipped_frames_cnt += missed_cnt
+        self._next_frame_time += (missed_cnt + 1) * self.frame_period
+        self.frames_cnt += 1
+        return True
+
+    # Wall seconds until the next tick or frame is due
+    def get_wait(self):
+        now = self.clock()
+        until_tick = (self.dt - self.accumulator) / self.speed - (now - self._last_time)
+        return max(min(until_tick, self._next_frame_time - now), 0.0)
+
+    def get_report(self):
+        return f'Clock: {self.ticks_cnt} ticks of {self.dt} sec, {self.frames_cnt} frames ({self.fps:.1f} FPS), ' \
+               f'{self.skipped_frames_cnt} frames skipped, real time factor {self.real_time_factor:.2f} ' \
+               f'of {self.speed:.2f}, {self.dropped_time:.2f} sec dropped'
@@ -0,0 +1,153 @@
+import cv2
+import numpy
+
+import constants
+from constants import Color
+from models import Ball, Drawable, MovingObstacle, Robot
+
+
+# Rectangles (K, 4) of x0, y0, x1, y1 (exclusive) around (K, 2) screen @centers, clipped by the screen
+def _get_rects(centers, extents, width, height):
+    centers = numpy.asarray(centers, dtype=numpy.intp).reshape(-1, 2)
+    extents = numpy.asarray(extents, dtype=numpy.intp).reshape(-1, 1)
+    starts = numpy.clip(centers - extents, 0, (width, height))
+    ends = numpy.clip(centers + extents + 1, 0, (width, height))
+    return numpy.concatenate([starts, ends], axis=1)
+
+
+# (K, L) flags of the rectangles @rects_a (K, 4) intersecting @rects_b (L, 4)
+def _intersect_rects(rects_a, rects_b):
+    return (rects_a[:, None, 0] < rects_b[None, :, 2]) & (rects_b[None, :, 0] < rects_a[:, None, 2]) & \
+        (rects_a[:, None, 1] < rects_b[None, :, 3]) & (rects_b[None, :, 1] < rects_a[:, None, 3])
+
+
+# Renders the same scene as @render_scene in layers which are kept between frames:
+# @background is the empty field, @trails is the background with the trails of the robots which is updated by
+# the trail dots added and dropped since the previous frame (@trail_counts is the number of dots on each pixel)
+# and @scene is the trails with the robots, obstacles and the ball on them. Only the rectangles of the objects
+# which have moved and of the changed trail dots are restored from @trails, and only the objects which are in
+# them (and the ones drawn over those) are drawn again, so the cost is proportional to the motion.
+class LayeredRenderer:
+    def __init__(self, width=constants.WINDOW_WIDTH, height=constants.WINDOW_HEIGHT, background_color=Color.BLACK):
+        self.width, self.height = width, height
+        self.background = numpy.full((height, width, 3), background_color, dtype=numpy.uint8)
+        self.trail_counts = numpy.zeros((height, width), dtype=numpy.int32)
+        self.trails = self.background.copy()
+        self.scene = self.background.copy()
+        self.frame = numpy.empty_like(self.background)
+
+        # offsets (dy, dx) of the pixels of a trail dot, the same as cv2.circle draws them
+        radius = Robot.TRAIL_SCREEN_RADIUS
+        stamp = numpy.zeros((2 * radius + 1, 2 * radius + 1), dtype=numpy.uint8)
+        cv2.circle(stamp, (radius, radius), radius, 1, thickness=-1)
+        self._stamp_offsets = numpy.argwhere(stamp) - radius
+
+        self._objects = None
+        self._states = None
+        self._rects = None
+        self._trail_coords = {}
+
+        self.frames_cnt = 0
+        self.full_redraws_cnt = 0
+        self.redrawn_area = 0
+
+    # Adds (@delta = 1) or removes (@delta = -1) the trail dots with (K, 2) screen @coords, returns their rectangles
+    def _stamp_trails(self, coords, delta):
+        xs = (coords[:, None, 0] + self._stamp_offsets[:, 1]).ravel()
+        ys = (coords[:, None, 1] + self._stamp_offsets[:, 0]).ravel()
+        is_inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs, ys = xs[is_inside], ys[is_inside]
+
+        numpy.add.at(self.trail_counts, (ys, xs), delta)
+        self.trails[ys, xs] = numpy.where(self.trail_counts[ys, xs, None] > 0, Robot.TRAIL_COLOR,
+                                          self.background[ys, xs])
+        return _get_rects(coords, Robot.TRAIL_SCREEN_RADIUS, self.width, self.height)
+
+    # Brings the trails layer to the current histories of @robots, returns the rectangles of the changed dots
+    def _update_trails(self, robots: [Robot]):
+        added, removed = [], []
+        for robot in robots:
+            coords = numpy.array(Drawable.get_coords_on_screen_many(robot.pos_history), dtype=numpy.intp)
+            coords = coords.reshape(-1, 2)
+            old_coords = self._trail_coords.get(robot, numpy.empty((0, 2), dtype=numpy.intp))
+            # histories are sliding windows: the oldest dots are dropped and the new ones are appended
+            for dropped_cnt in range(len(old_coords) + 1):
+                kept_cnt = len(old_coords) - dropped_cnt
+                if kept_cnt <= len(coords) and numpy.array_equal(old_coords[dropped_cnt:], coords[:kept_cnt]):
+                    break
+            removed.append(old_coords[:dropped_cnt])
+            added.append(coords[kept_cnt:])
+            self._trail_coords[robot] = coords
+
+        rects = [numpy.empty((0, 4), dtype=numpy.intp)]
+        removed, added = numpy.concatenate(removed or rects), numpy.concatenate(added or rects)
+        if len(removed):
+            rects.append(self._stamp_trails(removed, -1))
+        if len(added):
+            rects.append(self._stamp_trails(added, 1))
+        return numpy.concatenate(rects)
+
+    @staticmethod
+    def _draw_object(screen, drawable, wheel_coords):
+        if isinstance(drawable, Robot):
+            drawable.draw_body(screen, wheel_coords)
+        else:
+            drawable.draw(screen)
+
+    # Full redraw of all layers, used on the first frame and when the objects change
+    def _redraw(self, robots: [Robot], objects, wheel_coords):
+        self.trail_counts.fill(0)
+        numpy.copyto(self.trails, self.background)
+        self._trail_coords = {}
+        self._update_trails(robots)
+        numpy.copyto(self.scene, self.trails)
+        for drawable, drawable_wheel_coords in zip(objects, wheel_coords):
+            self._draw_object(self.scene, drawable, drawable_wheel_coords)
+        self.full_redraws_cnt += 1
+        self.redrawn_area += self.width * self.height
+
+    # The scene with @robots, @obstacles and @ball at their current positions, the @scene buffer is returned
+    def render(self, robots: [Robot], ball: Ball, obstacles: [MovingObstacle]):
+        objects = (*robots, *obstacles, ball)
+        states = numpy.array([drawable.get_pose() if isinstance(drawable, Robot) else (*drawable.get_pos(), 0.0)
+                              for drawable in objects]).reshape(-1, 3)
+        extents = [drawable.SCREEN_EXTENT for drawable in objects]
+        rects = _get_rects(Drawable.get_coords_on_screen_many(states[:, :2]), extents, self.width, self.height)
+        # wheels of all robots at once, none for the obstacles and the ball
+        wheel_coords = [*Robot.get_wheel_coords_many(robots), *[None] * (len(objects) - len(robots))]
+        self.frames_cnt += 1
+
+        if self._objects is None or len(objects) != len(self._objects) or \
+                any(drawable is not old for drawable, old in zip(objects, self._objects)):
+            self._redraw(robots, objects, wheel_coords)
+        else:
+            is_moved = (states != self._states).any(axis=1)
+            dirty_rects = numpy.concatenate([self._rects[is_moved], rects[is_moved], self._update_trails(robots)])
+            is_redrawn = _intersect_rects(rects, dirty_rects).any(axis=1)
+            # an object drawn again is over the later ones it overlaps, so they are drawn again too
+            is_later_overlap = numpy.triu(_intersect_rects(rects, rects), k=1)
+            while True:
+                is_redrawn_closed = is_redrawn | is_later_overlap[is_redrawn].any(axis=0)
+                if (is_redrawn_closed == is_redrawn).all():
+                    break
+                is_redrawn = is_redrawn_closed
+
+            for x0, y0, x1, y1 in dirty_rects.tolist():
+                self.scene[y0:y1, x0:x1] = self.trails[y0:y1, x0:x1]
+                self.redrawn_area += (x1 - x0) * (y1 - y0)
+            for drawable, drawable_wheel_coords, redrawn in zip(objects, wheel_coords, is_redrawn.tolist()):
+                if redrawn:
+                    self._draw_object(self.scene, drawable, drawable_wheel_coords)
+
+        self._objects, self._states, self._rects = objects, states, rects
+        return self.scene
+
+    # Copy of the scene in the preallocated @frame buffer to draw the debug information on
+    def get_frame(self):
+        numpy.copyto(self.frame, self.scene)
+        return self.frame
+
+    def get_report(self):
+        redrawn_part = self.redrawn_area / (self.frames_cnt * self.width * self.height) if self.frames_cnt else 0
+        return f'Renderer: {self.frames_cnt} frames, {self.full_redraws_cnt} full redraws, ' \
+               f'{redrawn_part:.1%} of the field redrawn per frame'
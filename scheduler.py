@@ -0,0 +1,153 @@
+import numpy
+
+import constants
+import obstacle_avoidance
+from models import Robot
+from obstacle_avoidance import PlannerContext, PlannerResult
+
+
+# Decides on each tick which robots call the obstacle avoidance, the others keep moving to the target
+# they got last time (move_to_dot_again). A robot replans when its replanning @period has passed
+# (scalar or one per robot) and, if @use_events is set, when it reached its target or the ball or
+# an obstacle came closer than @OBSTACLE_AWARE_DIST since its last planning.
+# With @drift_check_period every k-th tick the robots which are not replanned are planned anyway by a separate
+# context and the distances of their kept targets to the fresh ones (the drift) are measured for the report.
+class ReplanningScheduler:
+    TARGET_REACHED_DIST = Robot.RADIUS
+
+    class Trigger:
+        PERIOD = 'period'
+        TARGET_REACHED = 'target reached'
+        BALL_NEAR = 'ball near'
+        OBSTACLE_NEAR = 'obstacle near'
+
+    def __init__(self, robots_cnt, period=constants.dt, use_events=True, drift_check_period=None):
+        self.periods = numpy.broadcast_to(numpy.asarray(period, dtype=float), (robots_cnt,)).copy()
+        self.use_events = use_events
+        self.drift_check_period = drift_check_period
+
+        self.last_plan_time = numpy.full(robots_cnt, -numpy.inf)
+        self.targets = numpy.zeros((robots_cnt, 2))
+        self.is_ball_near = numpy.zeros(robots_cnt, dtype=bool)
+        self.is_obstacle_near = numpy.zeros((robots_cnt, 0), dtype=bool)
+
+        # sector flags of the last planning of each robot, for drawing
+        self.is_empty = None
+        self.is_chosen = None
+        self.is_danger = None
+
+        self.ticks_cnt = 0
+        self.planned_cnt = 0
+        self.triggers_cnt = {trigger: 0 for trigger in (self.Trigger.PERIOD, self.Trigger.TARGET_REACHED,
+                                                        self.Trigger.BALL_NEAR, self.Trigger.OBSTACLE_NEAR)}
+
+        self.drift_checks_cnt = 0
+        self.drift_sum = 0.0
+        self.max_drift = 0.0
+        self._drift_context = None
+
+    def _get_replan_mask(self, sim_time, robot_positions, ball_position, obstacles_positions, self_obstacle_indices):
+        aware_dist = obstacle_avoidance.OBSTACLE_AWARE_DIST
+        is_ball_near = numpy.linalg.norm(robot_positions - ball_position, axis=-1) <= aware_dist
+        obstacle_dists = numpy.linalg.norm(robot_positions[:, None] - obstacles_positions[None], axis=-1)
+        is_obstacle_near = obstacle_dists <= aware_dist
+        is_self = self_obstacle_indices >= 0
+        is_obstacle_near[numpy.flatnonzero(is_self), self_obstacle_indices[is_self]] = False
+
+        triggers = {self.Trigger.PERIOD: sim_time - self.last_plan_time >= self.periods - 1e-9}
+        if self.use_events:
+            dist_to_targets = numpy.linalg.norm(robot_positions - self.targets, axis=-1)
+            triggers[self.Trigger.TARGET_REACHED] = dist_to_targets < self.TARGET_REACHED_DIST
+            triggers[self.Trigger.BALL_NEAR] = is_ball_near & ~self.is_ball_near
+            if self.is_obstacle_near.shape == is_obstacle_near.shape:
+                triggers[self.Trigger.OBSTACLE_NEAR] = (is_obstacle_near & ~self.is_obstacle_near).any(axis=-1)
+            else:  # obstacles have changed, e.g. detected another number of them
+                triggers[self.Trigger.OBSTACLE_NEAR] = numpy.ones(len(robot_positions), dtype=bool)
+
+        mask = numpy.zeros(len(robot_positions), dtype=bool)
+        for trigger, triggered in triggers.items():
+            self.triggers_cnt[trigger] += numpy.count_nonzero(triggered & ~mask)
+            mask |= triggered
+        return mask, is_ball_near, is_obstacle_near
+
+    # Targets of all robots: replanned ones by @planner_context, the rest are the last targets.
+    # Obstacles are the other robots if @obstacles_predicted_positions is not given.
+    def get_targets(self, sim_time, robot_poses, ball_predicted_positions, planner_context: PlannerContext,
+                    obstacles_predicted_positions=None):
+        robot_poses = numpy.asarray(robot_poses, dtype=float).reshape(-1, 3)
+        if obstacles_predicted_positions is None:
+            obstacles_positions = robot_poses[:, :2]
+            self_obstacle_indices = numpy.arange(len(robot_poses))
+        else:
+            obstacles_positions = numpy.asarray(obstacles_predicted_positions, dtype=float).reshape(-1, 2)
+            self_obstacle_indices = numpy.full(len(robot_poses), -1)
+
+        mask, is_ball_near, is_obstacle_near = self._get_replan_mask(
+            sim_time, robot_poses[:, :2], numpy.asarray(ball_predicted_positions[0], dtype=float),
+            obstacles_positions, self_obstacle_indices)
+        if self.is_obstacle_near.shape != is_obstacle_near.shape:
+            self.is_obstacle_near = is_obstacle_near.copy()
+
+        planned = numpy.flatnonzero(mask)
+        if len(planned):
+            self.targets[planned] = planner_context.batch_obstacle_avoidance(
+                robot_poses[planned], ball_predicted_positions, obstacles_positions,
+                self_obstacle_indices=self_obstacle_indices[planned])
+            self.last_plan_time[planned] = sim_time
+            self.is_ball_near[planned] = is_ball_near[planned]
+            self.is_obstacle_near[planned] = is_obstacle_near[planned]
+            self._keep_sector_flags(planned, planner_context)
+
+        if self.drift_check_period and self.ticks_cnt % self.drift_check_period == 0:
+            skipped = numpy.flatnonzero(~mask)
+            self._check_drift(skipped, robot_poses, ball_predicted_positions, obstacles_positions,
+                              self_obstacle_indices)
+        self.ticks_cnt += 1
+        self.planned_cnt += len(planned)
+        return self.targets
+
+    # Distances of the kept targets of the @skipped robots to the ones they would be planned now
+    def _check_drift(self, skipped, robot_poses, ball_predicted_positions, obstacles_positions,
+                     self_obstacle_indices):
+        if not len(skipped):
+            return
+        if self._drift_context is None:
+            self._drift_context = PlannerContext(len(self.targets))
+        fresh_targets = self._drift_context.batch_obstacle_avoidance(
+            robot_poses[skipped], ball_predicted_positions, obstacles_positions,
+            self_obstacle_indices=self_obstacle_indices[skipped])
+        drifts = numpy.linalg.norm(self.targets[skipped] - fresh_targets, axis=-1)
+        self.drift_checks_cnt += len(skipped)
+        self.drift_sum += float(drifts.sum())
+        self.max_drift = max(self.max_drift, float(drifts.max()))
+
+    def _keep_sector_flags(self, planned, planner_context: PlannerContext):
+        if self.is_empty is None or self.is_empty.shape[1] != planner_context.is_empty.shape[1]:
+            shape = (len(self.targets), planner_context.is_empty.shape[1])
+            self.is_empty = numpy.ones(shape, dtype=bool)
+            self.is_chosen = numpy.zeros(shape, dtype=bool)
+            self.is_danger = numpy.zeros(shape, dtype=bool)
+        self.is_empty[planned] = planner_context.is_empty[:len(planned)]
+        self.is_chosen[planned] = planner_context.is_chosen[:len(planned)]
+        self.is_danger[planned] = planner_context.is_danger[:len(planned)]
+
+    def get_result(self, index) -> PlannerResult:
+        return PlannerResult(tuple(float(coord) for coord in self.targets[index]), self.is_empty[index],
+                             self.is_chosen[index], self.is_danger[index])
+
+    @property
+    def skipped_cnt(self):
+        return self.ticks_cnt * len(self.targets) - self.planned_cnt
+
+    def get_report(self, sim_time):
+        possible_cnt = self.ticks_cnt * len(self.targets)
+        saved = 100 * self.skipped_cnt / possible_cnt if possible_cnt else 0
+        calls_per_sec = self.planned_cnt / sim_time if sim_time else 0
+        saved_per_sec = self.skipped_cnt / sim_time if sim_time else 0
+        triggers = ', '.join(f'{trigger}: {cnt}' for trigger, cnt in self.triggers_cnt.items())
+        report = f'Planner calls: {self.planned_cnt} of {possible_cnt} ({saved:.1f}% saved), ' \
+                 f'{calls_per_sec:.1f} calls per simulated second ({saved_per_sec:.1f} saved), triggers: {triggers}'
+        if self.drift_checks_cnt:
+            report += f', drift of the kept targets: {self.drift_sum / self.drift_checks_cnt:.3f} m mean, ' \
+                      f'{self.max_drift:.3f} m max in {self.drift_checks_cnt} checks'
+        return report
@@ -0,0 +1,71 @@
+import math
+
+import numpy
+
+import constants
+
+
+# Uniform grid over the field for neighbour queries. Points are bucketed by their cell once (per tick)
+# with a counting sort and then any number of queries take only the cells around the query point.
+# Points outside of the field are put into the border cells, so they are still found.
+class UniformGrid:
+    def __init__(self, cell_size, corners=constants.WINDOW_CORNERS):
+        self.cell_size = cell_size
+        self.x_min, self.y_min, x_max, y_max = corners
+        self.cols = max(1, math.ceil((x_max - self.x_min) / cell_size))
+        self.rows = max(1, math.ceil((y_max - self.y_min) / cell_size))
+
+        self.positions = numpy.zeros((0, 2))
+        self.order = numpy.zeros(0, dtype=numpy.intp)
+        self.cell_starts = numpy.zeros(self.cols * self.rows + 1, dtype=numpy.intp)
+
+    def _get_cells(self, positions):
+        cols = numpy.clip(((positions[:, 0] - self.x_min) // self.cell_size).astype(numpy.intp), 0, self.cols - 1)
+        rows = numpy.clip(((positions[:, 1] - self.y_min) // self.cell_size).astype(numpy.intp), 0, self.rows - 1)
+        return cols, rows
+
+    def update(self, positions):
+        self.positions = numpy.asarray(positions, dtype=float).reshape(-1, 2)
+        cols, rows = self._get_cells(self.positions)
+        cell_ids = rows * self.cols + cols
+
+        self.order = numpy.argsort(cell_ids, kind='stable')
+        self.cell_starts[0] = 0
+        numpy.cumsum(numpy.bincount(cell_ids, minlength=self.cols * self.rows), out=self.cell_starts[1:])
+        return self
+
+    # All pairs (query index, point index) with the point not farther than @radius from the query center,
+    # sorted by the query index and then by the point index
+    def query_pairs(self, centers, radius):
+        centers = numpy.asarray(centers, dtype=float).reshape(-1, 2)
+        reach = math.ceil(radius / self.cell_size)
+        offsets = numpy.arange(-reach, reach + 1)
+
+        cols, rows = self._get_cells(centers)
+        neighbour_cols = (cols[:, None, None] + offsets[None, None, :]).repeat(len(offsets), axis=1)
+        neighbour_rows = (rows[:, None, None] + offsets[None, :, None]).repeat(len(offsets), axis=2)
+        inside = (neighbour_cols >= 0) & (neighbour_cols < self.cols) & \
+                 (neighbour_rows >= 0) & (neighbour_rows < self.rows)
+
+        cell_ids = (neighbour_rows * self.cols + neighbour_cols)[inside]
+        query_indices = numpy.broadcast_to(numpy.arange(len(centers))[:, None, None], inside.shape)[inside]
+        starts = self.cell_starts[cell_ids]
+        counts = self.cell_starts[cell_ids + 1] - starts
+
+        # expand cell ranges into positions in @order
+        total = counts.sum()
+        range_starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        slots = numpy.repeat(starts, counts) + numpy.arange(total) - range_starts
+
+        query_indices = numpy.repeat(query_indices, counts)
+        point_indices = self.order[slots]
+
+        deltas = self.positions[point_indices] - centers[query_indices]
+        near = deltas[:, 0] ** 2 + deltas[:, 1] ** 2 <= radius ** 2
+        query_indices, point_indices = query_indices[near], point_indices[near]
+
+        order = numpy.lexsort((point_indices, query_indices))
+        return query_indices[order], point_indices[order]
+
+    def query(self, center, radius):
+        return self.query_pairs([center], radius)[1]
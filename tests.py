@@ -1,7 +1,28 @@
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy
+
 import main
 import utils
 import constants
+import obstacle_avoidance
 from models import Ball, Robot, MovingObstacle
+from collision import CollisionEvent, detect_collisions, sweep_collisions
+import batch_runner
+from engine import SimulationEngine, SimulationResult, render_scene, run_headless
+from integrator import AdaptiveIntegrator
+from multi_world import MultiWorldEngine, run_many_headless
+from realtime import FixedStepClock
+from renderer import LayeredRenderer
+from trajectory import Trajectory, TrajectoryRecorder, TrajectoryReplay
+from video_export import export_video, get_chunks
+from video_writer import AsyncVideoWriter
+from scheduler import ReplanningScheduler
+from world import WorldState
 
 seeds = [42,171,228,239,322,359,777,1337,1703,3228]
 
@@ -62,6 +83,668 @@ def test_vshyvost():
         assert result
 
 
+def test_vectorized_histogram():
+    random.seed(239)
+    width = constants.UNITS_RADIUS * 3
+    robot_point = obstacle_avoidance.Point(0, 0)
+    # samples of the first obstacle lie on the 225 degrees border of two sectors
+    scenes = [[obstacle_avoidance.Square(-0.5, -0.52, width)]]
+    for _ in range(20):
+        scenes.append([obstacle_avoidance.Square(random.uniform(-1.5, 1.5), random.uniform(-1.5, 1.5), width)
+                       for _ in range(random.randint(0, 6))])
+
+    for obstacles in scenes:
+        expected = []
+        for sector in obstacle_avoidance._sectors:
+            values = [obstacle_avoidance.get_histogram_value(robot_point, obstacle, sector, 1, 1)
+                      for obstacle in obstacles]
+            seen_cnt = len([val for val in values if val != 0])
+            expected.append(sum(values) / seen_cnt if seen_cnt else sum(values))
+
+        corners = obstacle_avoidance.get_obstacle_corners(obstacles)
+        assert list(obstacle_avoidance.get_histogram(corners, width)) == expected
+
+
+# Target of the robot at @robot_position planned one sector at a time as the planner did before it was batched:
+# @get_histogram_value of each sector, the scalar smoothing and the choice of the valley closest to the ball
+def _reference_obstacle_avoidance(robot_position, robot_angle, ball_position, obstacles_positions):
+    oa = obstacle_avoidance
+    robot_x, robot_y = robot_position
+    robot_point = oa.Point(0, 0)
+    obstacles = []
+    for x, y in obstacles_positions:
+        point = oa.Point(x, y).rotate(robot_angle)
+        obstacle = oa.Square(point.x, point.y, oa.OBSTACLE_SQUARE_WIDTH,
+                             coord_center=oa.Point(robot_x, robot_y).rotate(robot_angle))
+        if obstacle.get_dist_to_point(robot_point) <= oa.OBSTACLE_AWARE_DIST:
+            obstacles.append(obstacle)
+    ball_point = oa.Point(*ball_position, coord_center=oa.Point(robot_x, robot_y)).rotate(robot_angle)
+
+    sectors, hist, ball_sector = oa._sectors, [], None
+    for sector in sectors:
+        values = [oa.get_histogram_value(robot_point, obstacle, sector, 1, 1) for obstacle in obstacles]
+        seen_cnt = len([value for value in values if value != 0])
+        hist.append(sum(values) / seen_cnt if seen_cnt else sum(values))
+        if sector.contains_point(ball_point):
+            ball_sector = sector
+    if ball_sector is None:
+        return robot_x, robot_y
+
+    count = len(sectors)
+    smoothed = []
+    for k in range(count):
+        value = 5 * hist[k]
+        for i in range(1, 6):
+            value += (5 - i) * hist[(k - i) % count]
+            value += (5 - i) * hist[(k + i) % count]
+        smoothed.append(value / 11)
+
+    danger_sectors = [sector for sector, value in zip(sectors, smoothed) if value > oa.DANGER]
+    target_sector, min_diff = sectors[0], oa.INF
+    for k in range(count):
+        ids = [(k + i) % count + 1 for i in range(oa.VALLEY)]
+        if all(smoothed[sector_id - 1] < oa.TRESHOLD for sector_id in ids):
+            valley_target = [sector for sector in sectors if sector.id in ids][oa.VALLEY // 2 + 1]
+            diff = oa.Sector.get_diff(valley_target, ball_sector)
+            if diff < min_diff and all(oa.Sector.get_diff(valley_target, danger) > oa.DANGER_AWARE_ANGLE
+                                       for danger in danger_sectors):
+                min_diff, target_sector = diff, valley_target
+
+    vec_x, vec_y = target_sector._get_line_by_deg((target_sector.start_deg + target_sector.end_deg) / 2) \
+        .get_direction_vector()
+    scale = abs(vec_x / vec_y)
+    if scale < 1:
+        target_x, target_y = oa.MAX_DIST_TO_GO * scale, oa.MAX_DIST_TO_GO
+    else:
+        target_x, target_y = oa.MAX_DIST_TO_GO, oa.MAX_DIST_TO_GO / scale
+    return target_x * utils._get_sign(vec_x) + robot_x, target_y * utils._get_sign(vec_y) + robot_y
+
+
+def test_batch_obstacle_avoidance():
+    random.seed(42)
+    for scene in range(20):
+        # every other scene is crowded, so most robots have obstacles around
+        size = (4, 2.5) if scene % 2 else (1.5, 1.5)
+        robot_poses = [(random.uniform(-size[0], size[0]), random.uniform(-size[1], size[1]),
+                        random.uniform(-math.pi, math.pi)) for _ in range(12)]
+        ball_predicted_positions = [(random.uniform(-4, 4), random.uniform(-2.5, 2.5))]
+
+        targets = obstacle_avoidance.batch_obstacle_avoidance(robot_poses, ball_predicted_positions)
+        for target, (robot_x, robot_y, robot_angle) in zip(targets, robot_poses):
+            obstacles = [(x, y) for x, y, _ in robot_poses if (x, y) != (robot_x, robot_y)]
+            expected = _reference_obstacle_avoidance((robot_x, robot_y), robot_angle, ball_predicted_positions[0],
+                                                     obstacles)
+            assert numpy.allclose(target, expected, rtol=0, atol=1e-9)
+
+
+def test_planner_threads():
+    random.seed(228)
+    scenes = []
+    for _ in range(40):
+        robot_poses = [(random.uniform(-4, 4), random.uniform(-2.5, 2.5), random.uniform(-math.pi, math.pi))
+                       for _ in range(6)]
+        scenes.append(((robot_poses[0][:2], robot_poses[0][2]), [(random.uniform(-4, 4), random.uniform(-2.5, 2.5))],
+                       [(x, y) for x, y, _ in robot_poses[1:]]))
+
+    def plan(scene):
+        (robot_position, robot_angle), ball_predicted_positions, obstacles = scene
+        result = obstacle_avoidance.get_planner_context().obstacle_avoidance(
+            robot_position, robot_angle, ball_predicted_positions, obstacles)
+        return result.target, result.is_empty.tolist(), result.is_chosen.tolist(), result.is_danger.tolist()
+
+    expected = [plan(scene) for scene in scenes]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(plan, scenes)) == expected
+
+
+def test_smooth_histograms():
+    random.seed(322)
+    sectors_cnt = obstacle_avoidance.Sector.COUNT
+    hist = [[random.choice([0, random.uniform(0, 60)]) for _ in range(sectors_cnt)] for _ in range(10)]
+
+    smoothed = obstacle_avoidance.smooth_histograms(numpy.array(hist))
+    for h_list, smoothed_hist in zip(hist, smoothed):
+        for k in range(sectors_cnt):
+            expected = 5 * h_list[k]
+            for i in range(1, 6):
+                expected += (5 - i) * h_list[(k - i) % sectors_cnt]
+                expected += (5 - i) * h_list[(k + i) % sectors_cnt]
+            assert smoothed_hist[k] == expected / 11
+
+
+def test_sector_resolution():
+    random.seed(359)
+    try:
+        for deg_step in (4, 2):
+            obstacle_avoidance.set_sector_resolution(deg_step)
+            assert len(obstacle_avoidance._sectors) == 360 // deg_step
+
+            points = [obstacle_avoidance.Point(random.uniform(-2, 2), random.uniform(-2, 2)) for _ in range(200)]
+            indices = obstacle_avoidance.get_sector_indices([p.x for p in points], [p.y for p in points])
+            for point, index in zip(points, indices):
+                assert obstacle_avoidance._sectors[index].contains_point(point)
+
+            robot_poses = [(random.uniform(-4, 4), random.uniform(-2.5, 2.5), 0) for _ in range(12)]
+            targets = obstacle_avoidance.batch_obstacle_avoidance(robot_poses, [(0, 0)])
+            assert targets.shape == (12, 2)
+    finally:
+        obstacle_avoidance.set_sector_resolution(8)
+
+
+def test_spatial_index():
+    random.seed(777)
+    positions = numpy.array([(random.uniform(-5, 5), random.uniform(-3, 3)) for _ in range(300)])
+    centers = numpy.array([(random.uniform(-5, 5), random.uniform(-3, 3)) for _ in range(50)])
+    radius = obstacle_avoidance.get_aware_radius()
+
+    query_indices, point_indices = obstacle_avoidance.build_spatial_index(positions).query_pairs(centers, radius)
+    dists = numpy.linalg.norm(centers[:, None] - positions[None], axis=-1)
+    expected_query_indices, expected_point_indices = numpy.nonzero(dists <= radius)
+    assert list(query_indices) == list(expected_query_indices)
+    assert list(point_indices) == list(expected_point_indices)
+
+    robot_poses = numpy.hstack([positions, numpy.zeros((len(positions), 1))])
+    targets = obstacle_avoidance.batch_obstacle_avoidance(robot_poses, [(0, 0)])
+    min_obstacles = obstacle_avoidance.SPATIAL_INDEX_MIN_OBSTACLES
+    obstacle_avoidance.SPATIAL_INDEX_MIN_OBSTACLES = obstacle_avoidance.INF
+    try:
+        assert (obstacle_avoidance.batch_obstacle_avoidance(robot_poses, [(0, 0)]) == targets).all()
+    finally:
+        obstacle_avoidance.SPATIAL_INDEX_MIN_OBSTACLES = min_obstacles
+
+
+def test_incremental_histograms():
+    random.seed(1337)
+    robot_poses = numpy.array([(random.uniform(-4, 4), random.uniform(-2.5, 2.5), random.uniform(-math.pi, math.pi))
+                               for _ in range(20)])
+    incremental_context = obstacle_avoidance.PlannerContext(incremental=True)
+    incremental_context.histogram_cache.check = True
+    context = obstacle_avoidance.PlannerContext()
+
+    for _ in range(30):
+        # only a part of the robots moves
+        for robot_pose in robot_poses[::3]:
+            robot_pose[0] += random.uniform(-0.1, 0.1)
+            robot_pose[1] += random.uniform(-0.1, 0.1)
+        targets = incremental_context.batch_obstacle_avoidance(robot_poses, [(0, 0)])
+        assert (targets == context.batch_obstacle_avoidance(robot_poses, [(0, 0)])).all()
+
+    assert incremental_context.histogram_cache.max_error < 1e-9
+    assert incremental_context.histogram_cache.skipped_cnt > 0
+
+
+def test_replanning_scheduler():
+    robot_poses = numpy.array([(-3, -2, 0), (0, -2, 0), (3, -2, 0), (-3, 2, 0), (0, 2, 0), (3, 2, 0)], dtype=float)
+    ball_predicted_positions = [(0, 0)]
+    context = obstacle_avoidance.PlannerContext()
+    scheduler = ReplanningScheduler(len(robot_poses), period=0.5)
+
+    targets = scheduler.get_targets(0, robot_poses, ball_predicted_positions, context)
+    assert (targets == obstacle_avoidance.batch_obstacle_avoidance(robot_poses, ball_predicted_positions)).all()
+    assert scheduler.planned_cnt == 6
+
+    scheduler.get_targets(0.1, robot_poses, ball_predicted_positions, context)
+    assert scheduler.planned_cnt == 6
+
+    # the first robot comes close to the second one, both of them have to replan
+    robot_poses[0, 0] = -1
+    scheduler.get_targets(0.2, robot_poses, ball_predicted_positions, context)
+    assert scheduler.planned_cnt == 8
+    assert scheduler.triggers_cnt[ReplanningScheduler.Trigger.OBSTACLE_NEAR] == 2
+
+    scheduler.get_targets(0.5, robot_poses, ball_predicted_positions, context)
+    assert scheduler.planned_cnt == 12
+    assert scheduler.skipped_cnt == 12
+
+    # kept targets are the fresh ones while nothing moves, then they drift away from them
+    scheduler = ReplanningScheduler(len(robot_poses), period=0.5, use_events=False, drift_check_period=1)
+    scheduler.get_targets(0, robot_poses, ball_predicted_positions, context)
+    scheduler.get_targets(0.1, robot_poses, ball_predicted_positions, context)
+    assert scheduler.drift_checks_cnt == 6 and scheduler.max_drift == 0
+    robot_poses[:, 1] += 0.5
+    scheduler.get_targets(0.2, robot_poses, ball_predicted_positions, context)
+    assert scheduler.drift_checks_cnt == 12 and scheduler.max_drift > 0
+    assert 'drift' in scheduler.get_report(0.3)
+
+
+def test_decision_cache():
+    robot_poses = numpy.array([(-3, -2, 0), (-2.6, -1.8, 0), (3, 2, 0), (2.5, 2.2, 0)], dtype=float)
+    obstacles_positions = numpy.array([(-2, -1.5), (-1, -2), (2, 1.5), (1, 2)], dtype=float)
+    context = obstacle_avoidance.PlannerContext()
+    cached_context = obstacle_avoidance.PlannerContext(decision_cache=obstacle_avoidance.DecisionCache(capacity=4))
+
+    for _ in range(3):
+        expected = context.batch_obstacle_avoidance(robot_poses, [(0, 0)], obstacles_positions)
+        assert (cached_context.batch_obstacle_avoidance(robot_poses, [(0, 0)], obstacles_positions) == expected).all()
+        assert (cached_context.is_chosen[:4] == context.is_chosen[:4]).all()
+    decision_cache = cached_context.decision_cache
+    assert (decision_cache.misses_cnt, decision_cache.hits_cnt) == (4, 8)
+
+    # the same local scene elsewhere on the field is a hit
+    shifted_poses = robot_poses + (0.5, 0.25, 0)
+    cached_context.batch_obstacle_avoidance(shifted_poses, [(0.5, 0.25)], obstacles_positions + (0.5, 0.25))
+    assert decision_cache.hits_cnt == 12
+
+    cached_context.batch_obstacle_avoidance(robot_poses, [(3, -2)], obstacles_positions)
+    assert decision_cache.evictions_cnt > 0 and len(decision_cache) == 4
+
+
+def test_move_to_dot_batch():
+    random.seed(42)
+    ball = Ball(1, 0.5, 0, 0)
+    robot_poses = [(random.uniform(-4, 4), random.uniform(-2.5, 2.5), random.uniform(-math.pi, math.pi))
+                   for _ in range(200)]
+    targets = [(x + random.uniform(-1, 1), y + random.uniform(-1, 1)) for x, y, _ in robot_poses]
+    # hunting for the close ball and standing on the target
+    robot_poses[:2] = [(1.1, 0.6, 0.3), (-1, -1, 2)]
+    targets[:2] = [ball.get_pos(), (-1, -1)]
+
+    velocities = utils.move_to_dot_batch(robot_poses, ball.get_pos(), targets)
+    for (x, y, angle), target, (vl, vr) in zip(robot_poses, targets, velocities):
+        robot = Robot(x, y, angle, constants.Color.BLUE)
+        expected_vl, expected_vr = utils.move_to_dot(robot, ball, target)
+        assert math.isclose(vl, expected_vl, abs_tol=1e-12) and math.isclose(vr, expected_vr, abs_tol=1e-12)
+
+        # the matrix form of the kinematics
+        if target != (x, y):
+            phi_vl, phi_vr = utils.calculate_phi_vector(utils.calculate_ksi_vector(1, 0.5, angle), angle)
+            assert numpy.allclose(utils._calculate_wheel_velocities(1, 0.5, angle), (phi_vl, phi_vr))
+    assert (velocities[1] == 0).all()
+    assert abs(velocities[0]).max() > constants.ROBOT_MAX_VELOCITY
+
+
+def test_world_state():
+    random.seed(7)
+    world = WorldState()
+    robots = [Robot(random.uniform(-4, 4), random.uniform(-2.5, 2.5), random.uniform(-math.pi, math.pi),
+                    constants.Color.WHITE, world) for _ in range(300)]
+    balls = [Ball(random.uniform(-4, 4), random.uniform(-2.5, 2.5), random.uniform(-5, 5), random.uniform(-5, 5),
+                  world) for _ in range(50)]
+    # straight, pure rotation and arc motions
+    for i, robot in enumerate(robots):
+        vel_left, vel_right = random.uniform(-1, 1), random.uniform(-1, 1)
+        robot.set_velocity(vel_left, (vel_left, -vel_left, vel_right)[i % 3])
+    scalar_robots = [Robot(*robot.get_pose(), robot.COLOR) for robot in robots]
+    scalar_balls = [Ball(*ball.get_pos(), *world.obstacle_velocities[ball.index]) for ball in balls]
+    for robot, scalar_robot in zip(robots, scalar_robots):
+        scalar_robot.set_velocity(robot.wheels[0].velocity, robot.wheels[1].velocity)
+
+    for _ in range(20):
+        world.step(constants.dt)
+        for scalar_robot in scalar_robots:
+            scalar_robot.move(constants.dt)
+        for scalar_ball in scalar_balls:
+            scalar_ball.move(constants.dt)
+
+    for robot, scalar_robot in zip(robots, scalar_robots):
+        assert robot.get_pose() == scalar_robot.get_pose()
+        assert numpy.allclose(robot.pos_history, scalar_robot.pos_history, rtol=0, atol=1e-12)
+        wheel_positions = world.get_wheel_positions()[robot.index]
+        assert numpy.allclose(wheel_positions, [wheel.get_pos() for wheel in robot.wheels])
+    for ball, scalar_ball in zip(balls, scalar_balls):
+        assert ball.get_pos() == scalar_ball.get_pos()
+
+
+def test_position_history():
+    world = WorldState(2, 0, history_capacity=4)
+    robots = [Robot(0, 0, 0, constants.Color.WHITE, world) for _ in range(3)]
+    for step in range(6):
+        robots[0].set_pos(step, -step)
+        if step < 2:
+            robots[1].set_pos(step, step)
+    world.record_positions([2])
+
+    assert robots[0].pos_history.tolist() == [[2, -2], [3, -3], [4, -4], [5, -5]]
+    assert robots[1].pos_history.tolist() == [[0, 0], [1, 1]]
+    assert numpy.shares_memory(robots[1].pos_history, world.history.positions)
+    assert robots[2].pos_history.tolist() == [[0, 0]]
+
+    positions, sizes = world.history.get_all(world.robots_cnt)
+    assert sizes.tolist() == [4, 2, 1]
+    assert (positions[0] == robots[0].pos_history).all()
+    assert (positions[1, -2:] == robots[1].pos_history).all()
+
+
+def test_detect_collisions():
+    random.seed(3)
+    for _ in range(50):
+        # enough robots for the grid broad phase
+        robots = [Robot(random.uniform(-4, 4), random.uniform(-2.5, 2.5), 0, constants.Color.WHITE)
+                  for _ in range(80)]
+        ball = Ball(random.uniform(-4, 4), random.uniform(-2.5, 2.5), 0, 0)
+        events = detect_collisions([robot.get_pos() for robot in robots], ball.get_pos(), 1.5)
+
+        # the robot by robot check
+        expected = []
+        for index, robot in enumerate(robots):
+            if robot.get_closest_dist_to_obstacle(robots[:index]) < 0.001:
+                expected.append((CollisionEvent.Kind.CRASH, index))
+            if robot.get_dist_to_target(ball) < Ball.RADIUS + Robot.RADIUS:
+                expected.append((CollisionEvent.Kind.BALL, index))
+        assert list(dict.fromkeys((event.kind, event.robot) for event in events)) == expected
+        assert all(event.time == 1.5 and event.other < event.robot for event in events)
+
+
+def test_sweep_collisions():
+    # head-on robots pass through each other during one big step, the ball is passed by the third robot
+    world = WorldState()
+    robots = [Robot(-1, 0, 0, constants.Color.WHITE, world), Robot(1, 0, math.pi, constants.Color.WHITE, world),
+              Robot(0, 2, 0, constants.Color.WHITE, world)]
+    for robot in robots:
+        robot.set_velocity(2, 2)
+    ball_start, ball_end = (2, 1), (2, 1)
+    dt = 1.0
+
+    robot_paths = world.get_robot_paths(dt, segments=3)
+    world.move_robots(dt)
+    assert (robot_paths[-1] == world.poses[:, :2]).all()
+    assert detect_collisions(world.poses[:, :2], ball_end, 10 + dt) == []
+
+    crash, = sweep_collisions(robot_paths, ball_start, ball_end, 10, dt)
+    assert (crash.kind, crash.robot, crash.other) == (CollisionEvent.Kind.CRASH, 1, 0)
+    # the robots close 4 m/s from 2 m between the centers
+    assert math.isclose(crash.time, 10 + (2 - 2 * Robot.RADIUS - 0.001) / 4)
+
+    # the ball comes to the third robot, the contact is at the same time whatever the segments are
+    ball_start, ball_end = (6, 2), (2, 2)
+    events = [sweep_collisions(world.get_robot_paths(dt, segments), ball_start, ball_end, 0, dt)
+              for segments in (1, 4)]
+    for segment_events in events:
+        ball_touch, = segment_events
+        assert (ball_touch.kind, ball_touch.robot) == (CollisionEvent.Kind.BALL, 2)
+        assert math.isclose(ball_touch.time, (4 - 2 * Robot.RADIUS) / 6)
+
+
+def test_adaptive_integrator():
+    world = WorldState()
+    robots = [Robot(-3, 0, 0, constants.Color.WHITE, world), Robot(3, 0, math.pi, constants.Color.WHITE, world)]
+    ball = Ball(0, 2, 0, 0)
+    for robot in robots:
+        robot.set_velocity(1, 1)
+    integrator = AdaptiveIntegrator(tolerance=0.001)
+
+    # far from each other the tick is one step
+    assert integrator.advance(robots, ball, 0.5) == []
+    assert integrator.steps_cnt == 1 and robots[0].get_pos() == (-2.5, 0)
+
+    # the robots close 2 m/s from 5 m between the centers
+    sim_time, events = 0.5, []
+    while not events:
+        events = integrator.advance(robots, ball, 0.5, sim_time)
+        sim_time += 0.5
+    crash, = events
+    assert (crash.kind, crash.robot, crash.other) == (CollisionEvent.Kind.CRASH, 1, 0)
+    contact_time = 0.5 + (5 - 2 * Robot.RADIUS - 0.001) / 2
+    # the contact is passed by the tolerance at most
+    assert contact_time <= crash.time <= contact_time + integrator.tolerance / 2
+    assert integrator.min_step_taken < 0.5
+    assert len(robots[0].pos_history) == integrator.ticks_cnt
+
+    # many robots are found by the grid, only the closing ones shorten the step
+    positions = numpy.stack(numpy.meshgrid(numpy.linspace(-5, 5, 10), numpy.linspace(-3, 3, 7)), -1).reshape(-1, 2)
+    speeds = numpy.ones(len(positions))
+    far_ball, still = (10, 10), (0, 0)
+    assert integrator.get_step(positions, speeds, far_ball, still, 0.1) == 0.1
+    positions[1] = positions[0] + (2 * Robot.RADIUS + 0.1, 0)
+    assert math.isclose(integrator.get_step(positions, speeds, far_ball, still, 0.1), (0.1 - 0.001 + 0.001) / 2)
+
+    # robots of their own worlds
+    robots = [Robot(-3, 0, 0, constants.Color.WHITE), Robot(3, 0, math.pi, constants.Color.WHITE)]
+    for robot in robots:
+        robot.set_velocity(1, 1)
+    assert AdaptiveIntegrator().advance(robots, Ball(0, 2, 0, 0), 0.5) == []
+    assert robots[0].get_pos() == (-2.5, 0) and len(robots[1].pos_history) == 1
+
+
+def test_run_headless():
+    result = run_headless(main._generate_robots(), Ball.create_randomized(seed=7), max_time=30)
+    assert (result.outcome, result.ticks) == (SimulationResult.Outcome.GOAL, 10)
+    assert math.isclose(result.sim_time, 10 * constants.dt)
+    assert result.events[0].kind == CollisionEvent.Kind.BALL
+
+    result = run_headless([Robot(-3, -2, 0, constants.Color.WHITE)], Ball(3, 2, 0, 0), max_time=0.5)
+    assert (result.outcome, result.ticks, result.events) == (SimulationResult.Outcome.TIMEOUT, 5, [])
+
+    result = run_headless([Robot(-3, -2, 0, constants.Color.WHITE)], Ball(3, 2, 0, 0), max_time=60,
+                          stop_condition=lambda events: True, adaptive_tolerance=0.01, dt=0.5)
+    assert (result.outcome, result.ticks) == (SimulationResult.Outcome.STOPPED, 1)
+
+    try:
+        SimulationEngine([Robot(-3, -2, 0, constants.Color.WHITE)], Ball(3, 2, 0, 0), continuous_collisions=True,
+                         adaptive_tolerance=0.01)
+        assert False, 'ValueError is expected'
+    except ValueError:
+        pass
+
+
+def test_batch_runner():
+    episodes = batch_runner.get_episodes([7, 13], ['fleet'], {'every tick': {}}, max_time=10)
+    random_state = random.getstate()
+    expected = {episode.seed: batch_runner.run_episode(episode) for episode in episodes}
+    assert random.getstate() == random_state
+    assert expected[7].outcome == SimulationResult.Outcome.GOAL and expected[7].ticks == 10
+    assert expected[13].outcome == SimulationResult.Outcome.CRASH and expected[13].crashes_cnt == 1
+
+    report = batch_runner.BatchReport()
+    for result in batch_runner.run_batch(episodes, workers=2):
+        assert (result.outcome, result.ticks) == (expected[result.seed].outcome, expected[result.seed].ticks)
+        report.add(result)
+    group, = report.get_summary()['groups']
+    assert (group['episodes'], group['success_rate'], group['crashes']) == (2, 0.5, 1)
+    assert group['time_to_ball_p50'] == expected[7].event_time
+
+
+def test_multi_world():
+    robot_indices, obstacle_indices = obstacle_avoidance.get_group_pairs([1, 0, 1], [0, 1, 1, 0])
+    assert robot_indices.tolist() == [0, 0, 1, 1, 2, 2]
+    assert obstacle_indices.tolist() == [1, 2, 0, 3, 1, 2]
+
+    seeds = [7, 13, 239, 42]
+    expected = [run_headless(main._generate_robots(), Ball.create_randomized(seed=seed), max_time=3)
+                for seed in seeds]
+    results = run_many_headless([(main._generate_robots(), Ball.create_randomized(seed=seed)) for seed in seeds],
+                                max_time=3)
+    for result, expected_result in zip(results, expected):
+        assert (result.outcome, result.ticks, result.events) == \
+               (expected_result.outcome, expected_result.ticks, expected_result.events)
+    assert [result.outcome for result in results[:3]] == \
+           [SimulationResult.Outcome.GOAL, SimulationResult.Outcome.CRASH, SimulationResult.Outcome.CRASH]
+
+    engine = MultiWorldEngine([[(-3, -2, 0)], [(3, 2, 0)]], [(3, 2), (3, 2)], [(0, 0), (0, 0)])
+    assert engine.step().tolist() == [1] and engine.done.tolist() == [False, True]
+    assert engine.robot_poses[1].tolist() == [[3, 2, 0]]
+    episodes = batch_runner.get_episodes([7, 13], ['fleet'], {'every tick': {}}, max_time=10)
+    assert [(result.seed, result.outcome) for result in batch_runner.run_vectorized(episodes)] == \
+           [(7, SimulationResult.Outcome.GOAL), (13, SimulationResult.Outcome.CRASH)]
+
+
+def test_layered_renderer():
+    robots, ball = main._generate_robots(), Ball.create_randomized(seed=42)
+    obstacles = [MovingObstacle(0, 0, 0.3, -0.2)]
+    engine = SimulationEngine(robots, ball, obstacles)
+    renderer = LayeredRenderer()
+    # more ticks than the history limit, so the trail dots are dropped too
+    for _ in range(constants.POS_HISTORY_LIMIT + 10):
+        assert numpy.array_equal(renderer.render(robots, ball, obstacles), render_scene(robots, ball, obstacles))
+        engine.detect()
+        engine.move(engine.plan())
+        obstacles[0].move(engine.dt)
+    assert renderer.full_redraws_cnt == 1
+
+    frame = renderer.get_frame()
+    frame[:] = 0
+    assert numpy.array_equal(renderer.render(robots[:3], ball, []), render_scene(robots[:3], ball, []))
+    assert renderer.full_redraws_cnt == 2 and frame is renderer.get_frame()
+
+
+def test_draw_planner_results():
+    robots = main._generate_robots()
+    engine = SimulationEngine(robots, Ball.create_randomized(seed=7))
+    engine.detect()
+    engine.plan()
+    results = [engine.get_planner_result(index) for index in range(len(robots))]
+    centers = [robot.get_pos() for robot in robots]
+
+    expected = numpy.zeros((constants.WINDOW_HEIGHT, constants.WINDOW_WIDTH, 3), dtype=numpy.uint8)
+    for center, result in zip(centers, results):
+        for i, sector in enumerate(obstacle_avoidance._sectors):
+            sector.draw(expected, obstacle_avoidance.Point(*center), result.is_empty[i], result.is_chosen[i],
+                        result.is_danger[i])
+    screen = numpy.zeros_like(expected)
+    obstacle_avoidance.draw_planner_results(screen, centers, results)
+    # the dots are on the rays up to their radius and the line rasterization, the dots beyond the borders
+    # of the screen have their edges on it
+    near_rays = cv2.dilate(screen.any(axis=-1).astype(numpy.uint8), numpy.ones((5, 5), numpy.uint8))
+    assert not (expected.any(axis=-1) & (near_rays == 0))[2:-2, 2:-2].any()
+
+    marked_screen = numpy.zeros_like(expected)
+    obstacle_avoidance.draw_planner_results(marked_screen, centers, results, only_marked=True)
+    marked_colors = {tuple(color) for color in marked_screen.reshape(-1, 3).tolist()}
+    assert marked_colors <= {(0, 0, 0), constants.Color.PURPLE, constants.Color.RED2}
+    assert constants.Color.PURPLE in marked_colors and numpy.array_equal(marked_screen[marked_screen.any(axis=-1)],
+                                                                          screen[marked_screen.any(axis=-1)])
+
+
+def test_async_video_writer(tmp_path):
+    frame = numpy.zeros((60, 80, 3), dtype=numpy.uint8)
+    path = str(tmp_path / 'video.avi')
+    writer = AsyncVideoWriter(path, frame_size=(80, 60), queue_size=2, frame_step=2)
+    for i in range(10):
+        frame[:] = i * 20
+        assert writer.write(frame) == (i % 2 == 0)
+    writer.close()
+    assert (writer.written_cnt, writer.dropped_cnt, writer.queue_depth) == (5, 0, 0)
+    assert cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT) == 5
+
+    class SlowWriter:
+        def __init__(self):
+            self.frames = []
+            self.is_ready = threading.Event()
+
+        def write(self, frame):
+            self.is_ready.wait()
+            self.frames.append(frame.copy())
+
+        def release(self):
+            pass
+
+    slow_writer = SlowWriter()
+    writer = AsyncVideoWriter(None, frame_size=(80, 60), queue_size=2, writer=slow_writer,
+                              backpressure=AsyncVideoWriter.Backpressure.DROP)
+    assert [writer.write(numpy.full_like(frame, i)) for i in range(5)] == [True, True, False, False, False]
+    slow_writer.is_ready.set()
+    writer.close()
+    assert writer.dropped_cnt == 3 and [int(frame[0, 0, 0]) for frame in slow_writer.frames] == [0, 1]
+
+
+def test_trajectory(tmp_path):
+    path = str(tmp_path / 'run.npz')
+    robots, ball = main._generate_robots(), Ball.create_randomized(seed=239)
+    result = run_headless(robots, ball, max_time=30, recorder=TrajectoryRecorder(path, 8, numpy.float64))
+    trajectory = Trajectory.load(path)
+    assert trajectory.ticks.tolist() == list(range(result.ticks + 1))
+    assert numpy.isnan(trajectory.targets[-1]).all() and (trajectory.chosen_sectors[-1] == -1).all()
+    assert numpy.array_equal(trajectory.robot_poses[-1], [robot.get_pose() for robot in robots])
+
+    replay = TrajectoryReplay(trajectory)
+    assert numpy.array_equal(replay.render(result.ticks, overlay=False), render_scene(robots, ball, []))
+    assert numpy.array_equal(replay.plan(20), trajectory.targets[20])
+    flags = trajectory.get_sector_flags(20)
+    assert (flags[:, 1].argmax(axis=-1) == trajectory.chosen_sectors[20]).all()
+    assert not numpy.array_equal(replay.render(5).copy(), replay.render(5, overlay=False))
+
+
+def test_export_video(tmp_path):
+    path, output_path = str(tmp_path / 'run.npz'), str(tmp_path / 'run.avi')
+    run_headless(main._generate_robots(), Ball.create_randomized(seed=13), max_time=30,
+                 recorder=TrajectoryRecorder(path))
+    ticks = Trajectory.load(path).ticks
+    assert numpy.array_equal(numpy.concatenate(get_chunks(ticks, 3)), ticks)
+
+    assert export_video(path, output_path, workers=2, chunks_cnt=3) == len(ticks)
+    capture = cv2.VideoCapture(output_path)
+    assert capture.get(cv2.CAP_PROP_FRAME_COUNT) == len(ticks)
+    assert (capture.get(cv2.CAP_PROP_FRAME_WIDTH), capture.get(cv2.CAP_PROP_FRAME_HEIGHT)) == \
+           (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT)
+
+    # all rows are dropped, nothing to export
+    recorder = TrajectoryRecorder(path)
+    recorder.record(SimulationEngine(main._generate_robots(), Ball.create_randomized(seed=13)))
+    recorder.truncate(0)
+    recorder.close()
+    try:
+        export_video(path, output_path)
+        assert False, 'ValueError is expected'
+    except ValueError:
+        pass
+
+
+def test_engine_snapshot(tmp_path):
+    robots, ball = main._generate_robots(), Ball.create_randomized(seed=42)
+    recorder = TrajectoryRecorder(str(tmp_path / 'run.npz'), chunk_size=4)
+    engine = SimulationEngine(robots, ball, replanning_period=0.5, recorder=recorder)
+    for _ in range(10):
+        engine.step()
+    snapshot = engine.snapshot()
+
+    def run(engine, ticks=15):
+        states = []
+        for _ in range(ticks):
+            events = engine.step()
+            states.append((events, [robot.get_pose() for robot in engine.robots], engine.ball.get_pos()))
+        return states, engine.robots[0].pos_history.copy(), engine.scheduler.planned_cnt
+
+    expected = run(engine)
+    engine.restore(snapshot)
+    assert recorder.rows_cnt == 10 and engine.ticks == 10
+    for engine_copy in (engine, engine.fork(snapshot)):
+        states, history, planned_cnt = run(engine_copy)
+        assert states == expected[0] and numpy.array_equal(history, expected[1]) and planned_cnt == expected[2]
+    assert recorder.rows_cnt == 25
+    assert all(robot.world is not robots[0].world for robot in engine_copy.robots) and engine_copy.recorder is None
+    assert engine.ticks == 25 and robots[0].get_pose() == expected[0][-1][1][0]
+
+    fork = engine.fork(snapshot, replanning_period=None)
+    assert fork.scheduler is None and fork.ticks == 10
+    fork.step()
+    assert engine.ticks == 25
+
+
+def test_fixed_step_clock():
+    now = [0.0]
+    clock = FixedStepClock(0.25, speed=1.0, render_fps=4, max_ticks_per_frame=3, clock=lambda: now[0])
+    assert clock.advance() == 0 and clock.is_frame_due() and not clock.is_frame_due()
+    assert clock.get_wait() == 0.25
+
+    def run(clock, max_ticks_cnt=None):
+        ticks_cnt = clock.advance()
+        for _ in range(ticks_cnt if max_ticks_cnt is None else min(ticks_cnt, max_ticks_cnt)):
+            clock.count_tick()
+        return ticks_cnt
+
+    ticks_cnt = 0
+    for _ in range(8):
+        now[0] += 0.125
+        ticks_cnt += run(clock)
+    assert ticks_cnt == 4 and clock.real_time_factor == 1.0
+    assert clock.is_frame_due() and clock.skipped_frames_cnt == 3
+
+    # a slow frame: only the allowed ticks are caught up with and the missed frames are skipped,
+    # only the ticks which are done count (the loop stops on an event)
+    now[0] += 2.0
+    assert run(clock, max_ticks_cnt=1) == 3 and clock.dropped_time == 1.25
+    assert clock.is_frame_due() and clock.skipped_frames_cnt == 10 and not clock.is_frame_due()
+    assert clock.frames_cnt == 3 and clock.sim_time == 1.25
+
+    clock.reset()
+    now[0] += 0.5
+    assert run(clock) == 2 and clock.real_time_factor == 1.0 and clock.frames_cnt == 0
+
+    fast_clock = FixedStepClock(0.25, speed=4.0, max_ticks_per_frame=10, clock=lambda: now[0])
+    now[0] += 0.5
+    assert run(fast_clock) == 8 and fast_clock.real_time_factor == 4.0
+
+
 if __name__ == '__main__':
     # test_no_obs()
     # test_no_obs2()
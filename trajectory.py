@@ -0,0 +1,213 @@
+import argparse
+
+import cv2
+import numpy
+
+from engine import SimulationEngine
+from models import Ball, MovingObstacle, Robot
+from obstacle_avoidance import PlannerResult, Sector, draw_planner_results
+from renderer import LayeredRenderer
+from world import WorldState
+
+
+# Columns of a trajectory, one row per recorded tick: the state of the world at the start of the tick
+# and the plan made from it (nan targets and no sectors if there was none)
+COLUMNS = ('ticks', 'robot_poses', 'wheel_velocities', 'balls', 'obstacles', 'targets', 'chosen_sectors',
+           'sector_flags')
+
+
+# Logs the state of a @SimulationEngine every tick into preallocated chunks of @chunk_size ticks, which are
+# written as one compressed .npz with a column per array on @close. Poses and velocities are stored with @dtype,
+# the sector flags (empty, chosen, danger) are bit packed.
+class TrajectoryRecorder:
+    def __init__(self, path, chunk_size=256, dtype=numpy.float32):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+
+        self.rows_cnt = 0
+        self.chunks = []
+        self._chunk = None
+        self._meta = None
+
+    def _allocate_chunk(self, robots_cnt, obstacles_cnt, sectors_cnt):
+        size, dtype = self.chunk_size, self.dtype
+        return {
+            'ticks': numpy.zeros(size, dtype=numpy.int32),
+            'robot_poses': numpy.zeros((size, robots_cnt, 3), dtype=dtype),
+            'wheel_velocities': numpy.zeros((size, robots_cnt, 2), dtype=dtype),
+            'balls': numpy.zeros((size, 4), dtype=dtype),  # x, y, vx, vy
+            'obstacles': numpy.zeros((size, obstacles_cnt, 4), dtype=dtype),
+            'targets': numpy.zeros((size, robots_cnt, 2), dtype=dtype),
+            'chosen_sectors': numpy.zeros((size, robots_cnt), dtype=numpy.int16),
+            'sector_flags': numpy.zeros((size, robots_cnt, 3, (sectors_cnt + 7) // 8), dtype=numpy.uint8),
+        }
+
+    # Current state of @engine with @robot_targets planned from it, if any
+    def record(self, engine: SimulationEngine, robot_targets=None):
+        robots, ball, obstacles = engine.robots, engine.ball, engine.obstacles
+        results = [engine.get_planner_result(index) for index in range(len(robots))] \
+            if robot_targets is not None else []
+        if self._meta is None:
+            self._meta = {'dt': engine.dt, 'sectors_cnt': Sector.COUNT,
+                          'robot_colors': numpy.array([robot.COLOR for robot in robots], dtype=numpy.uint8)}
+
+        row = self.rows_cnt % self.chunk_size
+        if row == 0:
+            self._chunk = self._allocate_chunk(len(robots), len(obstacles), self._meta['sectors_cnt'])
+            self.chunks.append(self._chunk)
+        chunk = self._chunk
+
+        chunk['ticks'][row] = engine.ticks
+        chunk['robot_poses'][row] = [robot.get_pose() for robot in robots]
+        chunk['wheel_velocities'][row] = [robot.world.wheel_velocities[robot.index] for robot in robots]
+        chunk['balls'][row] = (*ball.get_pos(), *ball.world.obstacle_velocities[ball.index])
+        chunk['obstacles'][row] = numpy.reshape([(*obstacle.get_pos(), *obstacle.world.obstacle_velocities[
+            obstacle.index]) for obstacle in obstacles], (-1, 4))
+        if results:
+            chunk['targets'][row] = robot_targets
+            flags = numpy.array([(result.is_empty, result.is_chosen, result.is_danger) for result in results])
+            chunk['chosen_sectors'][row] = numpy.where(flags[:, 1].any(axis=-1), flags[:, 1].argmax(axis=-1), -1)
+            chunk['sector_flags'][row] = numpy.packbits(flags, axis=-1)
+        else:
+            chunk['targets'][row] = numpy.nan
+            chunk['chosen_sectors'][row] = -1
+            chunk['sector_flags'][row] = 0
+        self.rows_cnt += 1
+
+    # Drops the rows of @ticks and later ones, e.g. after the engine is restored to a snapshot
+    def truncate(self, ticks):
+        if not self.chunks:
+            return
+        recorded_ticks = numpy.concatenate([chunk['ticks'] for chunk in self.chunks])[:self.rows_cnt]
+        self.rows_cnt = int(numpy.searchsorted(recorded_ticks, ticks))
+        self.chunks = self.chunks[:(self.rows_cnt + self.chunk_size - 1) // self.chunk_size]
+        self._chunk = self.chunks[-1] if self.chunks else None
+
+    def get_columns(self):
+        columns = {}
+        for name in COLUMNS:
+            arrays = [chunk[name] for chunk in self.chunks]
+            if arrays:
+                arrays[-1] = arrays[-1][:self.rows_cnt - (len(arrays) - 1) * self.chunk_size]
+            columns[name] = numpy.concatenate(arrays) if arrays else numpy.zeros(0)
+        return {**columns, **(self._meta or {})}
+
+    def close(self):
+        numpy.savez_compressed(self.path, **self.get_columns())
+
+
+# Recorded run loaded from the file of @TrajectoryRecorder, @columns are its arrays
+class Trajectory:
+    def __init__(self, columns):
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+        self.dt = float(columns['dt'])
+        self.sectors_cnt = int(columns['sectors_cnt'])
+        self.robot_colors = [tuple(color) for color in columns['robot_colors'].tolist()]
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as columns:
+            return cls(dict(columns))
+
+    @property
+    def robots_cnt(self):
+        return self.robot_poses.shape[1]
+
+    # Row of the @tick, the last recorded one before it if the tick was not recorded
+    def get_row(self, tick):
+        if not self.ticks[0] <= tick <= self.ticks[-1]:
+            raise IndexError(f'Tick {tick} is not in {self.ticks[0]}..{self.ticks[-1]}')
+        return int(numpy.searchsorted(self.ticks, tick, side='right')) - 1
+
+    # (empty, chosen, danger) flags (N, 3, S) of the plan made at the row
+    def get_sector_flags(self, row):
+        return numpy.unpackbits(self.sector_flags[row], axis=-1, count=self.sectors_cnt).astype(bool)
+
+    def get_planner_results(self, row) -> [PlannerResult]:
+        flags = self.get_sector_flags(row)
+        return [PlannerResult(tuple(target), *robot_flags) for target, robot_flags in
+                zip(self.targets[row].tolist(), flags)]
+
+
+# Puts a world to any recorded tick to render it, run the detection or plan from it again.
+# The robot trails are restored from the poses recorded before the tick.
+class TrajectoryReplay:
+    def __init__(self, trajectory: Trajectory, detector=None):
+        self.trajectory = trajectory
+        self.world = WorldState(trajectory.robots_cnt, trajectory.obstacles.shape[1] + 1)
+        self.robots = [Robot(*pose, color, self.world)
+                       for pose, color in zip(trajectory.robot_poses[0].tolist(), trajectory.robot_colors)]
+        self.obstacles = [MovingObstacle(*obstacle, self.world) for obstacle in trajectory.obstacles[0].tolist()]
+        self.ball = Ball(*trajectory.balls[0].tolist(), self.world)
+        self.engine = SimulationEngine(self.robots, self.ball, self.obstacles, trajectory.dt, detector)
+        self.renderer = LayeredRenderer()
+        self.row = None
+
+    def seek(self, tick):
+        trajectory, world = self.trajectory, self.world
+        self.row = row = trajectory.get_row(tick)
+        robots_cnt = trajectory.robots_cnt
+        world.robot_poses[:robots_cnt] = trajectory.robot_poses[row]
+        world.wheel_velocities[:robots_cnt] = trajectory.wheel_velocities[row]
+        for obstacle, state in zip([*self.obstacles, self.ball],
+                                   [*trajectory.obstacles[row], trajectory.balls[row]]):
+            world.obstacle_positions[obstacle.index] = state[:2]
+            world.obstacle_velocities[obstacle.index] = state[2:]
+
+        # positions are recorded after the moves, so the first row (before any) is not in the history
+        history = world.history
+        rows = numpy.flatnonzero(trajectory.ticks[:row + 1] > 0)[-history.capacity:]
+        history.positions[:robots_cnt, :len(rows)] = trajectory.robot_poses[rows, :, :2].transpose(1, 0, 2)
+        history.sizes[:robots_cnt] = len(rows)
+        history.heads[:robots_cnt] = len(rows) % history.capacity
+        self.engine.ticks = int(trajectory.ticks[row])
+
+    # Frame of the @tick as @run_simulation shows it, with the recorded plan if @overlay is set
+    def render(self, tick, overlay=True):
+        self.seek(tick)
+        self.renderer.render(self.robots, self.ball, self.obstacles)
+        frame = self.renderer.get_frame()
+        if overlay and not numpy.isnan(self.trajectory.targets[self.row]).all():
+            draw_planner_results(frame, [robot.get_pos() for robot in self.robots],
+                                 self.trajectory.get_planner_results(self.row))
+        return frame
+
+    # Ball and obstacle positions found by the detector (true positions without it) on the scene of the @tick
+    def detect(self, tick):
+        self.seek(tick)
+        self.engine.detect(self.renderer.render(self.robots, self.ball, self.obstacles))
+        return self.engine.ball_predicted_positions, self.engine.barriers_predicted_positions
+
+    # Targets planned again from the state of the @tick with the current planner
+    def plan(self, tick):
+        self.detect(tick)
+        return self.engine.plan().copy()
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Renders a tick of a recorded trajectory')
+    parser.add_argument('path')
+    parser.add_argument('--tick', type=int, default=None, help='the last recorded tick by default')
+    parser.add_argument('--output', default='frame.png')
+    parser.add_argument('--detect', action='store_true', help='run the MSER detection on the tick')
+    args = parser.parse_args()
+
+    trajectory = Trajectory.load(args.path)
+    tick = int(trajectory.ticks[-1]) if args.tick is None else args.tick
+    detector = None
+    if args.detect:
+        from obstacle_detection.mser import MSERObstacleDetector
+        detector = MSERObstacleDetector()
+    replay = TrajectoryReplay(trajectory, detector)
+
+    cv2.imwrite(args.output, cv2.cvtColor(replay.render(tick), cv2.COLOR_RGB2BGR))
+    print(f'Tick {tick} of {trajectory.ticks[0]}..{trajectory.ticks[-1]} is written to {args.output}')
+    if args.detect:
+        ball_positions, barrier_positions = replay.detect(tick)
+        print(f'Ball: {ball_positions}, barriers: {barrier_positions}')
+
+
+if __name__ == '__main__':
+    _main()
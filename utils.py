@@ -26,19 +26,45 @@ def calculate_phi_vector(ksi, theta):
     return phi[1][0], phi[0][0]
 
 
+# Closed form of @calculate_phi_vector(@calculate_ksi_vector(v, omega, theta), theta) on plain floats,
+# returns (vel left, vel right)
+def _calculate_wheel_velocities(v, omega, theta):
+    cos, sin = math.cos(theta), math.sin(theta)
+    ksi_x, ksi_y = cos * v, sin * v
+    coeff = 1 / constants.r
+    forward = coeff * cos * ksi_x + coeff * sin * ksi_y
+    turn = coeff * constants.l * omega
+    return forward - turn, forward + turn
+
+
+def _limit_velocities(vl_chosen, vr_chosen, max_velocity):
+    vl_abs = abs(vl_chosen)
+    vr_abs = abs(vr_chosen)
+    if vl_abs > max_velocity or vr_abs > max_velocity:
+        if vl_abs > vr_abs:
+            diff = vr_abs / vl_abs
+            vl_abs = max_velocity
+            vr_abs = vl_abs * diff
+        else:
+            diff = vl_abs / vr_abs
+            vr_abs = max_velocity
+            vl_abs = vr_abs * diff
+    return vl_abs * _get_sign(vl_chosen), vr_abs * _get_sign(vr_chosen)
+
+
 def move_to_dot(robot, ball, target):
     robot_x, robot_y = robot.get_pos()
     target_x, target_y = target
     ball_x, ball_y = ball.get_pos()
-    #
 
-    target_vec = numpy.array([target_x - robot_x, target_y - robot_y])
-    target_vec = rotate_np_vector(target_vec, robot.angle)
-    robot_target_angle = math.atan2(target_vec[1], target_vec[0])
-    robot_target_angle = _normalize_angle(robot_target_angle)
+    # target in the robot frame, same as @rotate_np_vector
+    dx, dy = target_x - robot_x, target_y - robot_y
+    cos, sin = math.cos(robot.angle), math.sin(robot.angle)
+    target_vec_x, target_vec_y = cos * dx + sin * dy, -sin * dx + cos * dy
+    robot_target_angle = _normalize_angle(math.atan2(target_vec_y, target_vec_x))
 
     v = constants.ROBOT_MAX_VELOCITY
-    dist = numpy.linalg.norm(target_vec)
+    dist = math.sqrt(target_vec_x * target_vec_x + target_vec_y * target_vec_y)
     if dist <= 0:
         return 0, 0
 
@@ -47,23 +73,10 @@ def move_to_dot(robot, ball, target):
     # if not (-math.pi / 2 < robot_target_angle < math.pi / 2):
     #     v = -v
 
-    ksi = calculate_ksi_vector(v, omega, robot.angle)
-    vl_chosen, vr_chosen = calculate_phi_vector(ksi, robot.angle)
+    vl_chosen, vr_chosen = _calculate_wheel_velocities(v, omega, robot.angle)
 
     # Applying velocity limitations
-    vl_abs = abs(vl_chosen)
-    vr_abs = abs(vr_chosen)
-    if vl_abs > constants.ROBOT_MAX_VELOCITY or vr_abs > constants.ROBOT_MAX_VELOCITY:
-        if vl_abs > vr_abs:
-            diff = vr_abs / vl_abs
-            vl_abs = constants.ROBOT_MAX_VELOCITY
-            vr_abs = vl_abs * diff
-        else:
-            diff = vl_abs / vr_abs
-            vr_abs = constants.ROBOT_MAX_VELOCITY
-            vl_abs = vr_abs * diff
-    vl_chosen = vl_abs * _get_sign(vl_chosen)
-    vr_chosen = vr_abs * _get_sign(vr_chosen)
+    vl_chosen, vr_chosen = _limit_velocities(vl_chosen, vr_chosen, constants.ROBOT_MAX_VELOCITY)
 
     # We should move faster if target is ball and it is close to our robot
     if target_x == ball_x and target_y == ball_y:
@@ -73,10 +86,57 @@ def move_to_dot(robot, ball, target):
             vl_chosen *= vel_delta
             vr_chosen *= vel_delta
 
-    logging.info(f'move_to_dot: vel left: {vl_chosen}, vel right: {vr_chosen}')
+    logging.info('move_to_dot: vel left: %s, vel right: %s', vl_chosen, vr_chosen)
     return vl_chosen, vr_chosen
 
 
+# @move_to_dot for the whole fleet: @robot_poses is (N, 3) array of x, y, angle, @targets is (N, 2),
+# @ball_position is one for all robots or (N, 2) array of them,
+# the result is (N, 2) array of left and right wheel velocities
+def move_to_dot_batch(robot_poses, ball_position, targets):
+    robot_poses = numpy.asarray(robot_poses, dtype=float).reshape(-1, 3)
+    targets = numpy.asarray(targets, dtype=float).reshape(-1, 2)
+    robot_x, robot_y, angle = robot_poses[:, 0], robot_poses[:, 1], robot_poses[:, 2]
+    target_x, target_y = targets[:, 0], targets[:, 1]
+    ball_x, ball_y = numpy.asarray(ball_position, dtype=float).T
+
+    dx, dy = target_x - robot_x, target_y - robot_y
+    cos, sin = numpy.cos(angle), numpy.sin(angle)
+    target_vec_x, target_vec_y = cos * dx + sin * dy, -sin * dx + cos * dy
+    robot_target_angle = _normalize_angles(numpy.arctan2(target_vec_y, target_vec_x))
+
+    v = constants.ROBOT_MAX_VELOCITY
+    dist = numpy.sqrt(target_vec_x * target_vec_x + target_vec_y * target_vec_y)
+    is_moving = dist > 0
+    omega = numpy.divide(robot_target_angle, dist / v, out=numpy.zeros_like(dist), where=is_moving)
+
+    coeff = 1 / constants.r
+    forward = coeff * cos * (cos * v) + coeff * sin * (sin * v)
+    turn = coeff * constants.l * omega
+    velocities = numpy.stack([forward - turn, forward + turn], axis=-1)
+
+    # Applying velocity limitations: the faster wheel gets the max velocity, the other keeps the ratio
+    vl_abs, vr_abs = numpy.abs(velocities[:, 0]), numpy.abs(velocities[:, 1])
+    is_limited = (vl_abs > constants.ROBOT_MAX_VELOCITY) | (vr_abs > constants.ROBOT_MAX_VELOCITY)
+    is_left_faster = vl_abs > vr_abs
+    diff = numpy.divide(numpy.where(is_left_faster, vr_abs, vl_abs), numpy.where(is_left_faster, vl_abs, vr_abs),
+                        out=numpy.zeros_like(vl_abs), where=is_limited)
+    limited = constants.ROBOT_MAX_VELOCITY * diff
+    vl_abs = numpy.where(is_limited, numpy.where(is_left_faster, constants.ROBOT_MAX_VELOCITY, limited), vl_abs)
+    vr_abs = numpy.where(is_limited, numpy.where(is_left_faster, limited, constants.ROBOT_MAX_VELOCITY), vr_abs)
+    velocities = numpy.where(velocities > 0, numpy.stack([vl_abs, vr_abs], axis=-1),
+                             -numpy.stack([vl_abs, vr_abs], axis=-1))
+
+    # We should move faster if target is ball and it is close to our robot
+    is_hunting = (target_x == ball_x) & (target_y == ball_y) & \
+                 (numpy.sqrt((robot_x - target_x) ** 2 + (robot_y - target_y) ** 2) <
+                  Robot.RADIUS + constants.ROBOT_HUNT_DISTANCE)
+    velocities[is_hunting] *= constants.ROBOT_MAX_HUNT_VELOCITY / constants.ROBOT_MAX_VELOCITY
+
+    velocities[~is_moving] = 0
+    return velocities
+
+
 def cast_detector_coordinates(coords):
     local_coords = coords.copy()
     # shift
@@ -108,6 +168,12 @@ def _normalize_angle(rad):
     return in_circle
 
 
+def _normalize_angles(rad):
+    in_circle = numpy.where(rad > 0, numpy.abs(rad) % (2 * math.pi), -(numpy.abs(rad) % (2 * math.pi)))
+    in_circle = numpy.where(in_circle < -math.pi, in_circle + 2 * math.pi, in_circle)
+    return numpy.where(in_circle > math.pi, in_circle - 2 * math.pi, in_circle)
+
+
 def to_radians(deg):
     return deg * math.pi / 180
 
@@ -0,0 +1,91 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy
+
+import constants
+from trajectory import Trajectory, TrajectoryReplay
+
+FRAME_SIZE = (constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT)
+
+
+# Ticks of the trajectory split into @chunks_cnt ranges of consecutive rows
+def get_chunks(ticks, chunks_cnt):
+    return [chunk for chunk in numpy.array_split(numpy.asarray(ticks), chunks_cnt) if len(chunk)]
+
+
+# Renders the @ticks of the trajectory at @path as @run_simulation shows them and encodes them into @segment_path,
+# runs in a worker process
+def _export_chunk(path, segment_path, ticks, fps, fourcc, overlay):
+    replay = TrajectoryReplay(Trajectory.load(path))
+    writer = cv2.VideoWriter(segment_path, cv2.VideoWriter_fourcc(*fourcc), fps, FRAME_SIZE)
+    for tick in ticks:
+        writer.write(replay.render(int(tick), overlay))
+    writer.release()
+    return len(ticks)
+
+
+# Segments are joined without encoding again by ffmpeg if it is installed, otherwise they are decoded and encoded
+def _join_segments(segment_paths, output_path, fps, fourcc):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is not None:
+        list_path = os.path.join(os.path.dirname(segment_paths[0]), 'segments.txt')
+        with open(list_path, 'w') as file:
+            file.writelines(f"file '{os.path.abspath(segment_path)}'\n" for segment_path in segment_paths)
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                        '-c', 'copy', output_path], check=True)
+        return
+
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, FRAME_SIZE)
+    for segment_path in segment_paths:
+        capture = cv2.VideoCapture(segment_path)
+        is_read, frame = capture.read()
+        while is_read:
+            writer.write(frame)
+            is_read, frame = capture.read()
+        capture.release()
+    writer.release()
+
+
+# Video of the trajectory recorded at @path (see @TrajectoryRecorder): the recorded ticks are split into
+# @chunks_cnt chunks (one per worker by default), each one is rendered and encoded by a process of the pool of
+# @workers and the segments are joined into @output_path. Returns the number of frames.
+def export_video(path, output_path, fps=15, fourcc='DIVX', workers=None, chunks_cnt=None, overlay=True):
+    ticks = Trajectory.load(path).ticks
+    if not len(ticks):
+        raise ValueError(f'Trajectory {path} has no recorded ticks to export')
+    workers = workers or os.cpu_count()
+    chunks = get_chunks(ticks, chunks_cnt or workers)
+    extension = os.path.splitext(output_path)[1]
+
+    with tempfile.TemporaryDirectory() as segments_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+        segment_paths = [os.path.join(segments_dir, f'{index}{extension}') for index in range(len(chunks))]
+        futures = [executor.submit(_export_chunk, path, segment_path, ticks, fps, fourcc, overlay)
+                   for segment_path, ticks in zip(segment_paths, chunks)]
+        frames_cnt = sum(future.result() for future in futures)
+        _join_segments(segment_paths, output_path, fps, fourcc)
+    return frames_cnt
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Renders a recorded trajectory into a video in parallel')
+    parser.add_argument('path')
+    parser.add_argument('--output', default='replay.avi')
+    parser.add_argument('--fps', type=int, default=15)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunks', type=int, default=None, help='one per worker by default')
+    parser.add_argument('--no-overlay', action='store_true', help='do not draw the recorded sectors')
+    args = parser.parse_args()
+
+    frames_cnt = export_video(args.path, args.output, args.fps, workers=args.workers, chunks_cnt=args.chunks,
+                              overlay=not args.no_overlay)
+    print(f'{frames_cnt} frames are written to {args.output}')
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,91 @@
+import queue
+import threading
+
+import cv2
+import numpy
+
+import constants
+
+
+# Video recording off the simulation loop: @write copies the frame into a free buffer of a preallocated pool and
+# puts it to a bounded queue, a background thread encodes the queued frames with cv2.VideoWriter (which releases
+# the GIL while encoding) and gives the buffers back. When no buffer is free, @write waits for one with
+# the BLOCK backpressure or drops the frame with DROP. Only every @frame_step-th frame is recorded.
+# @writer is anything with write(frame) and release(), cv2.VideoWriter for @path by default.
+class AsyncVideoWriter:
+    class Backpressure:
+        BLOCK = 'block'
+        DROP = 'drop'
+
+    def __init__(self, path, fps=15, frame_size=(constants.WINDOW_WIDTH, constants.WINDOW_HEIGHT), fourcc='DIVX',
+                 queue_size=8, backpressure=Backpressure.BLOCK, frame_step=1, writer=None):
+        if backpressure not in (self.Backpressure.BLOCK, self.Backpressure.DROP):
+            raise ValueError(f'Unknown backpressure {backpressure}')
+        self.backpressure = backpressure
+        self.frame_step = frame_step
+        self.queue_size = queue_size
+        self.writer = writer if writer is not None else \
+            cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, frame_size)
+
+        width, height = frame_size
+        self.frames = numpy.zeros((queue_size, height, width, 3), dtype=numpy.uint8)
+        self._free = queue.Queue()
+        for index in range(queue_size):
+            self._free.put(index)
+        self._queued = queue.Queue(queue_size + 1)  # and the stop mark
+
+        self.frames_cnt = 0
+        self.written_cnt = 0
+        self.dropped_cnt = 0
+        self.max_queue_depth = 0
+        self.error = None
+
+        self._thread = threading.Thread(target=self._run, name='video writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            index = self._queued.get()
+            if index is None:
+                break
+            try:
+                if self.error is None:
+                    self.writer.write(self.frames[index])
+                    self.written_cnt += 1
+            except Exception as error:  # reported by @close, the simulation goes on
+                self.error = error
+            self._free.put(index)
+
+    @property
+    def queue_depth(self):
+        return self._queued.qsize()
+
+    # Queues a copy of @frame, returns whether it is queued (not skipped by @frame_step or dropped)
+    def write(self, frame):
+        self.frames_cnt += 1
+        if (self.frames_cnt - 1) % self.frame_step:
+            return False
+        try:
+            index = self._free.get(block=self.backpressure == self.Backpressure.BLOCK)
+        except queue.Empty:
+            self.dropped_cnt += 1
+            return False
+
+        numpy.copyto(self.frames[index], frame)
+        self._queued.put(index)
+        self.max_queue_depth = max(self.max_queue_depth, self._queued.qsize())
+        return True
+
+    # Writes the queued frames and releases the writer
+    def close(self):
+        if self._thread.is_alive():
+            self._queued.put(None)
+            self._thread.join()
+            self.writer.release()
+        if self.error is not None:
+            raise self.error
+
+    def get_report(self):
+        return f'Video: {self.written_cnt} of {self.frames_cnt} frames written (every {self.frame_step}), ' \
+               f'{self.dropped_cnt} dropped, queue depth {self.queue_depth} (max {self.max_queue_depth}) ' \
+               f'of {self.queue_size}'
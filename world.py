@@ -0,0 +1,230 @@
+import numpy
+
+import constants
+
+
+# Fixed capacity ring buffers of positions, one per row, in one (N, @capacity, 2) array. Appending is O(1)
+# for any number of rows. While a row is not full its positions are in order from the slot 0, so the ordered
+# history is a view, afterwards it takes one copy.
+class PositionHistory:
+    def __init__(self, rows_cnt, capacity=constants.POS_HISTORY_LIMIT):
+        self.capacity = capacity
+        self.positions = numpy.zeros((rows_cnt, capacity, 2))
+        self.heads = numpy.zeros(rows_cnt, dtype=numpy.intp)
+        self.sizes = numpy.zeros(rows_cnt, dtype=numpy.intp)
+
+    def resize(self, rows_cnt):
+        positions = numpy.zeros((rows_cnt, self.capacity, 2))
+        heads, sizes = numpy.zeros(rows_cnt, dtype=numpy.intp), numpy.zeros(rows_cnt, dtype=numpy.intp)
+        kept = min(rows_cnt, len(self.positions))
+        positions[:kept], heads[:kept], sizes[:kept] = self.positions[:kept], self.heads[:kept], self.sizes[:kept]
+        self.positions, self.heads, self.sizes = positions, heads, sizes
+
+    def append(self, index, x, y):
+        head = self.heads[index]
+        self.positions[index, head] = x, y
+        self.heads[index] = (head + 1) % self.capacity
+        self.sizes[index] = min(self.sizes[index] + 1, self.capacity)
+
+    # Appends (K, 2) @positions to the rows with @indices (unique)
+    def append_many(self, indices, positions):
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        heads = self.heads[indices]
+        self.positions[indices, heads] = positions
+        self.heads[indices] = (heads + 1) % self.capacity
+        self.sizes[indices] = numpy.minimum(self.sizes[indices] + 1, self.capacity)
+
+    def clear(self, index):
+        self.heads[index] = self.sizes[index] = 0
+
+    # Ordered (size, 2) positions of the row from the oldest one
+    def get(self, index):
+        head, size = self.heads[index], self.sizes[index]
+        if size < self.capacity:
+            return self.positions[index, :size]
+        return numpy.concatenate([self.positions[index, head:], self.positions[index, :head]])
+
+    # Ordered (N, capacity, 2) positions of all rows with the oldest ones first and (N,) sizes,
+    # the positions of a row are at the end if it is not full
+    def get_all(self, rows_cnt=None):
+        rows_cnt = len(self.positions) if rows_cnt is None else rows_cnt
+        slots = (self.heads[:rows_cnt, None] + numpy.arange(self.capacity)) % self.capacity
+        return numpy.take_along_axis(self.positions[:rows_cnt], slots[..., None], axis=1), self.sizes[:rows_cnt]
+
+
+# Copy of the rows of a @WorldState to put it back to by @WorldState.restore
+class WorldSnapshot:
+    def __init__(self, world):
+        self.robot_poses = world.poses.copy()
+        self.wheel_velocities = world.velocities.copy()
+        self.history_positions = world.history.positions[:world.robots_cnt].copy()
+        self.history_heads = world.history.heads[:world.robots_cnt].copy()
+        self.history_sizes = world.history.sizes[:world.robots_cnt].copy()
+        self.obstacle_positions = world.obstacle_positions[:world.obstacles_cnt].copy()
+        self.obstacle_velocities = world.obstacle_velocities[:world.obstacles_cnt].copy()
+
+
+# State of all robots and moving obstacles (the ball is one of them) in contiguous arrays:
+# @robot_poses rows are x, y, theta, @wheel_velocities rows are left and right wheel velocities,
+# @obstacle_positions and @obstacle_velocities rows are x, y and vx, vy.
+# @Robot, @MovingObstacle and @Ball objects are views onto the rows, so the whole world is moved
+# by one array operation per motion case while drawing still goes through the objects.
+class WorldState:
+    ROBOT_WIDTH = constants.UNITS_RADIUS * 2
+    OBSTACLE_RADIUS = constants.UNITS_RADIUS
+
+    def __init__(self, robots_capacity=16, obstacles_capacity=16, history_capacity=constants.POS_HISTORY_LIMIT):
+        self.robots_cnt = 0
+        self.robot_poses = numpy.zeros((robots_capacity, 3))
+        self.wheel_velocities = numpy.zeros((robots_capacity, 2))
+        self.history = PositionHistory(robots_capacity, history_capacity)
+        self.robots = []
+
+        self.obstacles_cnt = 0
+        self.obstacle_positions = numpy.zeros((obstacles_capacity, 2))
+        self.obstacle_velocities = numpy.zeros((obstacles_capacity, 2))
+        self.obstacles = []
+
+    @staticmethod
+    def _grow(array, cnt):
+        if cnt < len(array):
+            return array
+        grown = numpy.zeros((max(2 * len(array), 1), *array.shape[1:]), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    # Rows of the @robot view, returns its index
+    def add_robot(self, x, y, theta, robot=None):
+        self.robot_poses = self._grow(self.robot_poses, self.robots_cnt)
+        self.wheel_velocities = self._grow(self.wheel_velocities, self.robots_cnt)
+        if len(self.history.positions) != len(self.robot_poses):
+            self.history.resize(len(self.robot_poses))
+        self.robot_poses[self.robots_cnt] = x, y, theta
+        self.robots.append(robot)
+        self.robots_cnt += 1
+        return self.robots_cnt - 1
+
+    def add_obstacle(self, x, y, vx, vy, obstacle=None):
+        self.obstacle_positions = self._grow(self.obstacle_positions, self.obstacles_cnt)
+        self.obstacle_velocities = self._grow(self.obstacle_velocities, self.obstacles_cnt)
+        self.obstacle_positions[self.obstacles_cnt] = x, y
+        self.obstacle_velocities[self.obstacles_cnt] = vx, vy
+        self.obstacles.append(obstacle)
+        self.obstacles_cnt += 1
+        return self.obstacles_cnt - 1
+
+    @property
+    def poses(self):
+        return self.robot_poses[:self.robots_cnt]
+
+    @property
+    def velocities(self):
+        return self.wheel_velocities[:self.robots_cnt]
+
+    # (N, 2, 2) positions of the left and right wheels of all robots or the ones with @indices
+    def get_wheel_positions(self, indices=None):
+        x, y, theta = (self.poses if indices is None else self.robot_poses[indices]).T
+        offset_x = (self.ROBOT_WIDTH / 2) * numpy.sin(theta)
+        offset_y = (self.ROBOT_WIDTH / 2) * numpy.cos(theta)
+        return numpy.stack([numpy.stack([x - offset_x, y + offset_y], axis=-1),
+                            numpy.stack([x + offset_x, y - offset_y], axis=-1)], axis=1)
+
+    # Poses after @dt of the same motion model as @Robot.move for (K, 3) @poses and (K, 2) @velocities
+    @classmethod
+    def integrate(cls, poses, velocities, dt):
+        x, y, theta = poses[:, 0], poses[:, 1], poses[:, 2]
+        vel_left, vel_right = velocities[:, 0], velocities[:, 1]
+
+        rounded_left, rounded_right = numpy.round(vel_left, 3), numpy.round(vel_right, 3)
+        is_straight = rounded_left == rounded_right
+        is_rotation = ~is_straight & (rounded_left == -rounded_right)
+        is_arc = ~is_straight & ~is_rotation
+
+        # Straight line motion, y uses the right wheel velocity as the scalar model does
+        x_new = numpy.where(is_straight, x + vel_left * dt * numpy.cos(theta), x)
+        y_new = numpy.where(is_straight, y + vel_right * dt * numpy.sin(theta), y)
+
+        # Pure rotation and general circular motion
+        vel_diff = vel_right - vel_left
+        delta_theta = vel_diff * dt / cls.ROBOT_WIDTH
+        _r = numpy.divide(cls.ROBOT_WIDTH / 2.0 * (vel_right + vel_left), vel_diff,
+                          out=numpy.zeros_like(vel_diff), where=is_arc)
+        x_new = numpy.where(is_arc, x + _r * (numpy.sin(delta_theta + theta) - numpy.sin(theta)), x_new)
+        y_new = numpy.where(is_arc, y - _r * (numpy.cos(delta_theta + theta) - numpy.cos(theta)), y_new)
+        theta_new = numpy.where(is_straight, theta, theta + delta_theta)
+
+        return numpy.stack([x_new, y_new, theta_new], axis=-1)
+
+    # Same motion model as @Robot.move for all robots (or the ones with @indices) at once
+    def move_robots(self, dt, indices=None):
+        indices = slice(0, self.robots_cnt) if indices is None else numpy.asarray(indices, dtype=numpy.intp)
+        self.robot_poses[indices] = self.integrate(self.robot_poses[indices], self.wheel_velocities[indices], dt)
+
+    # (@segments + 1, K, 2) positions along the arcs of (K, 3) @poses moving with (K, 2) @velocities during @dt,
+    # from the current ones to the ones after @integrate
+    @classmethod
+    def get_paths(cls, poses, velocities, dt, segments=1):
+        fractions = [dt * (segment + 1) / segments for segment in range(segments - 1)] + [dt]
+        return numpy.stack([poses[:, :2]] + [cls.integrate(poses, velocities, fraction)[:, :2]
+                                             for fraction in fractions])
+
+    # @get_paths of the robots (all or the ones with @indices) during the next @move_robots
+    def get_robot_paths(self, dt, segments=1, indices=None):
+        indices = slice(0, self.robots_cnt) if indices is None else numpy.asarray(indices, dtype=numpy.intp)
+        return self.get_paths(self.robot_poses[indices], self.wheel_velocities[indices], dt, segments)
+
+    # Same as @MovingObstacle.move for all obstacles (or the ones with @indices) at once
+    def move_obstacles(self, dt, indices=None):
+        indices = slice(0, self.obstacles_cnt) if indices is None else numpy.asarray(indices, dtype=numpy.intp)
+        positions = self.obstacle_positions[indices] + self.obstacle_velocities[indices] * dt
+        x_min, y_min, x_max, y_max = constants.WINDOW_CORNERS
+        is_out = (positions < (x_min + self.OBSTACLE_RADIUS, y_min + self.OBSTACLE_RADIUS)) | \
+                 (positions > (x_max - self.OBSTACLE_RADIUS, y_max - self.OBSTACLE_RADIUS))
+        self.obstacle_positions[indices] = positions
+        self.obstacle_velocities[indices] = numpy.where(is_out, -self.obstacle_velocities[indices],
+                                                        self.obstacle_velocities[indices])
+
+    # Appends the positions of the robots (all or the ones with @indices) to their histories
+    def record_positions(self, indices=None):
+        indices = numpy.arange(self.robots_cnt) if indices is None else indices
+        self.history.append_many(indices, self.robot_poses[indices, :2])
+
+    def get_snapshot(self) -> WorldSnapshot:
+        return WorldSnapshot(self)
+
+    # Puts the rows back to the @snapshot of this world (or of its copy)
+    def restore(self, snapshot: WorldSnapshot):
+        robots_cnt, obstacles_cnt = len(snapshot.robot_poses), len(snapshot.obstacle_positions)
+        if (robots_cnt, obstacles_cnt) != (self.robots_cnt, self.obstacles_cnt):
+            raise ValueError(f'Snapshot of {robots_cnt} robots and {obstacles_cnt} obstacles does not fit '
+                             f'the world of {self.robots_cnt} robots and {self.obstacles_cnt} obstacles')
+        self.robot_poses[:robots_cnt] = snapshot.robot_poses
+        self.wheel_velocities[:robots_cnt] = snapshot.wheel_velocities
+        self.history.positions[:robots_cnt] = snapshot.history_positions
+        self.history.heads[:robots_cnt] = snapshot.history_heads
+        self.history.sizes[:robots_cnt] = snapshot.history_sizes
+        self.obstacle_positions[:obstacles_cnt] = snapshot.obstacle_positions
+        self.obstacle_velocities[:obstacles_cnt] = snapshot.obstacle_velocities
+
+    # Independent world with the same rows and new views of the same types onto them
+    def copy(self):
+        world = WorldState(len(self.robot_poses), len(self.obstacle_positions), self.history.capacity)
+        for robot, (x, y, theta) in zip(self.robots, self.poses.tolist()):
+            if robot is None:
+                world.add_robot(x, y, theta)
+            else:
+                type(robot)(x, y, theta, robot.COLOR, world)
+        for obstacle, (x, y), (vx, vy) in zip(self.obstacles, self.obstacle_positions[:self.obstacles_cnt].tolist(),
+                                              self.obstacle_velocities[:self.obstacles_cnt].tolist()):
+            if obstacle is None:
+                world.add_obstacle(x, y, vx, vy)
+            else:
+                type(obstacle)(x, y, vx, vy, world)
+        world.restore(self.get_snapshot())
+        return world
+
+    # Moves everything by the current wheel and obstacle velocities
+    def step(self, dt):
+        self.move_robots(dt)
+        self.move_obstacles(dt)
+        self.record_positions()